@@ -654,7 +654,7 @@ if empty_stages_p; then
   fi
 fi
 
-for component in gcc linux gmp mpfr mpc binutils newlib isl
+for component in gcc gmp mpfr mpc binutils newlib isl
 do
   find_component_or_error "$srcdir" $component
 done
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+Benchmark source-fetch.py against synthetic local fixtures.
+
+Generates git repositories of a configurable size and history depth,
+serves them over file:// and a local git daemon, serves tarballs from
+a local HTTP server, then times checkout (full and --shallow, with and
+without --cache-dir) and archive end to end.  When svnadmin is found,
+the same content also goes into subversion repositories, checked out
+over file:// as subversion components.  Results are written as JSON
+so that runs from two commits can be compared with --compare.
+"""
+
+import argparse
+import functools
+import http.server
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+SOURCE_FETCH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "source-fetch.py")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("nothing listening on port %d" % port)
+
+
+def random_text(rng, size):
+    words = ["int", "void", "return", "if", "else", "for", "while", "struct", "static", "const"]
+    out = []
+    n = 0
+    while n < size:
+        w = rng.choice(words)
+        out.append(w)
+        n += len(w) + 1
+    return (" ".join(out) + "\n").encode()
+
+
+def make_git_repo(path, rng, files, file_size, commits):
+    """
+    Create a bare repository at PATH with COMMITS commits.
+
+    The first commit adds FILES files of about FILE_SIZE bytes; each
+    later commit rewrites one of them.  The history is written with
+    git fast-import so that deep histories are cheap to generate.
+    """
+    subprocess.check_call(["git", "init", "-q", "--bare", path])
+    subprocess.check_call(["git", "-C", path, "config", "uploadpack.allowAnySHA1InWant", "true"])
+    stream = []
+    when = 1500000000
+    for c in range(commits):
+        changed = range(files) if c == 0 else [rng.randrange(files)]
+        message = ("commit %d\n" % c).encode()
+        stream.append(b"commit refs/heads/master\n")
+        stream.append(b"committer Bench <bench@example.com> %d +0000\n" % (when + c))
+        stream.append(b"data %d\n%s" % (len(message), message))
+        for f in changed:
+            data = random_text(rng, file_size)
+            stream.append(b"M 100644 inline src/f%05d.c\n" % f)
+            stream.append(b"data %d\n%s\n" % (len(data), data))
+        stream.append(b"\n")
+    subprocess.run(
+        ["git", "-C", path, "fast-import", "--quiet"],
+        input=b"".join(stream),
+        check=True,
+    )
+    subprocess.check_call(["git", "-C", path, "gc", "-q"])
+    return subprocess.check_output(["git", "-C", path, "rev-parse", "master"]).decode().strip()
+
+
+def make_svn_repo(path, rng, files, file_size, commits):
+    """
+    Create a subversion repository at PATH, with svnadmin create, of
+    COMMITS revisions shaped as make_git_repo's history.
+
+    Returns the file:// URL of its trunk and the youngest revision.
+    """
+    subprocess.check_call(["svnadmin", "create", path])
+    url = "file://%s/trunk" % path
+    wc = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(wc, "src"))
+        for f in range(files):
+            with open(os.path.join(wc, "src", "f%05d.c" % f), "wb") as fd:
+                fd.write(random_text(rng, file_size))
+        subprocess.check_call(["svn", "import", "-q", "-m", "commit 0", wc, url])
+        shutil.rmtree(wc)
+        subprocess.check_call(["svn", "checkout", "-q", url, wc])
+        for c in range(1, commits):
+            with open(os.path.join(wc, "src", "f%05d.c" % rng.randrange(files)), "wb") as fd:
+                fd.write(random_text(rng, file_size))
+            subprocess.check_call(["svn", "commit", "-q", "-m", "commit %d" % c, wc])
+    finally:
+        shutil.rmtree(wc, ignore_errors=True)
+    youngest = subprocess.check_output(["svnlook", "youngest", path]).decode().strip()
+    return url, youngest
+
+
+def make_tarball(wwwdir, name, rng, files, file_size):
+    """Write NAME.tar.gz and a one patch series for it into WWWDIR."""
+    top = os.path.join(tempfile.mkdtemp(), name)
+    os.makedirs(os.path.join(top, "src"))
+    for f in range(files):
+        with open(os.path.join(top, "src", "f%05d.c" % f), "wb") as fd:
+            fd.write(random_text(rng, file_size))
+    with open(os.path.join(top, "VERSION"), "w") as fd:
+        fd.write("1\n")
+    tarball = name + ".tar.gz"
+    with tarfile.open(os.path.join(wwwdir, tarball), "w:gz") as tf:
+        tf.add(top, arcname=name)
+    shutil.rmtree(os.path.dirname(top))
+
+    patchname = name + "-version.diff"
+    with open(os.path.join(wwwdir, patchname), "w") as fd:
+        fd.write("--- a/VERSION\n+++ b/VERSION\n@@ -1 +1 @@\n-1\n+2\n")
+    series = name + ".series"
+    with open(os.path.join(wwwdir, series), "w") as fd:
+        fd.write(patchname + "\n")
+    return tarball, series
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Fixtures(object):
+    """The synthetic repositories and tarballs, and the servers for them."""
+
+    def __init__(self, root, args):
+        self.root = root
+        self.args = args
+        self.gitdir = os.path.join(root, "git")
+        self.svndir = os.path.join(root, "svn")
+        self.wwwdir = os.path.join(root, "www")
+        os.makedirs(self.gitdir)
+        os.makedirs(self.svndir)
+        os.makedirs(self.wwwdir)
+        self.repos = []
+        self.svn_repos = []
+        self.tarballs = []
+        self._daemon = None
+        self._httpd = None
+
+    def generate(self):
+        rng = random.Random(self.args.seed)
+        for i in range(self.args.repos):
+            name = "repo%d" % i
+            sha = make_git_repo(
+                os.path.join(self.gitdir, name + ".git"),
+                rng,
+                self.args.files,
+                self.args.file_size,
+                self.args.commits,
+            )
+            self.repos.append((name, sha))
+        for i in range(self.args.tarballs):
+            name = "lib%d-1.0" % i
+            tarball, series = make_tarball(self.wwwdir, name, rng, self.args.files, self.args.file_size)
+            self.tarballs.append(("lib%d" % i, tarball, series))
+        if "svn" in self.args.transport:
+            for i in range(self.args.repos):
+                name = "svnrepo%d" % i
+                url, revision = make_svn_repo(
+                    os.path.join(self.svndir, name),
+                    rng,
+                    self.args.files,
+                    self.args.file_size,
+                    self.args.commits,
+                )
+                self.svn_repos.append((name, url, revision))
+
+    def start(self):
+        self.daemon_port = free_port()
+        self._daemon = subprocess.Popen(
+            [
+                "git",
+                "daemon",
+                "--reuseaddr",
+                "--export-all",
+                "--enable=upload-archive",
+                "--listen=127.0.0.1",
+                "--port=%d" % self.daemon_port,
+                "--base-path=%s" % self.gitdir,
+                self.gitdir,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        wait_for_port(self.daemon_port)
+
+        handler = functools.partial(QuietHandler, directory=self.wwwdir)
+        self._httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.http_port = self._httpd.server_address[1]
+        t = threading.Thread(target=self._httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        if self._daemon:
+            self._daemon.terminate()
+            self._daemon.wait()
+        if self._httpd:
+            self._httpd.shutdown()
+
+    def write_spc(self, path, transport):
+        with open(path, "w") as fd:
+            if transport == "svn":
+                for name, url, revision in self.svn_repos:
+                    fd.write("[%s]\ntype=subversion\nurl=%s\nrevision=%s\n\n" % (name, url, revision))
+                return
+            for name, sha in self.repos:
+                if transport == "file":
+                    url = "file://%s/%s.git" % (self.gitdir, name)
+                else:
+                    url = "git://127.0.0.1:%d/%s.git" % (self.daemon_port, name)
+                fd.write("[%s]\ntype=git\nurl=%s\nversion=%s\n\n" % (name, url, sha))
+            for name, tarball, series in self.tarballs:
+                base = "http://127.0.0.1:%d/" % self.http_port
+                fd.write("[%s]\ntype=tarball\nurl=%s%s\nseries=%s%s\n\n" % (name, base, tarball, base, series))
+
+
+def source_fetch(args, cwd):
+    cmd = [sys.executable, SOURCE_FETCH] + args
+    start = time.time()
+    r = subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.time() - start
+    if r.returncode != 0:
+        raise RuntimeError("%s failed:\n%s" % (" ".join(cmd), r.stderr.decode()))
+    return elapsed
+
+
+def scenarios(transport, spc):
+    """
+    Return the (name, prepare, argv) scenarios for one transport.
+
+    PREPARE says what state the cache must be in before the timed run:
+    "none" for no --cache-dir, "cold" for an empty one and "warm" for
+    one populated by an untimed checkout.
+    """
+    full = ["checkout", "--src-dir", "{src}", spc]
+    shallow = ["checkout", "--shallow", "--src-dir", "{src}", spc]
+    archive = ["archive", "-o", "{out}", spc]
+    if transport == "svn":
+        # A subversion export has no history, so there is no --shallow.
+        return [
+            ("svn/checkout/full", "none", full),
+            ("svn/checkout/full/cache-cold", "cold", full),
+            ("svn/checkout/full/cache-warm", "warm", full),
+            ("svn/archive", "none", archive),
+            ("svn/archive/cache-warm", "warm", archive),
+        ]
+    return [
+        ("%s/checkout/full" % transport, "none", full),
+        ("%s/checkout/shallow" % transport, "none", shallow),
+        ("%s/checkout/full/cache-cold" % transport, "cold", full),
+        ("%s/checkout/full/cache-warm" % transport, "warm", full),
+        ("%s/checkout/shallow/cache-warm" % transport, "warm", shallow),
+        ("%s/archive" % transport, "none", archive),
+        ("%s/archive/cache-warm" % transport, "warm", archive),
+    ]
+
+
+def run_scenario(workdir, prepare, argv, repeat):
+    times = []
+    for _ in range(repeat):
+        run = tempfile.mkdtemp(dir=workdir)
+        src = os.path.join(run, "src")
+        out = os.path.join(run, "out")
+        cache = os.path.join(run, "cache")
+        os.makedirs(out)
+        subst = dict(src=src, out=out)
+        cmd = [a.format(**subst) for a in argv]
+        if prepare != "none":
+            if prepare == "warm":
+                source_fetch(["--cache-dir", cache, "checkout", "--src-dir", os.path.join(run, "warm"), argv[-1]], run)
+            cmd = ["--cache-dir", cache] + cmd
+        times.append(source_fetch(cmd, run))
+        shutil.rmtree(run)
+    return {
+        "runs": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+    }
+
+
+def source_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "-C", os.path.dirname(SOURCE_FETCH), "rev-parse", "HEAD"],
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base_path, results, threshold):
+    """Print the change against BASE_PATH, returning the regressed scenarios."""
+    with open(base_path) as fd:
+        base = json.load(fd)["results"]
+    regressions = []
+    print("%-40s %10s %10s %8s" % ("scenario", "base", "this", "change"))
+    for name in sorted(results):
+        new = results[name]["median"]
+        if name not in base:
+            print("%-40s %10s %10.3f %8s" % (name, "-", new, "new"))
+            continue
+        old = base[name]["median"]
+        change = (new - old) / old if old else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-40s %10.3f %10.3f %+7.1f%%%s" % (name, old, new, change * 100, flag))
+    return regressions
+
+
+def main_(args):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Benchmark source-fetch.py checkout and archive.",
+        epilog=__doc__,
+    )
+    parser.add_argument("--repos", type=int, default=2, help="Number of git repositories, default 2.")
+    parser.add_argument("--tarballs", type=int, default=2, help="Number of tarballs, default 2.")
+    parser.add_argument("--files", type=int, default=200, help="Files per repository or tarball, default 200.")
+    parser.add_argument("--file-size", type=int, default=4096, help="Approximate bytes per file, default 4096.")
+    parser.add_argument("--commits", type=int, default=100, help="History depth of each repository, default 100.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per scenario, default 3.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic content.")
+    parser.add_argument(
+        "--transport",
+        action="append",
+        choices=["file", "daemon", "svn"],
+        help="Only benchmark TRANSPORT, may be repeated; svn is included by default when svnadmin is found.",
+    )
+    parser.add_argument("--filter", metavar="SUBSTRING", help="Only run scenarios whose name contains SUBSTRING.")
+    parser.add_argument("-o", "--output", metavar="FILE", default="bench.json", help="Write results to FILE.")
+    parser.add_argument("--compare", metavar="FILE", help="Compare against the results in FILE.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Relative slowdown of the median counted as a regression, default 0.10.",
+    )
+    parser.add_argument("--keep", action="store_true", help="Keep the fixture directory.")
+    args = parser.parse_args(args)
+    have_svn = shutil.which("svnadmin") is not None
+    if not args.transport:
+        args.transport = ["file", "daemon"] + (["svn"] if have_svn else [])
+        if not have_svn:
+            sys.stderr.write("svnadmin not found, skipping the svn scenarios\n")
+    elif "svn" in args.transport and not have_svn:
+        parser.error("--transport svn needs svnadmin and svn")
+
+    root = tempfile.mkdtemp(prefix="source-fetch-bench-")
+    fixtures = Fixtures(root, args)
+    results = {}
+    try:
+        start = time.time()
+        fixtures.generate()
+        sys.stderr.write("generated fixtures in %.1fs under %s\n" % (time.time() - start, root))
+        fixtures.start()
+        for transport in args.transport:
+            spc = os.path.join(root, transport + ".spc")
+            fixtures.write_spc(spc, transport)
+            for name, prepare, argv in scenarios(transport, spc):
+                if args.filter and args.filter not in name:
+                    continue
+                results[name] = run_scenario(root, prepare, argv, args.repeat)
+                sys.stderr.write("%-40s %8.3fs\n" % (name, results[name]["median"]))
+    finally:
+        fixtures.stop()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "revision": source_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git": subprocess.check_output(["git", "--version"]).decode().strip(),
+            "parameters": dict(
+                (k, getattr(args, k)) for k in ["repos", "tarballs", "files", "file_size", "commits", "repeat", "seed"]
+            ),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
+
+    if args.compare:
+        if compare(args.compare, results, args.threshold):
+            return 1
+    return 0
+
+
+def main():
+    sys.exit(main_(sys.argv[1:]))
+
+
+if __name__ == "__main__":
+    main()
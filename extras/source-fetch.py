@@ -5,13 +5,36 @@ try:
 except ImportError:
     import configparser as ConfigParser
 import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import http.client
+import http.server
+import json
 import logging
 import os
 import io
+import random
+import re
 import sys
 import subprocess
 import shutil
+import stat
+import tarfile
 import tempfile
+import threading
+import time
+import urllib.parse
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 def remove_force(path):
     try:
@@ -21,8 +44,11 @@ def remove_force(path):
 
 
 class TemporaryDirectory:
+    def __init__(self, dir=None):
+        self.dir = dir
+
     def __enter__(self):
-        self.tempdir = tempfile.mkdtemp()
+        self.tempdir = tempfile.mkdtemp(dir=self.dir)
         return self.tempdir
 
     def __exit__(self, type, value, traceback):
@@ -45,22 +71,922 @@ def named_temporary():
     fd.close()
     return fd.name
 
+class Tracer(object):
+    """
+    Collect timing spans in the Chrome trace event format.
+
+    Spans are complete ("X") events carrying the component being
+    worked on by the current thread, so a run can be loaded into
+    Perfetto or chrome://tracing.  Nothing is recorded until the
+    tracer is enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._t0 = time.time()
+
+    def enable(self):
+        self.enabled = True
+
+    def current_component(self):
+        return getattr(self._local, "component", None)
+
+    @contextlib.contextmanager
+    def component(self, name):
+        """Attribute the spans of this thread to component NAME."""
+        previous = self.current_component()
+        self._local.component = name
+        try:
+            yield
+        finally:
+            self._local.component = previous
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        """
+        Time the body as an event NAME in category CAT.
+
+        The dictionary yielded may be updated with further arguments,
+        for example an exit code or a byte count, before the span ends.
+        """
+        if not self.enabled:
+            yield args
+            return
+        component = self.current_component()
+        if component is not None:
+            args["component"] = component
+        start = time.time()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = str(e)
+            raise
+        finally:
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": int((start - self._t0) * 1e6),
+                "dur": int((time.time() - start) * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.current_thread().name,
+                "args": args,
+            }
+            with self._lock:
+                self._events.append(event)
+
+    def write(self, path):
+        with self._lock:
+            events = list(self._events)
+        threads = sorted(set(e["tid"] for e in events))
+        tids = dict((t, i) for i, t in enumerate(threads))
+        for e in events:
+            e["tid"] = tids[e["tid"]]
+        for t, i in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": i, "args": {"name": t}})
+        with open(path, "w") as fd:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fd)
+
+
+tracer = Tracer()
+
+
+class Metrics(object):
+    """
+    Counters and gauges for a Prometheus textfile collector.
+
+    Samples are keyed by metric name and a tuple of label pairs.  The
+    file is written once, at the end of a run, with --metrics-file.
+    """
+
+    HELP = {
+        "source_fetch_cache_hits_total": ("counter", "Cache lookups satisfied locally."),
+        "source_fetch_cache_misses_total": ("counter", "Cache lookups that needed the network."),
+        "source_fetch_network_bytes_total": ("counter", "Bytes fetched over the network."),
+        "source_fetch_local_bytes_total": ("counter", "Bytes served from the local cache."),
+        "source_fetch_subprocesses_total": ("counter", "Child processes spawned."),
+        "source_fetch_component_seconds": ("gauge", "Wall time spent on each component."),
+        "source_fetch_stage_seconds_total": ("counter", "Time spent running stages."),
+        "source_fetch_stage_queue_seconds_total": ("counter", "Time stages spent queued."),
+        "source_fetch_run_seconds": ("gauge", "Wall time of the run."),
+        "source_fetch_run_success": ("gauge", "Whether the run succeeded."),
+        "source_fetch_last_run_timestamp_seconds": ("gauge", "When the run finished."),
+        "source_fetch_retries_total": ("counter", "Network operations retried."),
+        "source_fetch_timeouts_total": ("counter", "Child processes killed for taking too long."),
+        "source_fetch_mirror_failovers_total": ("counter", "Fetches moved on to another mirror."),
+        "source_fetch_bundle_seeds_total": ("counter", "Repositories seeded from a git bundle."),
+        "source_fetch_discarded_total": ("counter", "Stale trees moved aside to be deleted in the background."),
+        "source_fetch_served_bytes_total": ("counter", "Bytes sent by the serve command."),
+        "source_fetch_io_throttled_seconds_total": ("counter", "Time spent waiting on the --io-limit budget."),
+        "source_fetch_cache_reclaimed_bytes_total": ("counter", "Bytes freed by cache maintenance."),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._samples[key] = value
+
+    def get(self, name, **labels):
+        return self._samples.get((name, tuple(sorted(labels.items()))), 0)
+
+    def cache(self, kind, hit, size=0):
+        """Count a lookup of KIND in the cache serving SIZE bytes."""
+        if hit:
+            self.inc("source_fetch_cache_hits_total", kind=kind)
+            self.inc("source_fetch_local_bytes_total", size, kind=kind)
+        else:
+            self.inc("source_fetch_cache_misses_total", kind=kind)
+
+    def write(self, path, **labels):
+        """Write all samples to PATH, adding LABELS to each."""
+        with self._lock:
+            samples = sorted(self._samples.items())
+        lines = []
+        for name in sorted(set(n for (n, _), _ in samples)):
+            typ, text = self.HELP.get(name, ("untyped", name))
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, typ))
+            for (n, sample_labels), value in samples:
+                if n != name:
+                    continue
+                pairs = sorted(dict(sample_labels, **labels).items())
+                label_text = ",".join(
+                    '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs
+                )
+                lines.append("%s{%s} %s" % (name, label_text, repr(float(value))))
+        # The textfile collector reads whatever is there, write atomically.
+        tmp = path + ".t"
+        with open(tmp, "w") as fd:
+            fd.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+metrics = Metrics()
+
+
+_git_progress_re = re.compile(
+    r"(Receiving objects|Resolving deltas|Updating files|Checking out files):\s+(\d+)%"
+    r"[^,]*(?:, ([\d.]+) (bytes|KiB|MiB|GiB))?"
+)
+_wget_length_re = re.compile(r"^Length: (\d+)", re.M)
+_wget_dots_re = re.compile(r"^\s*(\d+)K ([ .]+?)\s+(\d+)%", re.M)
+_units = {"bytes": 1, "KiB": 1 << 10, "MiB": 1 << 20, "GiB": 1 << 30}
+
+
+class Meter(object):
+    """
+    What one transfer has received so far, and how far along it is.
+
+    BYTES counts what has arrived and FRACTION, when the source says,
+    how much of the whole that is; PHASE names what git is doing.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.fraction = None
+        self.phase = None
+        self.start = time.time()
+        self.open = True
+        self.total = None
+        self._tail = ""
+
+    def add(self, n):
+        self.bytes += n
+
+    def _lines(self, text):
+        # git redraws with \r; keep a partial line for the next chunk.
+        text = (self._tail + text).replace("\r", "\n")
+        lines = text.split("\n")
+        self._tail = lines.pop()
+        return lines
+
+    def feed_git(self, data):
+        """Follow the --progress output of git in DATA."""
+        for line in self._lines(data.decode(errors="replace")):
+            m = _git_progress_re.search(line)
+            if m:
+                if m.group(1) != self.phase:
+                    self.phase = m.group(1)
+                    self.start = time.time()
+                self.fraction = int(m.group(2)) / 100.0
+                if m.group(3):
+                    self.bytes = int(float(m.group(3)) * _units[m.group(4)])
+
+    def feed_wget(self, data):
+        """Follow the dot progress output of wget in DATA."""
+        text = "\n".join(self._lines(data.decode(errors="replace")))
+        m = _wget_length_re.search(text)
+        if m:
+            self.total = int(m.group(1))
+        for m in _wget_dots_re.finditer(text):
+            # Each dot is a KiB.
+            self.bytes = (int(m.group(1)) + m.group(2).count(".")) * 1024
+            self.fraction = int(m.group(3)) / 100.0
+        if self.fraction == 1 and self.total is not None:
+            self.bytes = self.total
+
+    def eta(self):
+        """Return the seconds left, if they can be told."""
+        if not self.fraction or self.fraction >= 1:
+            return None
+        return (time.time() - self.start) * (1 - self.fraction) / self.fraction
+
+
+class Progress(object):
+    """
+    Live progress of the components being fetched, on stderr.
+
+    Enabled by --progress.  Each component shows its stage, the bytes
+    received, the throughput and, when the source says how far along
+    it is, the time left; a component receiving nothing for a while is
+    shown as stalled.  On a terminal the lines are redrawn every
+    second, otherwise a one line summary is written every INTERVAL
+    seconds, for CI logs.
+    """
+
+    STALLED = 10
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._components = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._drawn = 0
+
+    def enable(self, fd=None, interval=30):
+        self.enabled = True
+        self._fd = fd or sys.stderr
+        self._tty = self._fd.isatty()
+        self._interval = 1 if self._tty else max(1, interval)
+        self._thread = threading.Thread(target=self._run, name="progress")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self._draw(final=True)
+
+    def _state(self, component):
+        state = self._components.get(component)
+        if state is None:
+            now = time.time()
+            state = self._components[component] = {
+                "stage": None,
+                "meters": [],
+                "done": False,
+                "sample": (now, 0),
+                "rate": 0.0,
+                "changed": now,
+            }
+        return state
+
+    def stage(self, component, stage):
+        """Note that COMPONENT has moved on to STAGE."""
+        if self.enabled:
+            with self._lock:
+                self._state(component)["stage"] = stage
+
+    def done(self, component):
+        if self.enabled:
+            with self._lock:
+                self._state(component)["done"] = True
+
+    def meter(self, component=None):
+        """Return a new Meter counting towards COMPONENT, by default the current one."""
+        meter = Meter()
+        if self.enabled:
+            component = component or tracer.current_component() or "-"
+            with self._lock:
+                self._state(component)["meters"].append(meter)
+        return meter
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._draw()
+
+    def _lines(self, final):
+        now = time.time()
+        lines = []
+        with self._lock:
+            for component in sorted(self._components):
+                state = self._components[component]
+                received = sum(m.bytes for m in state["meters"])
+                then, before = state["sample"]
+                if now > then:
+                    rate = (received - before) / (now - then)
+                    state["rate"] = rate if final else 0.5 * state["rate"] + 0.5 * rate
+                state["sample"] = (now, received)
+                if received != before:
+                    state["changed"] = now
+                if state["done"] and not final:
+                    continue
+                line = "%s: %s %s" % (component, state["stage"] or "queued", format_size(received))
+                if state["done"]:
+                    lines.append(line + " done")
+                    continue
+                if now - state["changed"] > self.STALLED and any(m.open for m in state["meters"]):
+                    line += ", stalled for %ds" % (now - state["changed"])
+                elif state["rate"] > 0:
+                    line += ", %s/s" % format_size(state["rate"])
+                active = [m for m in state["meters"] if m.eta() is not None]
+                if active:
+                    meter = active[-1]
+                    line += ", %s %d%%, %ds left" % (meter.phase or "download", meter.fraction * 100, meter.eta())
+                lines.append(line)
+        return lines
+
+    def _draw(self, final=False):
+        lines = self._lines(final)
+        if self._tty:
+            # Move up over what was drawn last time and draw over it.
+            out = "\x1b[%dA" % self._drawn if self._drawn else ""
+            out += "".join("\x1b[2K%s\n" % line for line in lines)
+            if len(lines) < self._drawn:
+                out += "\x1b[J"
+            self._drawn = 0 if final else len(lines)
+            self._fd.write(out)
+        elif lines:
+            self._fd.write("progress: %s\n" % "; ".join(lines))
+        self._fd.flush()
+
+
+progress = Progress()
+
+
+def pack_size(mirror):
+    """Return the size of the packs of the git repository MIRROR, what a local clone reads of it."""
+    total = 0
+    try:
+        with os.scandir(os.path.join(mirror, "objects", "pack")) as it:
+            for entry in it:
+                if entry.name.endswith(".pack"):
+                    total += entry.stat().st_size
+    except OSError:
+        pass
+    return total
+
+
+def dir_size(path):
+    """Return the total size of the regular files below PATH."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class IoBudget(object):
+    """
+    Pace the bytes written to disk to RATE bytes a second.
+
+    Writers call spend() with what they have just written and are put
+    to sleep once the run is more than a second's worth ahead of the
+    rate, so a burst never outruns it for long.  A RATE of None
+    disables the budget.
+
+    Only what this process writes itself is paced: extracted tarballs,
+    exported git trees and copied trees.  git and subversion write
+    their checkouts from child processes, which --idle-io covers.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._due = 0.0
+
+    def spend(self, size):
+        if not self.rate or size <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            self._due = max(self._due, now) + float(size) / self.rate
+            delay = self._due - now - 1.0
+        if delay > 0:
+            metrics.inc("source_fetch_io_throttled_seconds_total", delay)
+            time.sleep(delay)
+
+
+io_budget = IoBudget()
+
+
+def set_idle_io(logger=None):
+    """
+    Put this process, and the children it starts from now on, in the
+    idle I/O scheduling class, so they only get the disk when nothing
+    else wants it.
+    """
+    logger = logger or logging.getLogger(__name__)
+    try:
+        child = subprocess.run(
+            ["ionice", "-c", "3", "-p", str(os.getpid())], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+    except OSError as e:
+        logger.warning("cannot set the idle I/O priority: %s" % e)
+        return
+    if child.returncode != 0:
+        logger.warning("cannot set the idle I/O priority: %s" % child.stdout.decode(errors="replace").strip())
+
+
+def _command_name(args):
+    name = os.path.basename(args[0])
+    if name == "git":
+        rest = args[1:]
+        while rest and rest[0].startswith("-"):
+            rest = rest[2:] if rest[0] in ("-C", "-c") else rest[1:]
+        if rest:
+            return "git " + rest[0]
+    return name
+
+
+class RetryPolicy(object):
+    """
+    Time limits and retries for operations that use the network.
+
+    TIMEOUT bounds a whole operation and STALL_TIMEOUT the time it may
+    go without making progress; either is disabled when None.  Failures
+    that look transient are retried up to ATTEMPTS times in all,
+    sleeping a random time of up to BACKOFF * 2**n seconds, capped at
+    MAX_BACKOFF, before the n-th retry.  When OFFLINE is set the
+    network is not used at all, see check_online.
+    """
+
+    def __init__(self, timeout=None, stall_timeout=300, attempts=3, backoff=2.0, max_backoff=60.0):
+        self.offline = False
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, retry):
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2**retry)))
+
+    def run(self, fn, what, is_transient, logger=None, cleanup=None):
+        """
+        Call FN until it succeeds or fails for good.
+
+        An exception for which IS_TRANSIENT is true is retried, after
+        calling CLEANUP if given, while attempts remain.
+        """
+        logger = logger or logging.getLogger(__name__)
+        retry = 0
+        while True:
+            try:
+                return fn()
+            except Exception as e:
+                if retry + 1 >= self.attempts or not is_transient(e):
+                    raise
+                delay = self.delay(retry)
+                retry += 1
+                metrics.inc("source_fetch_retries_total", operation=what)
+                logger.warning("%s failed, retrying in %.1fs (%d/%d): %s", what, delay, retry, self.attempts - 1, e)
+                if cleanup:
+                    cleanup()
+                time.sleep(delay)
+
+
+network_policy = RetryPolicy()
+
+
+_transient_re = re.compile(
+    "|".join(
+        [
+            r"timed out",
+            r"stalled",
+            r"[Cc]onnection (reset|refused|timed out|closed)",
+            r"[Cc]ould not resolve host",
+            r"[Tt]emporary failure in name resolution",
+            r"early EOF",
+            r"unexpected disconnect",
+            r"remote end hung up",
+            r"RPC failed",
+            r"index-pack failed",
+            r"[Nn]etwork is unreachable",
+            r"HTTP (429|5\d\d)",
+            r"returned error: (429|5\d\d)",
+        ]
+    )
+)
+
+
+def is_transient_error(e):
+    """Tell whether the exception E is worth retrying."""
+    if isinstance(e, ShellException):
+        # wget exits with 4 for network failures.
+        return e.value == 4
+    return bool(_transient_re.search(str(e)))
+
+
+_progress_re = re.compile(
+    r"^(remote: )?(Enumerating|Counting|Compressing|Receiving|Resolving|Unpacking|Checking|Updating|Total)\b"
+)
+
+
+def strip_progress(text):
+    """Remove git's --progress lines from TEXT, keeping any messages."""
+    lines = []
+    for line in text.replace("\r", "\n").splitlines():
+        if line.strip() and not _progress_re.match(line):
+            lines.append(line)
+    return "\n".join(lines) + ("\n" if lines else "")
+
+
+def _drain(pipe, chunks, activity, feed=None):
+    for chunk in iter(lambda: os.read(pipe.fileno(), 65536), b""):
+        chunks.append(chunk)
+        activity[0] = time.time()
+        if feed:
+            feed(chunk)
+    pipe.close()
+
+
+def _watch(child, stdout, timeout, stall_timeout, feed=None):
+    """
+    Wait for CHILD, killing it when it runs out of time.
+
+    Progress is any output on a piped stdout or stderr, or growth of
+    a file given as STDOUT.  Returns the captured stdout and stderr
+    and the reason the child was killed, if it was.  FEED, if given,
+    is called with each chunk of stderr as it arrives.
+    """
+    activity = [time.time()]
+    readers = []
+    out_chunks = []
+    err_chunks = []
+    for pipe, chunks, f in [(child.stdout, out_chunks, None), (child.stderr, err_chunks, feed)]:
+        if pipe is not None:
+            t = threading.Thread(target=_drain, args=(pipe, chunks, activity, f))
+            t.daemon = True
+            t.start()
+            readers.append(t)
+    size = None
+    fileno = None
+    if stdout is not None and hasattr(stdout, "fileno"):
+        try:
+            fileno = stdout.fileno()
+            size = os.fstat(fileno).st_size
+        except (OSError, IOError, ValueError):
+            fileno = None
+
+    start = time.time()
+    reason = None
+    while True:
+        try:
+            child.wait(timeout=0.25)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+        now = time.time()
+        if fileno is not None:
+            current = os.fstat(fileno).st_size
+            if current != size:
+                size = current
+                activity[0] = now
+        if timeout and now - start > timeout:
+            reason = "timed out after %ds" % timeout
+        elif stall_timeout and now - activity[0] > stall_timeout:
+            reason = "stalled, no progress for %ds" % stall_timeout
+        if reason:
+            child.kill()
+            child.wait()
+            break
+    for t in readers:
+        t.join()
+    out = b"".join(out_chunks) if child.stdout is not None else None
+    err = b"".join(err_chunks) if child.stderr is not None else None
+    return out, err, reason
+
+
+def run_process(
+    args,
+    cwd=None,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+    stdin=None,
+    input=None,
+    timeout=None,
+    stall_timeout=None,
+):
+    """
+    Run ARGS to completion, returning a subprocess.CompletedProcess.
+
+    Every child process spawned by this script goes through here so
+    that each shows up in the --trace output with its exit code and
+    the number of bytes it wrote to STDOUT or, for a transfer by git
+    or wget, the bytes it received as its progress output tells.
+
+    With TIMEOUT or STALL_TIMEOUT the child is killed when it runs for
+    too long or stops making progress; the reason is appended to its
+    stderr, when captured, and its return code is negative.
+    """
+    name = _command_name(args)
+    metrics.inc("source_fetch_subprocesses_total", program=name)
+    with tracer.span(name, "process", command=" ".join(args)) as span:
+        offset = None
+        if hasattr(stdout, "tell"):
+            try:
+                offset = stdout.tell()
+            except (OSError, IOError):
+                pass
+        if input is not None:
+            stdin = subprocess.PIPE
+        meter = feed = None
+        if stderr == subprocess.PIPE and name in ("wget", "git clone", "git fetch"):
+            meter = progress.meter()
+            feed = meter.feed_wget if name == "wget" else meter.feed_git
+        child = subprocess.Popen(args, cwd=cwd, stdout=stdout, stderr=stderr, stdin=stdin)
+        if input is None and (timeout or stall_timeout or feed):
+            out, err, reason = _watch(child, stdout, timeout, stall_timeout, feed)
+            if reason:
+                metrics.inc("source_fetch_timeouts_total", program=name)
+                span["killed"] = reason
+                if err is not None:
+                    err += ("\n%s: %s\n" % (" ".join(args), reason)).encode()
+        else:
+            out, err = child.communicate(input)
+        span["exit_code"] = child.returncode
+        if meter:
+            meter.open = False
+            span["bytes"] = meter.bytes
+        elif out is not None:
+            span["bytes"] = len(out)
+        elif offset is not None:
+            try:
+                stdout.flush()
+                span["bytes"] = os.fstat(stdout.fileno()).st_size - offset
+            except (OSError, IOError, ValueError):
+                pass
+    return subprocess.CompletedProcess(args, child.returncode, out, err)
+
+
+@contextlib.contextmanager
+def stream_process(args, cwd=None, stdin=None, env=None):
+    """
+    Run ARGS, yielding the child for its stdout pipe to be read.
+
+    Like run_process the child is traced and counted.  Its stderr is
+    kept aside and, once the with block is left and the child has
+    exited, is in the child's stderr_text attribute.  Output the
+    block did not consume is drained so the child is not killed by
+    SIGPIPE; should the block raise, the child is killed instead.
+    """
+    name = _command_name(args)
+    metrics.inc("source_fetch_subprocesses_total", program=name)
+    with tracer.span(name, "process", command=" ".join(args)) as span:
+        with tempfile.TemporaryFile() as err:
+            child = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=err, stdin=stdin, env=env)
+            try:
+                yield child
+                while child.stdout.read(1 << 16):
+                    pass
+            except BaseException:
+                child.kill()
+                raise
+            finally:
+                child.stdout.close()
+                child.wait()
+                err.seek(0)
+                child.stderr_text = err.read().decode(errors="replace")
+                span["exit_code"] = child.returncode
+
+
 def wget(url, path):
+    # A partial download left by an earlier attempt is resumed.
     tmp = path + ".t"
-    rm(tmp, force=True)
-    shell(["wget", "-O", tmp, url])
+    args = ["wget", "-c", "--tries=1"]
+    if network_policy.stall_timeout:
+        args.append("--read-timeout=%d" % network_policy.stall_timeout)
+    args = args + ["-O", tmp, url]
+
+    def attempt():
+        if not progress.enabled and not tracer.enabled:
+            return shell(args, timeout=network_policy.timeout)
+        # Captured for --progress and --trace, rather than mixed into the terminal.
+        child = run_process(args[:1] + ["--progress=dot"] + args[1:], stdout=None, timeout=network_policy.timeout)
+        if child.returncode != 0:
+            output = child.stderr.decode(errors="replace").rstrip()
+            logging.getLogger(__name__).warning("wget %s failed:\n%s" % (url, output))
+            raise ShellException(child.returncode)
+
+    network_policy.run(attempt, "wget %s" % url, is_transient_error)
     mv(tmp, path)
 
 
 def fetch_raw(url, path, netrcfile=None):
-    wget(url, path)
+    check_online(url)
+    with tracer.span("download", "stage", url=url) as span:
+        wget(url, path)
+        span["bytes"] = os.path.getsize(path)
+    metrics.inc("source_fetch_network_bytes_total", span["bytes"], kind="download")
+
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+def path_lock(path):
+    """Return the lock serializing concurrent writers of PATH."""
+    path = os.path.abspath(path)
+    with _path_locks_lock:
+        lock = _path_locks.get(path)
+        if lock is None:
+            lock = _path_locks[path] = threading.Lock()
+        return lock
+
 
 def fetch_url(url, path, netrcfile=None):
-    if not os.path.exists(path):
-        dir_name = os.path.dirname(path)
-        if dir_name:
-            mkdir(dir_name, parents=True)
-        fetch_raw(url, path, netrcfile=netrcfile)
+    with path_lock(path):
+        if not os.path.exists(path):
+            dir_name = os.path.dirname(path)
+            if dir_name:
+                mkdir(dir_name, parents=True)
+            fetch_raw(url, path, netrcfile=netrcfile)
+
+class OfflineException(Exception):
+    """What a run needs from the network, when it is not allowed to use it."""
+
+    def __init__(self, missing):
+        self.missing = missing
+        self.value = "not available offline:\n  " + "\n  ".join(missing)
+
+    def __str__(self):
+        return self.value
+
+
+def is_remote(url):
+    """Tell whether fetching URL needs the network."""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme:
+        return parts.scheme != "file"
+    # scp-like git syntax, host:path.
+    return ":" in url.split("/", 1)[0]
+
+
+def check_online(url):
+    """Raise OfflineException if fetching URL is forbidden by --offline."""
+    if network_policy.offline and is_remote(url):
+        raise OfflineException([url])
+
+
+class FetchException(Exception):
+    def __init__(self, url, value):
+        self.url = url
+        self.value = value
+
+    def __str__(self):
+        return "%s: %s" % (self.url, self.value)
+
+
+class SpaceException(Exception):
+    """A checkout that would not fit on the disk, found before starting it."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return self.value
+
+
+class HttpPool(object):
+    """
+    Keep-alive HTTP(S) connections for fetching small files.
+
+    Connections are checked out by one thread at a time and returned
+    to the pool when the response has been read, so concurrent fetches
+    from the same host reuse a handful of connections rather than
+    paying for a new connection, and a new process, per file.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        # The socket timeout catches stalls, no data for that long.
+        timeout = network_policy.stall_timeout
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=timeout), False
+        return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+    def _release(self, scheme, netloc, conn):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def get(self, url):
+        """Return the body of URL, retrying transient failures."""
+        return network_policy.run(lambda: self._get(url), "GET %s" % url, is_transient_error)
+
+    def _read(self, response, url):
+        deadline = None
+        if network_policy.timeout:
+            deadline = time.time() + network_policy.timeout
+        chunks = []
+        meter = progress.meter()
+        try:
+            for chunk in iter(lambda: response.read(65536), b""):
+                chunks.append(chunk)
+                meter.add(len(chunk))
+                if response.length is not None:
+                    meter.fraction = meter.bytes / float(meter.bytes + response.length)
+                if deadline and time.time() > deadline:
+                    raise FetchException(url, "timed out after %ds" % network_policy.timeout)
+        finally:
+            meter.open = False
+        return b"".join(chunks)
+
+    def _get(self, url, redirects=5):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        while True:
+            conn, reused = self._acquire(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers={"User-Agent": "source-fetch"})
+                response = conn.getresponse()
+                data = self._read(response, url)
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if reused:
+                    # The server dropped an idle connection; retry on a fresh one.
+                    continue
+                raise FetchException(url, str(e))
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(parts.scheme, parts.netloc, conn)
+            break
+        if response.status in (301, 302, 303, 307, 308) and redirects:
+            location = urllib.parse.urljoin(url, response.getheader("Location", ""))
+            return self._get(location, redirects - 1)
+        if response.status != 200:
+            raise FetchException(url, "HTTP %d %s" % (response.status, response.reason))
+        return data
+
+
+http_pool = HttpPool()
+
+
+def url_get(url):
+    """Return the contents of URL, using the connection pool for HTTP(S)."""
+    check_online(url)
+    with tracer.span("download", "stage", url=url) as span:
+        if urllib.parse.urlsplit(url).scheme in ("http", "https"):
+            data = http_pool.get(url)
+        else:
+            with TemporaryDirectory() as tmpdir:
+                tmp = os.path.join(tmpdir, "data")
+                wget(url, tmp)
+                with open(tmp, "rb") as fd:
+                    data = fd.read()
+        span["bytes"] = len(data)
+    metrics.inc("source_fetch_network_bytes_total", len(data), kind="download")
+    return data
+
+
+_prefetch_executor = None
+_prefetch_lock = threading.Lock()
+PREFETCH_JOBS = 8
+
+
+def prefetch(fn, *args):
+    """Run FN(*ARGS) on the shared prefetch threads, returning a Future."""
+    global _prefetch_executor
+    with _prefetch_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=PREFETCH_JOBS, thread_name_prefix="prefetch"
+            )
+    component = tracer.current_component()
+
+    def run():
+        with tracer.component(component):
+            return fn(*args)
+
+    return _prefetch_executor.submit(run)
+
 
 class ShellException(Exception):
     def __init__(self, value):
@@ -97,28 +1023,92 @@ def rm(path, recursive=False, force=False):
         return
     if os.path.isdir(path) and not os.path.islink(path):
         if recursive:
-            for f in ls(path):
-                rm(os.path.join(path, f), recursive=True, force=force)
-        os.rmdir(path)
+            shutil.rmtree(path)
+        else:
+            os.rmdir(path)
     else:
         os.remove(path)
 
 
+TRASH_DIR = ".source-fetch-trash"
+TRASH_JOBS = 2
+_trash_executor = None
+_trash_lock = threading.Lock()
+_trash_pending = []
+_trash_seen = set()
+
+
+def _trash_submit(holder, trash):
+    def run():
+        with tracer.span("discard", "stage", path=holder):
+            rm(holder, recursive=True, force=True)
+        with _trash_lock:
+            try:
+                # Whoever empties the trash removes it.
+                os.rmdir(trash)
+            except OSError:
+                pass
+
+    global _trash_executor
+    with _trash_lock:
+        if _trash_executor is None:
+            _trash_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=TRASH_JOBS, thread_name_prefix="trash"
+            )
+        _trash_pending.append(_trash_executor.submit(run))
+
+
+def discard(path):
+    """
+    Remove the file or tree PATH in the background.
+
+    PATH is renamed into a trash directory beside it, which frees the
+    name at once, and deleted by the trash threads while the caller
+    carries on; wait_discarded waits for them.  Should the rename
+    fail PATH is removed before returning, as rm would.
+    """
+    if not os.path.lexists(path):
+        return
+    trash = os.path.join(os.path.dirname(os.path.abspath(path)), TRASH_DIR)
+    try:
+        with _trash_lock:
+            # Held so the trash is not removed from under the rename.
+            os.makedirs(trash, exist_ok=True)
+            stale = [] if trash in _trash_seen else os.listdir(trash)
+            _trash_seen.add(trash)
+            holder = tempfile.mkdtemp(dir=trash)
+            os.rename(path, os.path.join(holder, os.path.basename(path)))
+    except OSError:
+        rm(path, recursive=True, force=True)
+        return
+    # Anything else in the trash was left by a run killed before emptying it.
+    for name in stale:
+        _trash_submit(os.path.join(trash, name), trash)
+    metrics.inc("source_fetch_discarded_total")
+    _trash_submit(holder, trash)
+
+
+def wait_discarded():
+    """Wait for the trees given to discard to be deleted."""
+    while _trash_pending:
+        with _trash_lock:
+            pending = _trash_pending[:]
+            del _trash_pending[:]
+        concurrent.futures.wait(pending)
+
+
 def rmdir(path):
     os.rmdir(path)
 
 
-def shell(args, stdout_fd=None, stdout=None, cwd=None):
+def shell(args, stdout_fd=None, stdout=None, cwd=None, timeout=None):
     if stdout_fd:
-        inferior = subprocess.Popen(args=args, stdout=stdout_fd, cwd=cwd)
-        return_code = inferior.wait()
+        return_code = run_process(args, stdout=stdout_fd, stderr=None, cwd=cwd, timeout=timeout).returncode
     elif stdout:
         with open(stdout, "w") as stdout_fd:
-            inferior = subprocess.Popen(args=args, stdout=stdout_fd, cwd=cwd)
-            return_code = inferior.wait()
+            return_code = run_process(args, stdout=stdout_fd, stderr=None, cwd=cwd, timeout=timeout).returncode
     else:
-        inferior = subprocess.Popen(args=args, cwd=cwd)
-        return_code = inferior.wait()
+        return_code = run_process(args, stdout=None, stderr=None, cwd=cwd, timeout=timeout).returncode
     if return_code != 0:
         raise ShellException(return_code)
 
@@ -133,9 +1123,27 @@ def readfile(path):
         contents = fd.read()
     return contents
 
+
+def write_file(path, data):
+    """Write the bytes DATA to PATH, atomically."""
+    mkdir(os.path.dirname(path), parents=True)
+    tmp = path + ".t"
+    with open(tmp, "wb") as fd:
+        fd.write(data)
+    os.replace(tmp, path)
+
+
 def patch(dir_name, patchfile):
     shell(["patch", "-d", dir_name, "-i", patchfile])
 
+
+def patch_all(dir_name, patches):
+    """Apply the list of patch contents PATCHES, in order, with one patch(1)."""
+    data = b"".join(p if p.endswith(b"\n") else p + b"\n" for p in patches)
+    return_code = run_process(["patch", "-d", dir_name], stdout=None, stderr=None, input=data).returncode
+    if return_code != 0:
+        raise ShellException(return_code)
+
 def probe_tar_strip_arg():
     try:
         shell(
@@ -149,8 +1157,51 @@ def probe_tar_strip_arg():
     return tar_strip_arg
 
 
+def _tar_extract_paced(tarball, strip, directory):
+    """
+    Extract TARBALL as tar_extract does, a member at a time within the
+    --io-limit budget.
+
+    Every member, and the target of every link, must stay below
+    DIRECTORY once stripped, otherwise FetchException is raised.
+    """
+
+    def stripped(name):
+        return "/".join(name.split("/")[strip:])
+
+    def below(name):
+        return not os.path.isabs(name) and ".." not in name.split("/")
+
+    with tarfile.open(tarball, "r|*") as tar:
+        # Where tarfile has filters it checks the same again; tar_filter,
+        # unlike data_filter, leaves executable bits as tar(1) does.
+        tar.extraction_filter = getattr(tarfile, "tar_filter", None)
+        for member in tar:
+            member.name = stripped(member.name)
+            if not member.name:
+                continue
+            if member.islnk():
+                member.linkname = stripped(member.linkname)
+            link = None
+            if member.islnk():
+                link = member.linkname
+            elif member.issym():
+                link = os.path.normpath(os.path.join(os.path.dirname(member.name), member.linkname))
+            if not below(member.name) or (link is not None and not below(link)):
+                raise FetchException(
+                    tarball, "refusing member %s, it is not a path below %s" % (member.name, directory or ".")
+                )
+            try:
+                tar.extract(member, directory or ".")
+            except tarfile.TarError as e:
+                raise FetchException(tarball, str(e))
+            io_budget.spend(member.size)
+
+
 def tar_extract(tarball, strip=0, directory=None):
     """Extract the specified tarball."""
+    if io_budget.rate:
+        return _tar_extract_paced(tarball, strip, directory)
     args = ["tar", "x"]
     if directory:
         args = args + ["-C", directory]
@@ -174,112 +1225,878 @@ def verbose_write(msg):
     sys.stdout.write(msg)
 
 
-def tarball_acquire_explode_patch(url, srcpath, downloaddir, seriesurl=None, verbose=False):
-    bundle = os.path.basename(url)
+def tarball_download(url, downloaddir, verbose=False, mirrors=None):
+    """
+    Return the path of the tarball at URL in DOWNLOADDIR, fetching it if needed.
 
-    if os.path.isdir(srcpath):
-        if verbose:
-            verbose_write("Found %s\n" % srcpath)
+    The tarball is fetched from the fastest of MIRRORS, the site wide
+    rewrites of URL and URL, failing over to the others.
+    """
+    bundle = os.path.basename(url)
+    bundlepath = os.path.join(downloaddir, bundle)
+    if os.path.isfile(bundlepath):
+        metrics.cache("download", True, os.path.getsize(bundlepath))
+    elif network_policy.offline:
+        raise OfflineException([bundlepath])
     else:
-        bundlepath = os.path.join(downloaddir, bundle)
-        if not os.path.isfile(bundlepath):
-            if verbose:
-                verbose_write("Fetching %s\n" % url)
-            fetch_url(url, bundlepath)
+        metrics.cache("download", False)
+        if verbose:
+            verbose_write("Fetching %s\n" % url)
+        with path_lock(bundlepath):
+            fetched = os.path.isfile(bundlepath) or remote_cache.fetch_file("downloads/" + bundle, bundlepath)
+        if not fetched:
+            try_urls(rank_urls(candidate_urls(url, mirrors)), lambda u: fetch_url(u, bundlepath))
+    return bundlepath
 
-        packagedir = srcpath + ".tmp"
 
-        rm(srcpath, recursive=True, force=True)
-        rm(packagedir, recursive=True, force=True)
+def tarball_verify(path):
+    """
+    Read the tarball at PATH through to check that it is intact.
 
-        mkdir(packagedir, parents=True)
+    A damaged tarball is removed, so the next run fetches it again,
+    and FetchException raised.
+    """
+    try:
+        with tracer.span("verify", "stage", path=path):
+            with tarfile.open(path, "r|*") as tar:
+                # Stepping over each member reads, and so decompresses, it.
+                for _ in tar:
+                    pass
+    except Exception as e:
+        remove_force(path)
+        raise FetchException(path, "damaged tarball: %s" % e)
 
-        if verbose:
-            verbose_write("Expanding %s\n" % url)
-        tar_extract(bundlepath, directory=packagedir, strip=1)
-        if seriesurl:
-            baseurl = os.path.dirname(seriesurl)
-
-            if not os.path.exists(os.path.join(packagedir, "=series")):
-                if verbose:
-                    verbose_write("Fetching series file\n")
-                fetch_url(seriesurl, os.path.join(packagedir, "=series"))
-                contents = readfile(os.path.join(packagedir, "=series"))
-                print(contents)
-                for line in contents.splitlines():
-                    line = line.strip()
-                    if line != "":
-                        patchline = line
-                        if verbose:
-                            verbose_write("Fetching patch %s\n" % patchline)
-                        tmpdir = tempfile.mkdtemp(prefix="bld")
-                        try:
-                            tmp = os.path.join(tmpdir, "patch.diff")
-                            fetch_url(os.path.join(baseurl, patchline), tmp)
-                            if verbose:
-                                verbose_write("Applying patch %s\n" % patchline)
-                            patch(packagedir, tmp)
-                        finally:
-                            rm(tmpdir, force=True, recursive=True)
-        mv(packagedir, srcpath)
 
+def tarball_acquire(url, downloaddir, seriesurl=None, verbose=False, mirrors=None, cache_path=None):
+    """
+    Download the tarball at URL and, given SERIESURL, its series.
 
-def archive(url, srcpath, downloaddir, seriesurl=None, verbose=False):
-    bundle = os.path.basename(url)
+    The series patches are fetched in the background, starting before
+    the tarball, and are only waited for when they are applied.
+    Returns the path of the tarball and the Series or None.
+    """
+    series = None
+    if seriesurl:
+        series = Series.fetch(seriesurl, verbose=verbose, cache_path=cache_path)
+    bundlepath = tarball_download(url, downloaddir, verbose=verbose, mirrors=mirrors)
+    return bundlepath, series
 
-    bundlepath = os.path.join(downloaddir, bundle)
-    if not os.path.isfile(bundlepath):
-        if verbose:
-            verbose_write("Fetching %s\n" % url)
-    fetch_url(url, bundlepath + ".t")
 
-    if seriesurl:
-        if verbose:
-            verbose_write("Fetching series file\n")
-        fetch_url(seriesurl, bundle + ".series")
-        patches = parse_series_file(bundle + ".series")
+def tarball_explode(url, bundlepath, srcpath, verbose=False):
+    """Expand BUNDLEPATH next to SRCPATH, returning the directory used."""
+    packagedir = srcpath + ".tmp"
 
-        if patches != []:
-            rm(packagedir, recursive=True, force=True)
-            tmpdir = tempfile.mkdtemp(prefix="bld")
-            try:
-                packagedir = os.path.join(tmpdir, bundle)
-                mkdir(packagedir)
-                tar_extract(bundlepath, directory=packagedir, strip=1)
-                for patch in patches:
-                    if verbose:
-                        verbose_write("Fetching patch %s\n" % patch)
-                        tmp = os.path.join(tmpdir, "patch.diff")
-                        fetch_url(os.path.join(baseurl, patch), tmp)
-                        if verbose:
-                            verbose_write("Applying patch %s\n" % patch)
-                        patch(packagedir, tmp)
-                tar(bundlepath, bundle, tmpdir)
-            finally:
-                rm(tmpdir, force=True, recursive=True)
-            return
-    mv(bundlepath + ".t", bundlepath)
+    discard(srcpath)
+    discard(packagedir)
 
-def parse_series_file(fname):
-    contents = readfile(bundle + ".series")
-    contents.splitlines()
-    patches = []
-    for line in contents.splitlines():
-        line = line.strip()
-        if line != "":
-            patches.append(line)
-    return patches
+    mkdir(packagedir, parents=True)
 
+    if verbose:
+        verbose_write("Expanding %s\n" % url)
+    tar_extract(bundlepath, directory=packagedir, strip=1)
+    return packagedir
 
-class GitException(Exception):
-    def __init__(self, uri, value):
-        self.uri = uri
-        self.value = value
+
+def tarball_patch(packagedir, srcpath, series, verbose=False):
+    """Apply SERIES, as returned by tarball_acquire, and move into SRCPATH."""
+    if series and not os.path.exists(os.path.join(packagedir, "=series")):
+        with open(os.path.join(packagedir, "=series"), "w") as fd:
+            fd.write(series.text)
+        series.apply(packagedir, verbose=verbose)
+    mv(packagedir, srcpath)
+
+
+def tarball_acquire_explode_patch(url, srcpath, downloaddir, seriesurl=None, verbose=False):
+    if os.path.isdir(srcpath):
+        if verbose:
+            verbose_write("Found %s\n" % srcpath)
+        return
+
+    bundlepath, series = tarball_acquire(url, downloaddir, seriesurl, verbose=verbose)
+    packagedir = tarball_explode(url, bundlepath, srcpath, verbose=verbose)
+    tarball_patch(packagedir, srcpath, series, verbose=verbose)
+
+
+def download_dir(cache_path):
+    """Return the directory that holds downloaded upstream files."""
+    if cache_path:
+        return os.path.join(cache_path, "downloads")
+    return "."
+
+
+def file_digest(path):
+    """Return the sha256 hex digest of the file at PATH."""
+    h = hashlib.sha256()
+    with tracer.span("digest", "stage", path=path, bytes=os.path.getsize(path)):
+        with open(path, "rb") as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+# From linux/fs.h, _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """Clone SRC to DST sharing the data blocks, or raise OSError."""
+    if fcntl is None:
+        raise OSError("reflink not supported on this platform")
+    with open(src, "rb") as fd_in:
+        with open(dst, "wb") as fd_out:
+            try:
+                fcntl.ioctl(fd_out.fileno(), FICLONE, fd_in.fileno())
+            except (OSError, IOError):
+                fd_out.close()
+                remove_force(dst)
+                raise
+
+
+def link_or_copy(src, dst):
+    """
+    Materialize SRC at DST as cheaply as possible.
+
+    A reflink is preferred since it leaves DST independent of SRC,
+    then a hard link, and only when neither is possible is the file
+    data copied.
+    """
+    tmp = dst + ".t"
+    rm(tmp, force=True)
+    with tracer.span("link", "stage", path=dst) as span:
+        try:
+            reflink(src, tmp)
+            span["method"] = "reflink"
+        except OSError:
+            try:
+                os.link(src, tmp)
+                span["method"] = "hardlink"
+            except OSError:
+                shutil.copyfile(src, tmp)
+                span["method"] = "copy"
+                span["bytes"] = os.path.getsize(tmp)
+    os.replace(tmp, dst)
+
+
+def link_tree(src, dst):
+    """
+    Materialize the directory tree SRC at DST as cheaply as possible.
+
+    Each file is reflinked, hard linked or, failing both, copied, as
+    link_or_copy does; the first method that works is kept for the
+    rest of the tree.  Symbolic links are recreated.
+    """
+    tmp = dst + ".t"
+    rm(tmp, force=True, recursive=True)
+
+    def reflink_stat(s, d):
+        reflink(s, d)
+        shutil.copystat(s, d)
+
+    methods = [("reflink", reflink_stat), ("hardlink", os.link), ("copy", shutil.copy2)]
+    with tracer.span("link-tree", "stage", path=dst) as span:
+        files = 0
+        for root, dirs, names in os.walk(src):
+            target = os.path.normpath(os.path.join(tmp, os.path.relpath(root, src)))
+            os.mkdir(target)
+            shutil.copymode(root, target)
+            for name in dirs + names:
+                s = os.path.join(root, name)
+                d = os.path.join(target, name)
+                if os.path.islink(s):
+                    os.symlink(os.readlink(s), d)
+                elif name in names:
+                    while True:
+                        try:
+                            methods[0][1](s, d)
+                            break
+                        except OSError:
+                            if len(methods) == 1:
+                                raise
+                            methods.pop(0)
+                    if methods[0][0] == "copy":
+                        io_budget.spend(os.path.getsize(d))
+                    files += 1
+        span["files"] = files
+        span["method"] = methods[0][0]
+    mv(tmp, dst)
+
+
+MANIFEST_FILE = "=manifest"
+
+# Files changed this close to a manifest being started may have kept
+# the time they had when hashed, so they are always hashed again.
+MANIFEST_RACY_NS = 1000000000
+
+
+def _tree_entries(path):
+    """Return the lstat of each file and symbolic link below PATH, by relative path, but the manifest."""
+    entries = {}
+    for root, dirs, files in os.walk(path):
+        rel = os.path.relpath(root, path)
+        for name in dirs + files:
+            st = os.lstat(os.path.join(root, name))
+            if not stat.S_ISDIR(st.st_mode):
+                entries[os.path.normpath(os.path.join(rel, name))] = st
+    entries.pop(MANIFEST_FILE, None)
+    return entries
+
+
+def _entry_kind(st):
+    if stat.S_ISLNK(st.st_mode):
+        return "l"
+    return "x" if st.st_mode & 0o111 else "f"
+
+
+def _entry_digest(path, st):
+    """Return the sha256 of the file at PATH, the target if it is a link, or None if unreadable."""
+    try:
+        if stat.S_ISLNK(st.st_mode):
+            return os.readlink(path)
+        h = hashlib.sha256()
+        with open(path, "rb") as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+    except OSError:
+        return None
+
+
+def _digests(path, entries, jobs):
+    """Hash ENTRIES, a list of (relpath, lstat), below PATH on JOBS threads, in order."""
+
+    def batch(chunk):
+        return [_entry_digest(os.path.join(path, rel), st) for rel, st in chunk]
+
+    # Most source files are small, so hand them out in batches.
+    chunks = [entries[i : i + 256] for i in range(0, len(entries), 256)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count(), thread_name_prefix="hash") as pool:
+        return [d for digests in pool.map(batch, chunks) for d in digests]
+
+
+def write_manifest(path, source):
+    """
+    Record each file of the tree at PATH, by kind, size and time, in
+    its MANIFEST_FILE for verify_manifest.  SOURCE says what the tree
+    was made from.
+
+    Nothing is read here, so a checkout costs no more than a walk of
+    its tree; the sha256 of each file is filled in by the first
+    verify_manifest.
+    """
+    written = time.time_ns()
+    with tracer.span("manifest", "stage", path=path):
+        entries = _tree_entries(path)
+    files = dict((rel, [_entry_kind(st), st.st_size, st.st_mtime_ns, None]) for rel, st in entries.items())
+    manifest = {"source": source, "written": written, "files": files}
+    write_file(os.path.join(path, MANIFEST_FILE), json.dumps(manifest, sort_keys=True).encode())
+
+
+def manifest_size(path):
+    """Return the total size of the files in the MANIFEST_FILE of the tree at PATH, or None if it has none."""
+    try:
+        with open(os.path.join(path, MANIFEST_FILE)) as fd:
+            return sum(size for _, size, _, _ in json.load(fd)["files"].values())
+    except (OSError, ValueError):
+        return None
+
+
+def verify_manifest(path, source, jobs=None, full=False):
+    """
+    Return how the tree at PATH differs from its MANIFEST_FILE, as
+    "missing", "modified" and "added" followed by the relative path.
+
+    Like git's index, only files whose size or time changed are hashed
+    again, on JOBS threads, unless FULL is given.  Files not hashed
+    yet are hashed if they look as they did when checked out, and
+    their sha256 saved for the next time; if they do not they are
+    reported as modified.  A tree that was not made from SOURCE, or
+    has no manifest, is reported as such.
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_FILE)) as fd:
+            manifest = json.load(fd)
+    except (OSError, ValueError):
+        return ["no %s to verify against, check it out again" % MANIFEST_FILE]
+    if manifest["source"] != source:
+        return ["made from %s" % manifest["source"]]
+    problems = []
+    entries = _tree_entries(path)
+    check = []
+    record = []
+    with tracer.span("verify", "stage", path=path) as span:
+        for rel, (kind, size, mtime_ns, digest) in manifest["files"].items():
+            st = entries.get(rel)
+            if st is None:
+                problems.append((rel, "missing"))
+            elif _entry_kind(st) != kind or st.st_size != size:
+                problems.append((rel, "modified"))
+            elif digest is None:
+                if st.st_mtime_ns != mtime_ns:
+                    problems.append((rel, "modified"))
+                else:
+                    record.append((rel, st))
+            elif full or st.st_mtime_ns != mtime_ns or mtime_ns + MANIFEST_RACY_NS >= manifest["written"]:
+                check.append(((rel, st), digest))
+        span["hashed"] = len(check) + len(record)
+        digests = _digests(path, [e for e, _ in check] + record, jobs)
+    problems.extend((e[0], "modified") for (e, expected), d in zip(check, digests) if d != expected)
+    problems.extend((rel, "added") for rel in entries if rel not in manifest["files"])
+    if record:
+        for (rel, _), d in zip(record, digests[len(check) :]):
+            manifest["files"][rel][3] = d
+        try:
+            write_file(os.path.join(path, MANIFEST_FILE), json.dumps(manifest, sort_keys=True).encode())
+        except OSError:
+            # A read only tree is hashed afresh each time instead.
+            pass
+    return ["%s %s" % (state, rel) for rel, state in sorted(problems)]
+
+
+def parse_series(contents):
+    patches = []
+    for line in contents.splitlines():
+        line = line.strip()
+        if line != "":
+            patches.append(line)
+    return patches
+
+
+def parse_series_file(fname):
+    return parse_series(readfile(fname))
+
+
+class Series(object):
+    """
+    A series file and the patches it names.
+
+    The patches are fetched concurrently as soon as the series file
+    has been read; each is a Future of its contents.
+    """
+
+    def __init__(self, url, text, patches):
+        self.url = url
+        self.text = text
+        self.patches = patches
+
+    @staticmethod
+    def cache_dir(seriesurl, cache_path):
+        """Return where the series at SERIESURL is kept in CACHE_PATH."""
+        key = hashlib.sha256(seriesurl.encode()).hexdigest()[:16]
+        return os.path.join(download_dir(cache_path), "series", key)
+
+    @staticmethod
+    def parse(seriesurl, text):
+        """
+        Return the patch names listed in TEXT, the series at SERIESURL.
+
+        Names are paths below the series, in the cache as upstream, so
+        an absolute one or one going up with .. is refused.
+        """
+        names = parse_series(text)
+        for name in names:
+            parts = name.split("/")
+            if name.startswith("/") or ".." in parts or name == "series":
+                raise FetchException(seriesurl, "refusing patch %s, it is not a path below the series" % name)
+        return names
+
+    @staticmethod
+    def _get(url, path):
+        data = url_get(url)
+        if path:
+            write_file(path, data)
+        return data
+
+    @staticmethod
+    def fetch(seriesurl, verbose=False, cache_path=None):
+        """
+        Fetch the series at SERIESURL, keeping a copy in CACHE_PATH.
+
+        The series may change upstream so it is always fetched, unless
+        running --offline, when the copy is used instead.
+        """
+        if network_policy.offline:
+            return Series.load(seriesurl, cache_path)
+        cache = Series.cache_dir(seriesurl, cache_path) if cache_path else None
+        if verbose:
+            verbose_write("Fetching series file\n")
+        data = url_get(seriesurl)
+        text = data.decode()
+        names = Series.parse(seriesurl, text)
+        if cache:
+            write_file(os.path.join(cache, "series"), data)
+        baseurl = os.path.dirname(seriesurl)
+        patches = []
+        for patchline in names:
+            if verbose:
+                verbose_write("Fetching patch %s\n" % patchline)
+            path = os.path.join(cache, patchline) if cache else None
+            patches.append((patchline, prefetch(Series._get, os.path.join(baseurl, patchline), path)))
+        return Series(seriesurl, text, patches)
+
+    @staticmethod
+    def missing(seriesurl, cache_path):
+        """Return the files of the series at SERIESURL not in CACHE_PATH."""
+        cache = Series.cache_dir(seriesurl, cache_path) if cache_path else None
+        if not cache or not os.path.isfile(os.path.join(cache, "series")):
+            return [seriesurl]
+        with open(os.path.join(cache, "series"), "r") as fd:
+            names = Series.parse(seriesurl, fd.read())
+        baseurl = os.path.dirname(seriesurl)
+        return [os.path.join(baseurl, n) for n in names if not os.path.isfile(os.path.join(cache, n))]
+
+    @staticmethod
+    def load(seriesurl, cache_path):
+        """Return the series at SERIESURL as kept in CACHE_PATH."""
+        missing = Series.missing(seriesurl, cache_path)
+        if missing:
+            raise OfflineException(missing)
+        cache = Series.cache_dir(seriesurl, cache_path)
+        with open(os.path.join(cache, "series"), "r") as fd:
+            text = fd.read()
+        patches = []
+        for patchline in Series.parse(seriesurl, text):
+            future = concurrent.futures.Future()
+            with open(os.path.join(cache, patchline), "rb") as fd:
+                future.set_result(fd.read())
+            patches.append((patchline, future))
+        return Series(seriesurl, text, patches)
+
+    def names(self):
+        return [name for name, _ in self.patches]
+
+    def contents(self):
+        """Return the contents of each patch, waiting for them to arrive."""
+        return [future.result() for _, future in self.patches]
+
+    def digest(self):
+        """Return a digest covering the series file and every patch."""
+        h = hashlib.sha256()
+        h.update(hashlib.sha256(self.text.encode()).hexdigest().encode())
+        for data in self.contents():
+            h.update(hashlib.sha256(data).hexdigest().encode())
+        return h.hexdigest()
+
+    def apply(self, dir_name, verbose=False):
+        contents = self.contents()
+        if not contents:
+            return
+        if verbose:
+            verbose_write("Applying patches %s\n" % " ".join(self.names()))
+        with tracer.span("apply-series", "stage", patches=len(contents)):
+            patch_all(dir_name, contents)
+
+
+_patch_header_re = re.compile(r"^(?:---|\+\+\+|\*\*\*) ([^\t\n]+)")
+
+
+def patch_targets(data):
+    """
+    Return the set of files the patch contents DATA touches.
+
+    The series patches are applied with patch(1) without a -p option
+    so each file is resolved by its base name in the top directory of
+    the unpacked tarball; the names returned are relative to that
+    directory.
+    """
+    targets = set()
+    for line in data.decode(errors="replace").splitlines():
+        m = _patch_header_re.match(line)
+        if not m:
+            continue
+        name = m.group(1).strip()
+        if name == "/dev/null":
+            continue
+        targets.add(os.path.basename(name))
+    return targets
+
+
+def tar_compression(path):
+    """Return the tarfile compression suffix matching PATH's extension."""
+    for ext, comp in [(".gz", "gz"), (".tgz", "gz"), (".bz2", "bz2"), (".tbz2", "bz2"), (".xz", "xz"), (".txz", "xz")]:
+        if path.endswith(ext):
+            return comp
+    return ""
+
+
+def _strip_member(name):
+    if name.startswith("./"):
+        name = name[2:]
+    prefix, _, rel = name.partition("/")
+    return prefix, rel
+
+
+def tar_repack_patched(bundlepath, dst, series, verbose=False):
+    """
+    Re-pack BUNDLEPATH into DST, compressed as BUNDLEPATH is, with the
+    SERIES applied.
+
+    The upstream tarball is read as a single stream.  Members not
+    touched by any patch are copied straight through to DST; the few
+    that are touched are set aside, patched, and appended at the end.
+    """
+    targets = set()
+    for data in series.contents():
+        targets |= patch_targets(data)
+
+    tmp = dst + ".t"
+    rm(tmp, force=True)
+    with tracer.span("repack", "stage", path=dst), TemporaryDirectory() as workdir:
+        deferred = {}
+        top = None
+        try:
+            with tarfile.open(bundlepath, "r|*") as src:
+                with tarfile.open(tmp, "w:" + tar_compression(bundlepath), format=tarfile.PAX_FORMAT) as out:
+                    for member in src:
+                        prefix, rel = _strip_member(member.name)
+                        if top is None:
+                            top = prefix
+                        if member.isfile() and rel in targets:
+                            with open(os.path.join(workdir, rel), "wb") as fd:
+                                shutil.copyfileobj(src.extractfile(member), fd)
+                            deferred[rel] = member
+                        elif member.isfile():
+                            out.addfile(member, src.extractfile(member))
+                        else:
+                            out.addfile(member)
+
+                    series.apply(workdir, verbose=verbose)
+
+                    for rel in sorted(targets):
+                        path = os.path.join(workdir, rel)
+                        if not os.path.isfile(path):
+                            # Deleted by the series.
+                            continue
+                        info = deferred.get(rel)
+                        if info is None:
+                            info = tarfile.TarInfo(top + "/" + rel if top else rel)
+                            info.mode = 0o644
+                            info.mtime = int(os.path.getmtime(path))
+                        info.size = os.path.getsize(path)
+                        with open(path, "rb") as fd:
+                            out.addfile(info, fd)
+        except:
+            rm(tmp, force=True)
+            raise
+    mv(tmp, dst)
+
+
+def tarball_archive(url, dst, downloaddir, seriesurl=None, cache_path=None, verbose=False, mirrors=None):
+    """
+    Place the tarball at URL, with its series applied, at DST.
+
+    Without a series the downloaded tarball is linked to DST as is.
+    With a series the patched re-pack is kept in the cache, keyed by
+    the digests of the tarball and of the series, so later archives
+    of the same inputs are links too.  Either way DST keeps the
+    compression of the upstream tarball, which tar(1) detects.
+    """
+    bundle = os.path.basename(url)
+    series = None
+    if seriesurl:
+        series = Series.fetch(seriesurl, verbose=verbose, cache_path=cache_path)
+    bundlepath = tarball_download(url, downloaddir, verbose=verbose, mirrors=mirrors)
+
+    if not series or not series.patches:
+        if os.path.abspath(bundlepath) != os.path.abspath(dst):
+            link_or_copy(bundlepath, dst)
+        return
+
+    key = file_digest(bundlepath) + "-" + series.digest()
+    if cache_path:
+        cached = os.path.join(cache_path, "archives", key, bundle)
+        hit = os.path.isfile(cached) or remote_cache.fetch_file("archives/%s/%s" % (key, bundle), cached)
+        metrics.cache("archive", hit, os.path.getsize(cached) if hit else 0)
+        if not hit:
+            mkdir(os.path.dirname(cached), parents=True)
+            tar_repack_patched(bundlepath, cached, series, verbose=verbose)
+        link_or_copy(cached, dst)
+    else:
+        tar_repack_patched(bundlepath, dst, series, verbose=verbose)
+
+
+class GitException(Exception):
+    def __init__(self, uri, value):
+        self.uri = uri
+        self.value = value
 
     def __str__(self):
         return self.uri + "\n" + self.value
 
 
+class MirrorMap(object):
+    """
+    Site wide URL rewrites, read from the [mirrors] section of --config.
+
+    Each option maps a URL prefix to a list of replacement prefixes,
+    for example:
+
+        [mirrors]
+        git://gcc.gnu.org/git/ = https://gcc-mirror.example.com/git/
+    """
+
+    def __init__(self):
+        self._rewrites = []
+
+    def load(self, path):
+        config = configparser.ConfigParser(delimiters=("=",))
+        config.optionxform = str
+        with open(path, "r") as fp:
+            config.read_file(fp)
+        if config.has_section("mirrors"):
+            for prefix in config.options("mirrors"):
+                self._rewrites.append((prefix, config.get("mirrors", prefix).replace(",", " ").split()))
+        # Longest prefix wins.
+        self._rewrites.sort(key=lambda r: -len(r[0]))
+
+    def rewrite(self, url):
+        for prefix, replacements in self._rewrites:
+            if url.startswith(prefix):
+                return [r + url[len(prefix) :] for r in replacements]
+        return []
+
+
+mirror_map = MirrorMap()
+
+
+class RemoteCache(object):
+    """
+    The cache of another host, as the serve command publishes it.
+
+    Set by --remote-cache, it is consulted before upstream.  Its
+    index.json lists the git mirrors it has, with their URLs, and the
+    sha256 of each file; files are fetched by that digest and checked
+    against it.  What is read from it lands in the local cache.
+    """
+
+    def __init__(self):
+        self.url = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def index(self):
+        """Return the index of the remote cache, empty if it cannot be read."""
+        with self._lock:
+            if self._index is None:
+                self._index = {"mirrors": {}, "files": {}}
+                try:
+                    self._index.update(json.loads(url_get(self.url + "/index.json").decode()))
+                except (FetchException, ShellException, ValueError) as e:
+                    logging.getLogger(__name__).warning("remote cache %s unusable: %s" % (self.url, e))
+            return self._index
+
+    def fetch_file(self, rel, path):
+        """Fetch REL, a path relative to the cache, to PATH, returning whether the remote cache had it."""
+        if not self.url or network_policy.offline:
+            return False
+        entry = self.index()["files"].get(rel)
+        metrics.cache("remote", entry is not None, entry["size"] if entry else 0)
+        if entry is None:
+            return False
+        tmp = path + ".remote"
+        try:
+            mkdir(os.path.dirname(os.path.abspath(path)), parents=True)
+            fetch_raw("%s/sha256/%s" % (self.url, entry["sha256"]), tmp)
+            if file_digest(tmp) != entry["sha256"]:
+                raise FetchException(self.url, "%s does not match its digest" % rel)
+        except (FetchException, ShellException) as e:
+            remove_force(tmp)
+            logging.getLogger(__name__).warning("remote cache: %s" % e)
+            return False
+        os.replace(tmp, path)
+        return True
+
+    def fill_mirror(self, url, path, version, logger):
+        """
+        Bring the mirror of URL at PATH up to date from the remote cache.
+
+        Returns whether the pinned VERSION is then in the mirror, in
+        which case upstream need not be asked at all.
+        """
+        if not self.url or network_policy.offline:
+            return False
+        if version and os.path.isdir(path) and Git(url, path).has_commit(version):
+            return True
+        # The served cache names its mirrors as this one does.
+        name = os.path.basename(path)
+        if self.index()["mirrors"].get(name) != url:
+            return False
+        remote = "%s/git/%s" % (self.url, name)
+        try:
+            if os.path.exists(path):
+                repo = Git(url, path, logger=logger)
+                repo.fetch(remote=remote, refspecs=["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"])
+            else:
+                repo = Git.clone(remote, path, mirror=True, logger=logger)
+                repo.set_url(url)
+        except GitException as e:
+            logger.warning("remote cache: %s" % e)
+            return False
+        return bool(version) and repo.has_commit(version)
+
+
+remote_cache = RemoteCache()
+
+PROBE_TIMEOUT = 10
+
+_probes = {}
+_probes_lock = threading.Lock()
+
+
+def candidate_urls(url, mirrors=None):
+    """Return the places URL may be fetched from, URL itself last."""
+    urls = []
+    for u in list(mirrors or []) + mirror_map.rewrite(url) + [url]:
+        if u not in urls:
+            urls.append(u)
+    return urls
+
+
+def probe_url(url):
+    """
+    Return the time a cheap request to URL takes, or None if it fails.
+
+    Git URLs are probed with a ref advertisement for HEAD and HTTP
+    URLs with a HEAD request.  Local paths cost nothing.
+    """
+    with _probes_lock:
+        if url in _probes:
+            return _probes[url]
+    parts = urllib.parse.urlsplit(url)
+    start = time.time()
+    latency = None
+    with tracer.span("probe", "stage", url=url) as span:
+        if parts.scheme in ("", "file"):
+            latency = 0.0 if os.path.exists(parts.path or url) else None
+        elif parts.scheme in ("http", "https") and not (url.endswith(".git") or url.endswith(".git/")):
+            cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+            conn = cls(parts.netloc, timeout=PROBE_TIMEOUT)
+            try:
+                conn.request("HEAD", parts.path or "/", headers={"User-Agent": "source-fetch"})
+                if conn.getresponse().status < 400:
+                    latency = time.time() - start
+            except (http.client.HTTPException, OSError):
+                pass
+            finally:
+                conn.close()
+        else:
+            child = run_process(["git", "ls-remote", url, "HEAD"], timeout=PROBE_TIMEOUT)
+            if child.returncode == 0:
+                latency = time.time() - start
+        span["latency"] = latency
+    with _probes_lock:
+        _probes[url] = latency
+    return latency
+
+
+def content_length(url, redirects=5):
+    """Return the size the server at URL gives for it, following redirects, or None."""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or network_policy.offline:
+        return None
+    cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    conn = cls(parts.netloc, timeout=PROBE_TIMEOUT)
+    try:
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        conn.request("HEAD", path, headers={"User-Agent": "source-fetch"})
+        response = conn.getresponse()
+        location = response.getheader("Location")
+        if response.status in (301, 302, 303, 307, 308) and location and redirects:
+            return content_length(urllib.parse.urljoin(url, location), redirects - 1)
+        length = response.getheader("Content-Length", "")
+        if response.status < 300 and length.isdigit():
+            return int(length)
+    except (http.client.HTTPException, OSError):
+        pass
+    finally:
+        conn.close()
+    return None
+
+
+def rank_urls(urls, logger=None):
+    """
+    Order URLS fastest first by probing them concurrently.
+
+    Unreachable URLs are kept, last, so that a failed probe never
+    leaves nothing to try.
+    """
+    if len(urls) < 2 or network_policy.offline:
+        return list(urls)
+    logger = logger or logging.getLogger(__name__)
+    futures = [prefetch(probe_url, u) for u in urls]
+    latencies = [f.result() for f in futures]
+    reachable = sorted((lat, i) for i, lat in enumerate(latencies) if lat is not None)
+    ranked = [urls[i] for _, i in reachable] + [u for u, lat in zip(urls, latencies) if lat is None]
+    for u, lat in zip(urls, latencies):
+        logger.debug("probe %s: %s" % (u, "unreachable" if lat is None else "%.3fs" % lat))
+    logger.info("using %s for %s" % (ranked[0], urls[-1]))
+    return ranked
+
+
+def try_urls(urls, fn, logger=None):
+    """
+    Call FN with each of URLS in turn until one succeeds.
+
+    Returns the URL used and what FN returned; if every URL fails
+    the last error is raised.
+    """
+    logger = logger or logging.getLogger(__name__)
+    for i, url in enumerate(urls):
+        try:
+            return url, fn(url)
+        except (GitException, FetchException, ShellException) as e:
+            if i + 1 == len(urls):
+                raise
+            metrics.inc("source_fetch_mirror_failovers_total")
+            logger.warning("fetch from %s failed, trying %s: %s" % (url, urls[i + 1], e))
+
+
+def run_git_network(command, url, cwd=None, stdout=subprocess.PIPE, logger=None, cleanup=None):
+    """
+    Run a git COMMAND that talks to URL under network_policy.
+
+    A failure raises GitException; transient ones are retried first.
+    When STDOUT is a file it is truncated back to where it started
+    before each retry.
+    """
+    check_online(url)
+    offset = None
+    if hasattr(stdout, "seek"):
+        offset = stdout.tell()
+
+    def attempt():
+        child = run_process(
+            command,
+            cwd=cwd,
+            stdout=stdout,
+            timeout=network_policy.timeout,
+            stall_timeout=network_policy.stall_timeout,
+        )
+        if child.returncode != 0:
+            raise GitException(url, strip_progress(child.stderr.decode(errors="replace")))
+        return child
+
+    def reset():
+        if offset is not None:
+            stdout.seek(offset)
+            stdout.truncate()
+        if cleanup:
+            cleanup()
+
+    return network_policy.run(attempt, " ".join(command[:2]), is_transient_error, logger, reset)
+
+
+def progress_args():
+    """Ask git for progress output, which stall detection, --progress and --trace watch for."""
+    if network_policy.stall_timeout or progress.enabled or tracer.enabled:
+        return ["--progress"]
+    return []
+
+
+def is_full_sha(version):
+    """Tell whether VERSION is a full commit hash, rather than a name or an abbreviation."""
+    return version is not None and re.match(r"^([0-9a-f]{40}|[0-9a-f]{64})$", version) is not None
+
+
 class GitIface(object):
     def __init__(self, url, path=None, logger=None):
         self.url = url
@@ -299,22 +2116,22 @@ class GitIface(object):
             what,
         ]
         self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, cwd=self._path, stdout=fd, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
-            raise GitException(self.url, comms[1].decode())
+        run_git_network(command, self.url, cwd=self._path, stdout=fd, logger=self._logger)
 
     def _archive_via_clone_fd(self, what, prefix, fd):
         with TemporaryDirectory() as tmp:
             dst = os.path.join(tmp, prefix)
 
-            command = ["git", "clone", "--mirror", self.url, dst]
+            command = ["git", "clone", "--mirror"] + progress_args() + [self.url, dst]
             self._logger.debug(" ".join(command))
 
-            child = subprocess.Popen(command, cwd=self._path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            comms = child.communicate()
-            if child.wait() != 0:
-                raise GitException(self.url, comms[1].decode())
+            run_git_network(
+                command,
+                self.url,
+                cwd=self._path,
+                logger=self._logger,
+                cleanup=lambda: rm(dst, force=True, recursive=True),
+            )
 
             command = [
                 "git",
@@ -326,10 +2143,9 @@ class GitIface(object):
                 what,
             ]
             self._logger.debug(" ".join(command))
-            child = subprocess.Popen(command, cwd=dst, stdout=fd, stderr=subprocess.PIPE)
-            comms = child.communicate()
-            if child.wait() != 0:
-                raise GitException(self.url, comms[1].decode())
+            child = run_process(command, cwd=dst, stdout=fd)
+            if child.returncode != 0:
+                raise GitException(self.url, child.stderr.decode())
 
     def _correct_tar_format(self, fname, fd):
         """To fix the tar format issue"""
@@ -341,27 +2157,24 @@ class GitIface(object):
 
         command = ["tar", "-xvf", filename]
         self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, cwd=src_dir, stdout=fd, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
+        child = run_process(command, cwd=src_dir, stdout=fd)
+        if child.returncode != 0:
             self._logger.error("Unable to extract tar")
-            raise Exception(comms[1].decode())
+            raise Exception(child.stderr.decode())
 
         command = ["tar", "-cvf", filename, os.path.splitext(filename)[0] + "/"]
         self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, cwd=src_dir, stdout=fd, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
+        child = run_process(command, cwd=src_dir, stdout=fd)
+        if child.returncode != 0:
             self._logger.error("Unable to create tar")
-            raise Exception(comms[1].decode())
+            raise Exception(child.stderr.decode())
 
         command = ["rm", "-rf", os.path.splitext(filename)[0]]
         self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, cwd=src_dir, stdout=fd, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
+        child = run_process(command, cwd=src_dir, stdout=fd)
+        if child.returncode != 0:
             self._logger.error("Unable to delete dir")
-            raise Exception(comms[1].decode())
+            raise Exception(child.stderr.decode())
 
     def archive_fd(self, what, prefix, fd, fname=None):
         try:
@@ -378,6 +2191,57 @@ class GitIface(object):
             rm(fname, force=True)
             raise
 
+    def export(self, what, dst):
+        """
+        Write the tree of WHAT to DST as plain files.
+
+        git archive is streamed straight into tarfile, so there is no
+        clone, no index and no .git directory.
+
+        A checkout would neither drop export-ignore files nor expand
+        export-subst placeholders, so git archive runs in a scratch git
+        directory borrowing this repository's objects, whose
+        info/attributes, which beats the tree's, turns both off.  The
+        repository itself, often a shared cache mirror, is not touched.
+        """
+        commit = self.run_git_cmd(["rev-parse", "--verify", what + "^{commit}"]).strip()
+        objects = self.run_git_cmd(["rev-parse", "--git-path", "objects"]).strip()
+        objects = os.path.abspath(os.path.join(self._path, objects))
+        tmp = dst + ".t"
+        rm(tmp, force=True, recursive=True)
+        mkdir(tmp, parents=True)
+        broken = None
+        try:
+            with TemporaryDirectory() as gitdir:
+                write_file(os.path.join(gitdir, "HEAD"), (commit + "\n").encode())
+                if len(commit) == 64:
+                    config = "[core]\n\trepositoryformatversion = 1\n[extensions]\n\tobjectformat = sha256\n"
+                    write_file(os.path.join(gitdir, "config"), config.encode())
+                mkdir(os.path.join(gitdir, "refs"), parents=True)
+                write_file(os.path.join(gitdir, "objects", "info", "alternates"), (objects + "\n").encode())
+                write_file(os.path.join(gitdir, "info", "attributes"), b"* -export-ignore -export-subst\n")
+                command = ["git", "--git-dir", gitdir, "archive", "--format=tar", commit]
+                self._logger.debug(" ".join(command))
+                with stream_process(command, cwd=self._path) as child:
+                    try:
+                        with tarfile.open(fileobj=child.stdout, mode="r|") as tar:
+                            # The stream is git's own, extract it as a checkout would.
+                            tar.extraction_filter = getattr(tarfile, "fully_trusted_filter", None)
+                            for member in tar:
+                                tar.extract(member, tmp)
+                                io_budget.spend(member.size)
+                    except tarfile.TarError as e:
+                        # Most likely git failed part way, its error says why.
+                        broken = e
+            if child.returncode != 0:
+                raise GitException(self.url, child.stderr_text)
+            if broken:
+                raise broken
+        except:
+            rm(tmp, force=True, recursive=True)
+            raise
+        mv(tmp, dst)
+
     def current_branch(self):
         # Return the name of the current branch.
         return self.run_git_cmd(["rev-parse", "--abbrev-ref", "HEAD"]).strip()
@@ -385,161 +2249,1098 @@ class GitIface(object):
     def branch(self, remote, local):
         command = ["git", "branch", "--track", local, remote]
         self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, cwd=self._path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
-            raise GitException(self.url, comms[1].decode())
+        child = run_process(command, cwd=self._path)
+        if child.returncode != 0:
+            raise GitException(self.url, child.stderr.decode())
+
+    def add_remote(self):
+        command = ["git", "-C", self._path, "remote", "add", "origin"]
+        command.append(self.url)
+        child = run_process(command)
+        if child.returncode != 0:
+            raise GitException(self.url, child.stderr.decode())
+
+    def checkout(self, version, quiet=False):
+        command = ["git", "checkout"]
+        if quiet:
+            command.append("-q")
+        command.append(version)
+        self._logger.debug(" ".join(command))
+        child = run_process(command, cwd=self._path)
+        if child.returncode != 0:
+            raise GitException(self.url, child.stderr.decode())
+
+    def fetch(self, shallow=False, remote=None, quiet=False, version=None, refspecs=None, tags=False):
+        command = ["git", "fetch"]
+        if quiet:
+            command.append("-q")
+        if tags:
+            # Every tag, replacing any of the same name already here.
+            command.extend(["--force", "--tags"])
+        command.extend(progress_args())
+        if shallow:
+            command.append("--depth=1")
+            command.append(remote or "origin")
+            command.append(version)
+        elif remote is not None:
+            command.append(remote)
+            command.extend(refspecs or [])
+        self._logger.debug(" ".join(command))
+        run_git_network(command, remote if remote and "/" in remote else self.url, cwd=self._path, logger=self._logger)
+
+    def has_commit(self, version):
+        command = ["git", "cat-file", "-e", version + "^{commit}"]
+        return run_process(command, cwd=self._path).returncode == 0
+
+    def set_url(self, url):
+        """Point origin, and this object, at URL."""
+        self.run_git_cmd(["remote", "set-url", "origin", url])
+        self.url = url
+
+    def fetch_verified(self, version=None):
+        """
+        Fetch from origin, the primary URL, after a transfer from a mirror.
+
+        This leaves every branch and tag the primary has as it has it;
+        a tag the mirror had elsewhere is moved.  When the primary is
+        unreachable a VERSION already present is good enough only if it
+        is a full commit hash, which vouches for the content; a name
+        given by a mirror is not.
+        """
+        try:
+            self.fetch(tags=True)
+        except GitException:
+            if not is_full_sha(version) or not self.has_commit(version):
+                raise
+            self._logger.warning("cannot reach %s, using %s as fetched from a mirror" % (self.url, version))
+
+    def log_for_revision(self, revision):
+        command = ["git", "log", "-n1", revision]
+        self._logger.debug(" ".join(command))
+        child = run_process(command, cwd=self._path, stderr=None)
+        if child.returncode != 0:
+            raise subprocess.CalledProcessError(child.returncode, command)
+        return child.stdout
+
+    def remote_commit(self, version):
+        """Return the commit the ref VERSION names at this URL, asking git ls-remote, or None."""
+        command = ["git", "ls-remote", self.url, version, version + "^{}"]
+        self._logger.debug(" ".join(command))
+        child = run_git_network(command, self.url, cwd=self._path, logger=self._logger)
+        refs = [line.split("\t", 1) for line in child.stdout.decode().splitlines() if "\t" in line]
+        # An annotated tag is followed by the commit it peels to.
+        peeled = [sha for sha, ref in refs if ref.endswith("^{}")]
+        if peeled:
+            return peeled[0]
+        return refs[0][0] if refs else None
+
+    def rev_parse(self, what):
+        """Return the commit WHAT names, or None."""
+        child = run_process(["git", "rev-parse", "--verify", "-q", what + "^{commit}"], cwd=self._path)
+        return child.stdout.decode().strip() if child.returncode == 0 else None
+
+    def config_get(self, key):
+        """Return the value of the git config KEY, or None when unset."""
+        child = run_process(["git", "config", "--get", key], cwd=self._path)
+        return child.stdout.decode().strip() if child.returncode == 0 else None
+
+    def record_checkout(self, version):
+        """Note VERSION, and the commit it resolved to, in the config for verify."""
+        self.run_git_cmd(["config", "source-fetch.version", version])
+        self.run_git_cmd(["config", "source-fetch.commit", self.rev_parse("HEAD")])
+
+    def status(self):
+        """
+        Return (state, path) for each path of the work tree that differs
+        from HEAD, state being "missing", "modified" or "added".
+
+        This is git status, so files are only read again when the stat
+        data in the index says they may have changed.
+        """
+        command = ["git", "status", "--porcelain", "-z"]
+        self._logger.debug(" ".join(command))
+        child = run_process(command, cwd=self._path)
+        if child.returncode != 0:
+            raise GitException(self.url, child.stderr.decode())
+        fields = child.stdout.decode(errors="surrogateescape").split("\0")
+        changes = []
+        while fields:
+            field = fields.pop(0)
+            if not field:
+                continue
+            xy, path = field[:2], field[3:]
+            if xy[0] in "RC":
+                # The path it was renamed or copied from follows.
+                fields.pop(0)
+            if xy == "??":
+                changes.append(("added", path))
+            elif "D" in xy:
+                changes.append(("missing", path))
+            else:
+                changes.append(("modified", path))
+        return changes
+
+    def missing_commits(self, revisions):
+        """Return those of REVISIONS that are not commits here, asking one git cat-file."""
+        command = ["git", "cat-file", "--batch-check"]
+        query = "".join("%s^{commit}\n" % r for r in revisions)
+        child = run_process(command, cwd=self._path, input=query.encode())
+        if child.returncode != 0:
+            raise GitException(self.url, child.stderr.decode())
+        answers = child.stdout.decode().splitlines()
+        return [r for r, a in zip(revisions, answers) if a.endswith(" missing")]
+
+    def log_range(self, old, new):
+        """
+        Return the commits in NEW but not in OLD, newest first.
+
+        Each is a dict of commit, author, email, date and subject; the
+        whole range comes from one git log.
+        """
+        command = ["git", "log", "-z", "--format=%H%x1f%an%x1f%ae%x1f%aI%x1f%s", "%s..%s" % (old, new), "--"]
+        self._logger.debug(" ".join(command))
+        child = run_process(command, cwd=self._path)
+        if child.returncode != 0:
+            raise GitException(self.url, child.stderr.decode())
+        keys = ["commit", "author", "email", "date", "subject"]
+        records = child.stdout.decode(errors="replace").split("\0")
+        return [dict(zip(keys, r.split("\x1f"))) for r in records if r]
+
+    def reset(self, hard=False, quiet=False):
+        command = ["git", "reset"]
+        if hard:
+            command.append("--hard")
+        if quiet:
+            command.append("-q")
+        self._logger.debug(" ".join(command))
+        child = run_process(command, cwd=self._path)
+        if child.returncode != 0:
+            raise GitException(self.url, child.stderr.decode())
+
+    def mv(self, path):
+        mv(self._path, path)
+        self._path = path
+
+    def get_branches(self):
+        command = ["git", "ls-remote", self.url]
+        self._logger.debug(" ".join(command))
+        child = run_git_network(command, self.url, logger=self._logger)
+        output = child.stdout.decode()
+        return [tuple(l.split()) for l in output.splitlines()]
+
+    def get_revision(self, branch):
+        def selector(xxx_todo_changeme):
+            (revision, ref) = xxx_todo_changeme
+            return ref == "refs/heads/" + branch or ref == "refs/remotes/" + branch or ref == "refs/" + branch
+
+        branches = self.get_branches()
+        branches = list(filter(selector, branches))
+        if not branches:
+            raise GitException(self.url, "url %s has no such branch %s" % (self.url, branch))
+        revision, _ = branches[0]
+        return revision
+
+    def add_branch_fetch(self):
+        command = [
+            "git",
+            "config",
+            "--add",
+            "remote.origin.fetch",
+            "+refs/remotes/*:refs/remotes/origin/remotes/*",
+        ]
+        self._logger.debug(" ".join(command))
+        child = run_process(command, cwd=self._path)
+        if child.returncode != 0:
+            raise GitException(self.url, child.stderr.decode())
+
+    def run_git_cmd(self, args):
+        cmd = ["git"] + args
+        self._logger.debug(" ".join(cmd))
+        r = run_process(cmd, cwd=self._path)
+        if r.returncode != 0:
+          raise GitException(self.url, r.stderr.decode())
+        return r.stdout.decode()
+
+    def add_arm_vendor_remote(self):
+        self.run_git_cmd(["config", "remote.vendors/ARM.url", self.url])
+        self.run_git_cmd(["config",
+          "remote.vendors/ARM.fetch",
+          "+refs/vendors/ARM/*:refs/remotes/vendors/ARM/*"])
+
+class Git(GitIface):
+    def __init__(self, url, path, branch="master", logger=None):
+        GitIface.__init__(self, url, path, logger)
+        self._branch = branch
+
+    @staticmethod
+    def clone(url, path, mirror=False, logger=None):
+        logger = logger or logging.getLogger(__name__)
+        tmp = path + ".t"
+        rm(tmp, force=True, recursive=True)
+        # -q would silence the receiving half of the progress output too.
+        command = ["git", "clone", "-n"] + (progress_args() or ["-q"])
+        if mirror:
+            command.append("--mirror")
+        command.append(url)
+        command.append(tmp)
+        logger.debug(" ".join(command))
+        run_git_network(command, url, logger=logger, cleanup=lambda: rm(tmp, force=True, recursive=True))
+        mv(tmp, path)
+        git = Git(url, path)
+        return git
+
+    @staticmethod
+    def git_init(url, path, logger=None):
+        logger = logger or logging.getLogger(__name__)
+        tmp = path + ".t"
+        rm(tmp, force=True, recursive=True)
+        command = ["git", "init"]
+        command.append(tmp)
+        logger.debug(" ".join(command))
+        child = run_process(command)
+        if child.returncode != 0:
+            raise GitException(url, child.stderr.decode())
+        mv(tmp, path)
+        git = Git(url, path)
+        return git
+
+    def get_revision(self, branch=None):
+        if branch is None:
+            branch = self._branch
+        return GitIface.get_revision(self, branch)
+
+NETWORK = "network"
+DISK = "disk"
+
+DEFAULT_NETWORK_JOBS = 4
+DEFAULT_DISK_JOBS = min(4, os.cpu_count() or 1)
+
+
+class Stage(object):
+    """
+    One step in materializing a component.
+
+    FN is called with the result of the previous stage of the same
+    component (None for the first) and its result is handed to the
+    next.  POOL says which worker pool, NETWORK or DISK, runs it.
+    """
+
+    def __init__(self, name, pool, fn):
+        self.name = name
+        self.pool = pool
+        self.fn = fn
+
+
+def run_stages(stages):
+    """Run STAGES one after the other in the calling thread."""
+    result = None
+    for stage in stages:
+        result = stage.fn(result)
+    return result
+
+
+class StageStats(object):
+    def __init__(self, component, stage, pool, queued, elapsed, start=None):
+        self.start = start
+        self.component = component
+        self.stage = stage
+        self.pool = pool
+        self.queued = queued
+        self.elapsed = elapsed
+
+
+class Pipeline(object):
+    """
+    Run the stages of many components over bounded worker pools.
+
+    Each pool has its own threads and a queue no deeper than its
+    thread count.  A component moves to the next pool by queueing its
+    next stage there, so when the disk pool falls behind the network
+    workers block rather than racing ahead.  Consecutive stages in the
+    same pool run back to back on the same worker.  Stages must only
+    move forward through POOLS, which keeps the hand-offs acyclic.
+
+    The time each stage spent waiting in a queue and running is
+    recorded in STATS, and the components whose every stage ran in
+    COMPLETED.
+    """
+
+    def __init__(self, pools, logger=None):
+        self._pools = list(pools)
+        self._order = dict((name, i) for i, (name, _) in enumerate(self._pools))
+        self._queues = dict((name, queue.Queue(maxsize=max(1, n))) for name, n in self._pools)
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._pending = 0
+        self._error = None
+        self.stats = []
+        self.completed = []
+
+    def run(self, jobs):
+        """
+        Run JOBS, a list of (component, stages), raising the first error,
+        or a KeyboardInterrupt or SystemExit raised by any stage.
+        """
+        jobs = [(c, s) for c, s in jobs if s]
+        if not jobs:
+            return
+        self._pending = len(jobs)
+        threads = []
+        for name, n in self._pools:
+            for i in range(max(1, n)):
+                t = threading.Thread(target=self._worker, args=(name,), name="%s-%d" % (name, i))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+        for component, stages in jobs:
+            self._put(component, stages, 0, None)
+        self._done.wait()
+
+        for name, n in self._pools:
+            for i in range(max(1, n)):
+                self._queues[name].put(None)
+        for t in threads:
+            t.join()
+
+        self._report()
+        if self._error is not None:
+            raise self._error
+
+    def _put(self, component, stages, index, arg):
+        self._queues[stages[index].pool].put((component, stages, index, arg, time.time()))
+
+    def _finish(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending == 0:
+                self._done.set()
+
+    def _worker(self, pool):
+        while True:
+            task = self._queues[pool].get()
+            if task is None:
+                return
+            component, stages, index, arg, queued_at = task
+            if self._error is not None:
+                self._finish()
+                continue
+            try:
+                queued = time.time() - queued_at
+                while True:
+                    stage = stages[index]
+                    progress.stage(component, stage.name)
+                    start = time.time()
+                    with tracer.component(component):
+                        with tracer.span(stage.name, "stage", pool=pool, queued=queued):
+                            arg = stage.fn(arg)
+                    self.stats.append(StageStats(component, stage.name, pool, queued, time.time() - start, start))
+                    index += 1
+                    if index == len(stages) or stages[index].pool != pool:
+                        break
+                    queued = 0.0
+            except BaseException as e:
+                # KeyboardInterrupt or SystemExit in a stage must still
+                # finish the component, or run() would wait for ever,
+                # and take the place of an ordinary error.
+                with self._lock:
+                    if self._error is None or (isinstance(self._error, Exception) and not isinstance(e, Exception)):
+                        self._error = e
+                progress.done(component)
+                self._finish()
+                continue
+            if index == len(stages):
+                self.completed.append(component)
+                progress.done(component)
+                self._finish()
+            else:
+                assert self._order[stages[index].pool] > self._order[pool]
+                self._put(component, stages, index, arg)
+
+    def _report(self):
+        spans = {}
+        for s in self.stats:
+            self._logger.debug(
+                "stage %s %s (%s): queued %.3fs, ran %.3fs", s.component, s.stage, s.pool, s.queued, s.elapsed
+            )
+            metrics.inc("source_fetch_stage_seconds_total", s.elapsed, stage=s.stage, pool=s.pool)
+            metrics.inc("source_fetch_stage_queue_seconds_total", s.queued, stage=s.stage, pool=s.pool)
+            first, last = spans.get(s.component, (s.start, s.start + s.elapsed))
+            spans[s.component] = (min(first, s.start), max(last, s.start + s.elapsed))
+        for component, (first, last) in spans.items():
+            metrics.set("source_fetch_component_seconds", last - first, component=component)
+        for name, n in self._pools:
+            queued = [s.queued for s in self.stats if s.pool == name]
+            if queued:
+                self._logger.info(
+                    "pool %s (%d workers): %d stages, queue wait mean %.3fs max %.3fs",
+                    name,
+                    n,
+                    len(queued),
+                    sum(queued) / len(queued),
+                    max(queued),
+                )
+
+
+def bundle_clone(bundle, url, path, mirror=False, logger=None):
+    """
+    Clone PATH from BUNDLE, a git bundle file or URL, with origin set to URL.
+
+    Returns the Git, which still has to be fetched from URL, or None if
+    the bundle cannot be used; cloning from URL itself is then the
+    only option left.
+    """
+    logger = logger or logging.getLogger(__name__)
+    parts = urllib.parse.urlsplit(bundle)
+    local = parts.scheme in ("", "file")
+    fname = (parts.path if parts.scheme else bundle) if local else path + ".bundle"
+    try:
+        with tracer.span("bundle", "stage", bundle=bundle):
+            if not local:
+                remove_force(fname)
+                mkdir(os.path.dirname(fname), parents=True)
+                fetch_raw(bundle, fname)
+            logger.info("seeding %s from %s" % (path, bundle))
+            repo = Git.clone(fname, path, mirror=mirror, logger=logger)
+            repo.set_url(url)
+        metrics.inc("source_fetch_bundle_seeds_total")
+        return repo
+    except (GitException, FetchException, ShellException, OSError) as e:
+        logger.warning("cannot use bundle %s: %s" % (bundle, e))
+        rm(path, force=True, recursive=True)
+        return None
+    finally:
+        if not local:
+            remove_force(fname)
+
+
+@contextlib.contextmanager
+def cache_lock(path, exclusive=True):
+    """
+    Hold the lock guarding the cache entry at PATH.
+
+    Writers, such as fetching into a mirror, maintaining or evicting
+    it, hold the lock exclusively; readers cloning from a mirror share
+    it.  The lock is an flock on PATH.lock so it is honoured by every
+    process using the cache.
+    """
+    if fcntl is None:
+        yield
+        return
+    mkdir(os.path.dirname(os.path.abspath(path)), parents=True)
+    with open(path + ".lock", "a") as fd:
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_UN)
+
+
+def mark_used(path):
+    """Mark the cache entry at PATH as used now, for eviction."""
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def update_mirror(url, path, name, logger, mirrors=None, version=None, bundle=None):
+    """
+    Clone or fetch the mirror of URL at PATH, returning its Git.
+
+    The bulk of the transfer comes from BUNDLE, when the mirror is
+    first made, or the fastest of MIRRORS and the site wide rewrites
+    of URL; then refs are brought up to date from URL itself, see
+    Git.fetch_verified for the role of VERSION.
+    """
+    with cache_lock(path):
+        repo = _update_mirror(url, path, name, logger, mirrors, version, bundle)
+        mark_used(path)
+        return repo
+
+
+def _update_mirror(url, path, name, logger, mirrors, version, bundle):
+    if network_policy.offline:
+        if not os.path.exists(path):
+            raise OfflineException([path])
+        metrics.cache("mirror", True)
+        return Git(url, path, logger=logger)
+    hit = os.path.exists(path)
+    if hit and mirror_url(path) != url:
+        raise GitException(url, "the mirror %s is of %s" % (path, mirror_url(path)))
+    before = dir_size(os.path.join(path, "objects")) if hit else 0
+    if remote_cache.fill_mirror(url, path, version, logger):
+        # The pinned version is all that is wanted, upstream is not asked.
+        metrics.cache("mirror", hit)
+        return Git(url, path, logger=logger)
+    urls = rank_urls(candidate_urls(url, mirrors), logger)
+    exists = os.path.exists(path)
+    seeded = False
+    if not exists:
+        repo = bundle_clone(bundle, url, path, mirror=True, logger=logger) if bundle else None
+        seeded = repo is not None
+    if not exists and not seeded:
+        logger.debug("git clone %s %s (mirror)" % (url, name))
+        used, repo = try_urls(urls, lambda u: Git.clone(u, path, mirror=True, logger=logger), logger)
+        if used != url:
+            repo.set_url(url)
+    elif exists:
+        repo = Git(url, path, logger=logger)
+        if urls[0] != url:
+            try:
+                repo.fetch(remote=urls[0], refspecs=["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"])
+            except GitException as e:
+                logger.warning("fetch from %s failed: %s" % (urls[0], e))
+    logger.debug("git fetch %s (mirror)" % name)
+    if seeded or urls[0] != url:
+        repo.fetch_verified(version)
+    else:
+        repo.fetch()
+    metrics.cache("mirror", hit)
+    fetched = dir_size(os.path.join(path, "objects")) - before
+    metrics.inc("source_fetch_network_bytes_total", max(0, fetched), kind="mirror")
+    return repo
+
+
+def url_digest(url):
+    """Return the part of a mirror's name that tells URL apart."""
+    return hashlib.sha256(url.encode()).hexdigest()[:12]
+
+
+def mirror_path(cache_path, name, url):
+    """
+    Return where the mirror of URL, for the component NAME, is kept in
+    CACHE_PATH.  Components that share a name but not a URL, as in the
+    spc files of two branches, each get a mirror of their own.
+
+    A mirror of URL that an older cache keeps as CACHE_PATH/NAME is
+    moved there, so that existing caches stay warm.
+    """
+    path = os.path.join(cache_path, "%s-%s" % (name, url_digest(url)))
+    if not os.path.exists(path):
+        adopt_mirror(os.path.join(cache_path, name), path, url)
+    return path
+
+
+def adopt_mirror(old, path, url=None):
+    """
+    Move the git mirror at OLD to PATH if it is of URL, or of any URL
+    when URL is None, and nothing is at PATH yet.  Returns whether it
+    was moved.
+    """
+    if not os.path.isfile(os.path.join(old, "HEAD")):
+        return False
+    with cache_lock(old):
+        with cache_lock(path):
+            if not os.path.isdir(old) or os.path.exists(path):
+                return False
+            if url is not None and mirror_url(old) != url:
+                return False
+            logging.getLogger(__name__).info("moving the mirror %s to %s" % (old, path))
+            os.rename(old, path)
+            return True
+
+
+def cache_mirrors(cache_path):
+    """Return the paths of the git mirrors in CACHE_PATH."""
+    mirrors = []
+    for name in sorted(ls(cache_path)):
+        path = os.path.join(cache_path, name)
+        if os.path.isdir(os.path.join(path, "objects")) and os.path.isfile(os.path.join(path, "HEAD")):
+            mirrors.append(path)
+    return mirrors
+
+
+def maintain_mirror(path, prune_expire="2.weeks.ago", logger=None):
+    """
+    Repack, index and prune the mirror at PATH.
+
+    Packs are rolled up geometrically, so only the small recent packs
+    fetches leave behind are rewritten, into a multi-pack-index with a
+    reachability bitmap.  The split commit-graph is extended likewise.
+    The caller holds the mirror's lock.
+    """
+    logger = logger or logging.getLogger(__name__)
+    used = os.stat(path).st_mtime
+    for command in [
+        ["git", "repack", "-d", "-q", "--geometric=2", "--write-midx", "--write-bitmap-index"],
+        ["git", "commit-graph", "write", "--reachable", "--split"],
+        ["git", "prune", "--expire=%s" % prune_expire],
+    ]:
+        logger.debug("%s (%s)" % (" ".join(command), path))
+        child = run_process(command, cwd=path)
+        if child.returncode != 0:
+            raise GitException(path, child.stderr.decode())
+    # Maintenance is not use.
+    os.utime(path, (used, used))
+
+
+def parse_size(text):
+    """Return the number of bytes in TEXT, such as 512M or 20G."""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(size) < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "TiB"
+    return "%.1f %s" % (size, unit) if unit != "B" else "%d B" % size
+
+
+SNAPSHOT_INDEX = "index.json"
+
+# What a snapshot carries besides the mirrors; archives/ is rebuilt
+# from these on demand.
+SNAPSHOT_DIRS = ["downloads", "bldroot"]
+
+
+def mirror_refs(path):
+    """Return a dict of the refs of the repository at PATH and their hashes."""
+    out = Git(None, path).run_git_cmd(["for-each-ref", "--format=%(objectname) %(refname)"])
+    return dict(reversed(line.split(" ", 1)) for line in out.splitlines())
+
+
+def mirror_url(path):
+    """Return the URL the mirror at PATH is of."""
+    return run_process(["git", "config", "remote.origin.url"], cwd=path).stdout.decode().strip()
+
+
+def snapshot_files(cache_path, tops=SNAPSHOT_DIRS):
+    """Return the paths, relative to CACHE_PATH, of the files under TOPS a snapshot carries."""
+    files = []
+    for top in tops:
+        for root, _, names in os.walk(os.path.join(cache_path, top)):
+            for n in names:
+                if not n.endswith(".t") and not n.endswith(".lock") and not n.endswith(".remote"):
+                    files.append(os.path.relpath(os.path.join(root, n), cache_path))
+    return sorted(files)
+
+
+def snapshot_index(path):
+    """Return the index of the snapshot at PATH, its first member."""
+    with tarfile.open(path, "r|") as tar:
+        member = tar.next()
+        if member is None or member.name != SNAPSHOT_INDEX:
+            raise SpcException("%s is not a cache snapshot" % path)
+        return json.loads(tar.extractfile(member).read().decode())
+
+
+def cache_export(cache_path, fd, since=None, logger=None):
+    """
+    Write a snapshot of the cache at CACHE_PATH to the file object FD.
+
+    The snapshot is a tar stream: the index, then a git bundle of each
+    mirror, then the downloaded files.  Given SINCE, the index of an
+    earlier snapshot, bundles only hold the objects that snapshot did
+    not reach and unchanged files are left out.  Returns the index.
+    """
+    logger = logger or logging.getLogger(__name__)
+    since = since or {"mirrors": {}, "files": {}}
+    index = {"version": 1, "created": time.time(), "base": since.get("created"), "mirrors": {}, "files": {}}
+    with TemporaryDirectory(dir=cache_path) as tmp:
+        bundles = []
+        for path in cache_mirrors(cache_path):
+            name = os.path.basename(path)
+            with cache_lock(path, exclusive=False):
+                refs = mirror_refs(path)
+                index["mirrors"][name] = {"url": mirror_url(path), "refs": refs}
+                old = since["mirrors"].get(name, {}).get("refs", {})
+                if refs == old or not refs:
+                    continue
+                # Only exclude what this mirror still has.
+                known = set(old.values())
+                check = run_process(
+                    ["git", "cat-file", "--batch-check=%(objectname)"], cwd=path, input="\n".join(known).encode()
+                )
+                present = [line for line in check.stdout.decode().splitlines() if not line.endswith("missing")]
+                bundle = os.path.join(tmp, name + ".bundle")
+                revs = "".join("^%s\n" % sha for sha in present)
+                child = run_process(
+                    ["git", "bundle", "create", "-q", bundle, "--all", "--stdin"], cwd=path, input=revs.encode()
+                )
+                if child.returncode != 0:
+                    if "empty bundle" in child.stderr.decode():
+                        continue
+                    raise GitException(path, child.stderr.decode())
+                bundles.append((name, bundle))
+        for rel in snapshot_files(cache_path):
+            full = os.path.join(cache_path, rel)
+            index["files"][rel] = {"size": os.path.getsize(full), "sha256": file_digest(full)}
+
+        with tarfile.open(fileobj=fd, mode="w|") as tar:
+            data = json.dumps(index, indent=1, sort_keys=True).encode()
+            info = tarfile.TarInfo(SNAPSHOT_INDEX)
+            info.size = len(data)
+            info.mtime = int(index["created"])
+            tar.addfile(info, io.BytesIO(data))
+            for name, bundle in bundles:
+                tar.add(bundle, arcname="mirrors/%s.bundle" % name)
+            for rel, entry in sorted(index["files"].items()):
+                if since["files"].get(rel, {}).get("sha256") != entry["sha256"]:
+                    tar.add(os.path.join(cache_path, rel), arcname=rel)
+    index["bundles"] = [name for name, _ in bundles]
+    return index
+
+
+def _import_bundle(cache_path, name, bundle, url, logger):
+    """
+    Merge the mirror bundle BUNDLE into the mirror NAME in CACHE_PATH.
+
+    A new mirror is cloned from the bundle.  Into an existing one the
+    objects are fetched, and refs created or fast forwarded; a local
+    ref that has moved elsewhere is kept.
+    """
+    path = os.path.join(cache_path, name)
+    with cache_lock(path):
+        if not os.path.exists(path):
+            repo = Git.clone(bundle, path, mirror=True, logger=logger)
+            if url:
+                repo.set_url(url)
+            mark_used(path)
+            return
+        repo = Git(url, path, logger=logger)
+        staging = "refs/source-fetch-import/"
+        repo.run_git_cmd(["fetch", "-q", bundle, "+refs/*:%s*" % staging])
+        local = mirror_refs(path)
+        updates = []
+        kept = 0
+        for ref, sha in sorted(local.items()):
+            if not ref.startswith(staging):
+                continue
+            target = "refs/" + ref[len(staging) :]
+            updates.append("delete %s\n" % ref)
+            current = local.get(target)
+            if current == sha:
+                continue
+            if current is None:
+                updates.append("update %s %s\n" % (target, sha))
+            elif run_process(["git", "merge-base", "--is-ancestor", current, sha], cwd=path).returncode == 0:
+                updates.append("update %s %s\n" % (target, sha))
+            else:
+                kept += 1
+        child = run_process(["git", "update-ref", "--stdin"], cwd=path, input="".join(updates).encode())
+        if child.returncode != 0:
+            raise GitException(path, child.stderr.decode())
+        if kept:
+            logger.warning("%s: kept %d local refs that have diverged from the snapshot" % (name, kept))
+
+
+def cache_import(cache_path, fd, logger=None):
+    """
+    Merge the snapshot read from the file object FD into CACHE_PATH.
+
+    Files already in the cache are kept as they are, the others must
+    match their sha256 in the snapshot's index.  Returns the index.
+    """
+    logger = logger or logging.getLogger(__name__)
+    index = None
+    with TemporaryDirectory(dir=cache_path) as tmp:
+        with tarfile.open(fileobj=fd, mode="r|") as tar:
+            for member in tar:
+                name = member.name
+                parts = name.split("/")
+                if os.path.isabs(name) or ".." in parts or "" in parts or not member.isfile():
+                    raise SpcException("unexpected member %s in cache snapshot" % name)
+                if index is None:
+                    if name != SNAPSHOT_INDEX:
+                        raise SpcException("not a cache snapshot")
+                    index = json.loads(tar.extractfile(member).read().decode())
+                    continue
+                if parts[0] == "mirrors" and len(parts) == 2 and name.endswith(".bundle"):
+                    mirror = parts[1][: -len(".bundle")]
+                    if not mirror or mirror.startswith("."):
+                        raise SpcException("unexpected member %s in cache snapshot" % name)
+                    bundle = os.path.join(tmp, parts[1])
+                    with open(bundle, "wb") as out:
+                        shutil.copyfileobj(tar.extractfile(member), out)
+                    url = index["mirrors"].get(mirror, {}).get("url")
+                    with tracer.component(mirror):
+                        with tracer.span("import", "stage"):
+                            _import_bundle(cache_path, mirror, bundle, url, logger)
+                    remove_force(bundle)
+                elif parts[0] in SNAPSHOT_DIRS:
+                    dst = os.path.join(cache_path, name)
+                    with path_lock(dst):
+                        if os.path.exists(dst):
+                            logger.debug("%s: already in the cache" % name)
+                            continue
+                        mkdir(os.path.dirname(dst), parents=True)
+                        h = hashlib.sha256()
+                        src = tar.extractfile(member)
+                        with open(dst + ".t", "wb") as out:
+                            for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                                h.update(chunk)
+                                out.write(chunk)
+                        if h.hexdigest() != index["files"].get(name, {}).get("sha256"):
+                            remove_force(dst + ".t")
+                            raise SpcException("%s in cache snapshot does not match its digest in the index" % name)
+                        os.utime(dst + ".t", (member.mtime, member.mtime))
+                        os.replace(dst + ".t", dst)
+                else:
+                    raise SpcException("unexpected member %s in cache snapshot" % name)
+    if index is None:
+        raise SpcException("not a cache snapshot")
+    return index
+
+
+class CacheServer(http.server.ThreadingHTTPServer):
+    """
+    Publish the cache at CACHE_PATH over HTTP, for --remote-cache.
+
+    /index.json lists the git mirrors with their URLs and the files
+    under downloads, bldroot and archives with their size and sha256.
+    /sha256/DIGEST is the file with that digest and /git/NAME/ the
+    mirror NAME, over git's smart HTTP as git http-backend serves it.
+    Nothing can be written.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, cache_path, logger=None):
+        http.server.ThreadingHTTPServer.__init__(self, address, CacheRequestHandler)
+        self.cache_path = cache_path
+        self.logger = logger or logging.getLogger(__name__)
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def files(self):
+        """Return the files served, only digesting those new or changed since last asked."""
+        files = {}
+        for rel in snapshot_files(self.cache_path, SNAPSHOT_DIRS + ["archives"]):
+            path = os.path.join(self.cache_path, rel)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            with self._lock:
+                known = self._digests.get(rel)
+            if known is None or known[:2] != (st.st_size, st.st_mtime):
+                known = (st.st_size, st.st_mtime, file_digest(path))
+                with self._lock:
+                    self._digests[rel] = known
+            files[rel] = {"size": known[0], "sha256": known[2]}
+        return files
+
+    def index(self):
+        mirrors = {}
+        for path in cache_mirrors(self.cache_path):
+            mirrors[os.path.basename(path)] = mirror_url(path)
+        return {"mirrors": mirrors, "files": self.files()}
+
+    def find(self, digest):
+        """Return the path of the file with the sha256 DIGEST, or None."""
+        for _ in range(2):
+            with self._lock:
+                for rel, (_, _, d) in self._digests.items():
+                    if d == digest:
+                        return os.path.join(self.cache_path, rel)
+            # Perhaps added since the index was last read.
+            self.files()
+        return None
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "source-fetch"
+
+    def log_message(self, format, *args):
+        self.server.logger.info("%s %s" % (self.address_string(), format % args))
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/index.json":
+            data = json.dumps(self.server.index(), indent=1, sort_keys=True).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif path.startswith("/sha256/"):
+            self._send_file(self.server.find(path[len("/sha256/") :]))
+        elif path.startswith("/git/"):
+            self._git()
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path.startswith("/git/"):
+            self._git()
+        else:
+            self.send_error(404)
+
+    def _send_file(self, path):
+        if path is None:
+            self.send_error(404)
+            return
+        with open(path, "rb") as fd:
+            size = os.fstat(fd.fileno()).st_size
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            shutil.copyfileobj(fd, self.wfile)
+        metrics.inc("source_fetch_served_bytes_total", size, kind="file")
+
+    def _git(self):
+        parts = urllib.parse.urlsplit(self.path)
+        name = parts.path[len("/git/") :].split("/", 1)[0]
+        mirror = os.path.join(self.server.cache_path, name)
+        if mirror not in cache_mirrors(self.server.cache_path):
+            self.send_error(404)
+            return
+        env = dict(os.environ)
+        env.update(
+            {
+                "GIT_PROJECT_ROOT": os.path.abspath(self.server.cache_path),
+                "GIT_HTTP_EXPORT_ALL": "1",
+                "PATH_INFO": parts.path[len("/git") :],
+                "QUERY_STRING": parts.query,
+                "REQUEST_METHOD": self.command,
+                "CONTENT_TYPE": self.headers.get("Content-Type", ""),
+                "CONTENT_LENGTH": self.headers.get("Content-Length", "0"),
+                "REMOTE_ADDR": self.client_address[0],
+                "HTTP_CONTENT_ENCODING": self.headers.get("Content-Encoding", ""),
+                "GIT_PROTOCOL": self.headers.get("Git-Protocol", ""),
+            }
+        )
+        with tempfile.TemporaryFile() as body:
+            remaining = int(self.headers.get("Content-Length") or 0)
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 1 << 16))
+                if not chunk:
+                    break
+                body.write(chunk)
+                remaining -= len(chunk)
+            body.seek(0)
+            with cache_lock(mirror, exclusive=False):
+                mark_used(mirror)
+                with stream_process(["git", "http-backend"], stdin=body, env=env) as child:
+                    # A CGI response: headers, Status among them, then the body.
+                    status = 200
+                    headers = []
+                    for line in iter(child.stdout.readline, b""):
+                        line = line.decode().rstrip("\r\n")
+                        if not line:
+                            break
+                        key, _, value = line.partition(":")
+                        if key.lower() == "status":
+                            status = int(value.split()[0])
+                        else:
+                            headers.append((key, value.strip()))
+                    self.send_response(status)
+                    for key, value in headers:
+                        self.send_header(key, value)
+                    self.end_headers()
+                    size = 0
+                    for chunk in iter(lambda: child.stdout.read(1 << 16), b""):
+                        self.wfile.write(chunk)
+                        size += len(chunk)
+        metrics.inc("source_fetch_served_bytes_total", size, kind="git")
+
+
+class SubversionException(Exception):
+    def __init__(self, uri, value):
+        self.uri = uri
+        self.value = value
+
+    def __str__(self):
+        return self.uri + "\n" + self.value
+
+
+def run_svn_network(command, url, logger=None, cleanup=None):
+    """
+    Run an svn COMMAND that talks to URL under network_policy.
+
+    A failure raises SubversionException; transient ones are retried
+    first, after calling CLEANUP if given.
+    """
+    check_online(url)
 
-    def add_remote(self):
-        command = ["git", "-C", self._path, "remote", "add", "origin"]
-        command.append(self.url)
-        child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
-            raise GitException(self.url, comms[1].decode())
+    def attempt():
+        child = run_process(command, timeout=network_policy.timeout, stall_timeout=network_policy.stall_timeout)
+        if child.returncode != 0:
+            raise SubversionException(url, child.stderr.decode(errors="replace"))
+        return child
 
-    def checkout(self, version, quiet=False):
-        command = ["git", "checkout"]
-        if quiet:
-            command.append("-q")
-        command.append(version)
-        self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, cwd=self._path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
-            raise GitException(self.url, comms[1].decode())
+    return network_policy.run(attempt, " ".join(command[:2]), is_transient_error, logger, cleanup)
 
-    def fetch(self, shallow=False, remote=None, quiet=False, version=None):
-        command = ["git", "fetch"]
-        if quiet:
-            command.append("-q")
-        if remote is not None:
-            command.append(remote)
-        if shallow:
-            command.append("--depth=1")
-            command.append("origin")
-            command.append(version)
-        self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, cwd=self._path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
-            raise GitException(self.url, comms[1].decode())
 
-    def log_for_revision(self, revision):
-        command = ["git", "log", "-n1", revision]
-        self._logger.debug(" ".join(command))
-        return subprocess.check_output(command, cwd=self._path)
+def file_url(path):
+    return "file://" + urllib.parse.quote(os.path.abspath(path))
 
-    def reset(self, hard=False, quiet=False):
-        command = ["git", "reset"]
-        if hard:
-            command.append("--hard")
-        if quiet:
-            command.append("-q")
-        self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, cwd=self._path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
-            raise GitException(self.url, comms[1].decode())
 
-    def mv(self, path):
-        mv(self._path, path)
-        self._path = path
+class SubversionMirror(object):
+    """
+    A local svnsync mirror, at PATH, of the repository holding URL.
 
-    def get_branches(self):
-        command = ["git", "ls-remote", self.url]
-        self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        output = comms[0].decode()
-        if child.wait() != 0:
-            raise GitException(self.url, comms[1].decode())
-        return [tuple(l.split()) for l in output.splitlines()]
+    svnsync copies revisions with their original paths, so URL is at
+    the same path below the root of the mirror as below the root of
+    its own repository; that path is recorded when the mirror is made.
+    """
 
-    def get_revision(self, branch):
-        def selector(xxx_todo_changeme):
-            (revision, ref) = xxx_todo_changeme
-            return ref == "refs/heads/" + branch or ref == "refs/remotes/" + branch or ref == "refs/" + branch
+    PATH_FILE = "source-fetch-path"
 
-        branches = self.get_branches()
-        branches = list(filter(selector, branches))
-        if not branches:
-            raise GitException(self.url, "url %s has no such branch %s" % (self.url, branch))
-        revision, _ = branches[0]
-        return revision
+    def __init__(self, url, path, logger=None):
+        self.url = url
+        self.path = path
+        self._logger = logger or logging.getLogger(__name__)
 
-    def add_branch_fetch(self):
-        command = [
-            "git",
-            "config",
-            "--add",
-            "remote.origin.fetch",
-            "+refs/remotes/*:refs/remotes/origin/remotes/*",
-        ]
+    def _run(self, command):
         self._logger.debug(" ".join(command))
-        child = subprocess.Popen(command, cwd=self._path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
-            raise GitException(self.url, comms[1].decode())
+        child = run_process(command)
+        if child.returncode != 0:
+            raise SubversionException(self.path, child.stderr.decode(errors="replace"))
+        return child.stdout.decode()
 
-    def run_git_cmd(self, args):
-        cmd = ["git"] + args
-        self._logger.debug(" ".join(cmd))
-        r = subprocess.run(cmd, cwd=self._path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if r.returncode != 0:
-          raise GitException(self.url, r.stderr.decode())
-        return r.stdout.decode()
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, self.PATH_FILE))
 
-    def add_arm_vendor_remote(self):
-        self.run_git_cmd(["config", "remote.vendors/ARM.url", self.url])
-        self.run_git_cmd(["config",
-          "remote.vendors/ARM.fetch",
-          "+refs/vendors/ARM/*:refs/remotes/vendors/ARM/*"])
+    def youngest(self):
+        return int(self._run(["svnlook", "youngest", self.path]).strip())
 
-class Git(GitIface):
-    def __init__(self, url, path, branch="master", logger=None):
-        GitIface.__init__(self, url, path, logger)
-        self._branch = branch
+    def has_revision(self, revision):
+        return self.exists() and str(revision).isdigit() and int(revision) <= self.youngest()
 
-    @staticmethod
-    def clone(url, path, mirror=False, logger=None):
-        logger = logger or logging.getLogger(__name__)
-        tmp = path + ".t"
+    def create(self):
+        tmp = self.path + ".t"
         rm(tmp, force=True, recursive=True)
-        command = ["git", "clone", "-n", "-q"]
-        if mirror:
-            command.append("--mirror")
-        command.append(url)
-        command.append(tmp)
-        logger.debug(" ".join(command))
-        child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
-            raise GitException(url, comms[1].decode())
-        mv(tmp, path)
-        git = Git(url, path)
-        return git
+        self._run(["svnadmin", "create", tmp])
+        # svnsync records its state in revision properties.
+        hook = os.path.join(tmp, "hooks", "pre-revprop-change")
+        with open(hook, "w") as fd:
+            fd.write("#!/bin/sh\nexit 0\n")
+        os.chmod(hook, 0o755)
+        command = ["svn", "info", "--non-interactive", "--show-item", "repos-root-url", self.url]
+        root = run_svn_network(command, self.url, self._logger).stdout.decode().strip()
+        command = ["svnsync", "initialize", "--non-interactive", file_url(tmp), self.url]
+        self._logger.debug(" ".join(command))
+        run_svn_network(command, self.url, self._logger)
+        with open(os.path.join(tmp, self.PATH_FILE), "w") as fd:
+            fd.write(self.url[len(root) :].strip("/") + "\n")
+        mv(tmp, self.path)
+
+    def sync(self):
+        """Create the mirror if needed and copy the revisions it lacks."""
+        if not self.exists():
+            self.create()
+        # The cache lock is held, so any svnsync lock left is stale.
+        command = ["svnsync", "synchronize", "--non-interactive", "--steal-lock", file_url(self.path)]
+        self._logger.debug(" ".join(command))
+        run_svn_network(command, self.url, self._logger)
 
-    @staticmethod
-    def git_init(url, path, logger=None):
-        logger = logger or logging.getLogger(__name__)
-        tmp = path + ".t"
-        rm(tmp, force=True, recursive=True)
-        command = ["git", "init"]
-        command.append(tmp)
-        logger.debug(" ".join(command))
-        child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        comms = child.communicate()
-        if child.wait() != 0:
-            raise GitException(comms[1].decode())
-        mv(tmp, path)
-        git = Git(url, path)
-        return git
+    def export(self, revision, dst):
+        with open(os.path.join(self.path, self.PATH_FILE), "r") as fd:
+            rel = fd.read().strip()
+        url = file_url(self.path) + ("/" + urllib.parse.quote(rel) if rel else "")
+        self._run(["svn", "export", "-q", "--non-interactive", "-r", revision, "%s@%s" % (url, revision), dst])
 
-    def get_revision(self, branch=None):
-        if branch is None:
-            branch = self._branch
-        return GitIface.get_revision(self, branch)
 
 class SpcException(Exception):
     def __init__(self, value):
@@ -578,7 +3379,7 @@ class SpcItem(object):
         @return [Integer] Process return code
         """
         try:
-            ret = subprocess.call(cmd)
+            ret = run_process(cmd, stdout=None, stderr=None).returncode
             self._logger.debug("cmd='%s', ret=%d", " ".join(cmd), ret)
         except subprocess.CalledProcessError as e:
             raise SpcException(str(e))
@@ -592,7 +3393,10 @@ class SpcItem(object):
         output = str()
         try:
             self._logger.debug("cmd='%s'", " ".join(cmd))
-            output = subprocess.check_output(cmd)
+            child = run_process(cmd, stderr=None)
+            if child.returncode != 0:
+                raise subprocess.CalledProcessError(child.returncode, cmd)
+            output = child.stdout
         except subprocess.CalledProcessError as e:
             raise SpcException(str(e))
         return output.decode().strip()
@@ -600,12 +3404,68 @@ class SpcItem(object):
     def opt_attr(self):
         return self._opt_attributes
 
+    def checkout_stages(self, srcdir, shallow=False, cache_path=None, export=False):
+        """Return the list of Stages that check this component out."""
+        return [Stage("checkout", NETWORK, lambda _: self.checkout(srcdir, shallow, cache_path, export))]
+
+    def offline_missing(self, cache_path=None):
+        """Return what this component needs, but CACHE_PATH lacks, to work --offline."""
+        return ["%s: cannot be fetched without the network" % self._name]
+
+    def cache_key(self):
+        """Return what identifies the cache entry this component fills, or None."""
+        return None
+
+    def describe(self):
+        """Return a line saying where this component comes from."""
+        return self.__class__.__name__
+
+    def verify(self, srcdir, jobs=None, full=False):
+        """
+        Return what is wrong with the tree of this component in SRCDIR.
+
+        A git tree is checked with verify_identity and git status, any
+        other tree against the manifest written when it was checked
+        out, see verify_manifest.  Each line names the component.
+        """
+        path = os.path.join(srcdir, self._name)
+        if not os.path.isdir(path):
+            return ["%s: missing %s" % (self._name, path)]
+        if os.path.isdir(os.path.join(path, ".git")):
+            repo = Git(path, path, logger=self._logger)
+            problems = self.verify_identity(repo) or ["%s %s" % change for change in repo.status()]
+        else:
+            problems = verify_manifest(path, self.describe(), jobs, full)
+        return ["%s: %s" % (self._name, p) for p in problems]
+
+    def verify_identity(self, repo):
+        """Return why the git tree REPO is not the one this component names, if it is not."""
+        return []
+
+    def mirror_revision(self):
+        """Return the revision in the git mirror this component checks out, or None."""
+        return None
+
+    def warm_stages(self, cache_path):
+        """Return the list of Stages that fill CACHE_PATH for this component."""
+        return []
+
+    def _mirror_missing(self, cache_path, ref):
+        """Return what is missing for REF to come from the mirror in CACHE_PATH."""
+        mirror = mirror_path(cache_path, self._name, self._url) if cache_path else None
+        if not mirror or not os.path.isdir(mirror):
+            return ["%s: mirror %s" % (self._name, mirror or "in --cache-dir")]
+        if not Git(self._url, mirror).has_commit(ref):
+            return ["%s: %s in mirror %s" % (self._name, ref, mirror)]
+        return []
+
 
 class SpcItemTarball(SpcItem):
-    def __init__(self, name, url, series=None, logger=None, opt_arg=None):
+    def __init__(self, name, url, series=None, logger=None, opt_arg=None, mirrors=None):
         SpcItem.__init__(self, name, logger=logger, opt_arg=opt_arg)
         self._url = url
         self._series = series
+        self._mirrors = mirrors or []
 
     def __eq__(self, other):
         """
@@ -631,20 +3491,95 @@ class SpcItemTarball(SpcItem):
     def archive_fd(self, fd):
         raise NotImplementedError
 
-    def archive(self, output_dir):
-        path = os.path.join(output_dir, self._name + ".tar")
-        archive(self._url, path, ".", seriesurl=self._series)
+    def archive(self, output_dir, cache_path=None):
+        tarball_archive(
+            self._url,
+            os.path.join(output_dir, self._name + ".tar"),
+            download_dir(cache_path),
+            seriesurl=self._series,
+            cache_path=cache_path,
+            mirrors=self._mirrors,
+        )
 
-    def checkout(self, srcdir, shallow=False, cache_path=None):
+    def checkout_stages(self, srcdir, shallow=False, cache_path=None, export=False):
         path = os.path.join(srcdir, self._name)
-        tarball_acquire_explode_patch(self._url, path, ".", seriesurl=self._series)
+        downloaddir = download_dir(cache_path)
+
+        def fetch(_):
+            if os.path.isdir(path):
+                return None
+            return tarball_acquire(
+                self._url, downloaddir, seriesurl=self._series, mirrors=self._mirrors, cache_path=cache_path
+            )
+
+        def extract(acquired):
+            if acquired is None:
+                return None
+            bundlepath, series = acquired
+            return tarball_explode(self._url, bundlepath, path), series
+
+        def apply(exploded):
+            if exploded is None:
+                return
+            packagedir, series = exploded
+            tarball_patch(packagedir, path, series)
+            write_manifest(path, self.describe())
+
+        return [
+            Stage("fetch", NETWORK, fetch),
+            Stage("extract", DISK, extract),
+            Stage("patch", DISK, apply),
+        ]
+
+    def checkout(self, srcdir, shallow=False, cache_path=None, export=False):
+        run_stages(self.checkout_stages(srcdir, shallow, cache_path, export))
+
+    def cache_key(self):
+        return ("tarball", self._url, self._series)
+
+    def describe(self):
+        if self._series:
+            return "tarball %s series %s" % (self._url, self._series)
+        return "tarball %s" % self._url
+
+    def warm_stages(self, cache_path):
+        downloaddir = download_dir(cache_path)
+
+        def fetch(_):
+            fresh = not os.path.isfile(os.path.join(downloaddir, os.path.basename(self._url)))
+            bundlepath, series = tarball_acquire(
+                self._url, downloaddir, seriesurl=self._series, mirrors=self._mirrors, cache_path=cache_path
+            )
+            if series:
+                # Wait for the patches to land in the cache.
+                series.contents()
+            return bundlepath, fresh
+
+        def verify(fetched):
+            bundlepath, fresh = fetched
+            if fresh:
+                tarball_verify(bundlepath)
+
+        return [Stage("fetch", NETWORK, fetch), Stage("verify", DISK, verify)]
+
+    def offline_missing(self, cache_path=None):
+        missing = []
+        bundlepath = os.path.join(download_dir(cache_path), os.path.basename(self._url))
+        if not os.path.isfile(bundlepath):
+            missing.append("%s: tarball %s" % (self._name, bundlepath))
+        if self._series:
+            missing.extend("%s: series file %s" % (self._name, f) for f in Series.missing(self._series, cache_path))
+        return missing
 
 
 class SpcItemGitVersion(SpcItem):
-    def __init__(self, name, url, version, logger=None, opt_arg=None):
+    def __init__(self, name, url, version, logger=None, opt_arg=None, mirrors=None, bundle=None, export=False):
         SpcItem.__init__(self, name, logger=logger, opt_arg=opt_arg)
         self._url = url
         self._version = version
+        self._mirrors = mirrors or []
+        self._bundle = bundle
+        self._export = export
 
     def __eq__(self, other):
         """
@@ -660,6 +3595,10 @@ class SpcItemGitVersion(SpcItem):
         if self._version != other._version:
             return False
 
+        # An exported tree lacks the .git of a checkout.
+        if self._export != other._export:
+            return False
+
         return True
 
     def __hash__(self):
@@ -669,47 +3608,177 @@ class SpcItemGitVersion(SpcItem):
         repo = Git(self._url, None, logger=self._logger)
         repo.archive_fd(self._version, self._name, fd)
 
-    def archive(self, output_dir):
-        repo = Git(self._url, None, logger=self._logger)
+    def archive(self, output_dir, cache_path=None):
         fname = os.path.join(output_dir, self._name + ".tar")
+        if network_policy.offline or (remote_cache.url and cache_path):
+            mirror = mirror_path(cache_path, self._name, self._url)
+            if not network_policy.offline:
+                update_mirror(
+                    self._url,
+                    mirror,
+                    self._name,
+                    self._logger,
+                    mirrors=self._mirrors,
+                    version=self._version,
+                    bundle=self._bundle,
+                )
+            with cache_lock(mirror, exclusive=False):
+                Git(mirror, None, logger=self._logger).archive(self._version, self._name, fname)
+            return
+        repo = Git(self._url, None, logger=self._logger)
         repo.archive(self._version, self._name, fname)
 
-    def checkout(self, srcdir, shallow=False, cache_path=None):
-        path = os.path.join(srcdir, self._name)
-        if not os.path.exists(path):
-            if cache_path:
-                cache_path = os.path.join(cache_path, self._name)
-                if not os.path.exists(cache_path):
-                    self._logger.debug("git clone %s %s (mirror)" % (self._url, self._name))
-                    repo = Git.clone(self._url, cache_path, mirror=True, logger=self._logger)
-                else:
-                    repo = Git(self._url, cache_path, logger=self._logger)
-                self._logger.debug("git fetch %s (mirror)" % self._name)
+    def offline_missing(self, cache_path=None):
+        return self._mirror_missing(cache_path, self._version)
+
+    def cache_key(self):
+        return ("git", self._name, self._url)
+
+    def describe(self):
+        return "git %s version %s" % (self._url, self._version)
+
+    def mirror_revision(self):
+        return self._version
+
+    def verify_identity(self, repo):
+        recorded = repo.config_get("source-fetch.version")
+        if recorded is not None and recorded != self._version:
+            return ["checked out at version %s" % recorded]
+        expected = repo.config_get("source-fetch.commit") if recorded else repo.rev_parse(self._version)
+        if expected is None:
+            return ["version %s not found" % self._version]
+        head = repo.rev_parse("HEAD")
+        if head != expected:
+            return ["HEAD is %s, not %s" % (head, expected)]
+        return []
+
+    def warm_stages(self, cache_path):
+        mirror = mirror_path(cache_path, self._name, self._url)
+
+        def fetch(_):
+            update_mirror(
+                self._url,
+                mirror,
+                self._name,
+                self._logger,
+                mirrors=self._mirrors,
+                version=self._version,
+                bundle=self._bundle,
+            )
+
+        return [Stage("fetch", NETWORK, fetch)]
+
+    def _clone(self, url, path, shallow, mirrors=None, bundle=None):
+        urls = rank_urls(candidate_urls(url, mirrors), self._logger)
+        if shallow:
+            self._logger.debug("git init")
+            repo = Git.git_init(url, path, logger=self._logger)
+            self._logger.debug("git remote add %s" % (self._url))
+            repo.add_remote()
+            self._logger.debug("git fetch %s" % (self._name))
+            used, _ = try_urls(
+                urls, lambda u: repo.fetch(shallow=True, remote=u, version=self._version), self._logger
+            )
+            if used != url:
+                try:
+                    self._verify_fetched(repo, url)
+                except GitException:
+                    discard(path)
+                    raise
+        else:
+            self._logger.debug("git clone %s %s" % (self._url, self._name))
+            repo = bundle_clone(bundle, url, path + ".tmp", logger=self._logger) if bundle else None
+            if repo is None:
+                used, repo = try_urls(
+                    urls, lambda u: Git.clone(u, path + ".tmp", logger=self._logger), self._logger
+                )
+            else:
+                used = bundle
+            self._logger.debug("git fetch %s" % (self._name))
+            if used != url:
+                repo.set_url(url)
+                repo.fetch_verified(self._version)
+            else:
                 repo.fetch()
-            rm(path + ".tmp", force=True, recursive=True)
-            url = self._url
-            if cache_path:
-                url = cache_path
+        return repo
+
+    def _verify_fetched(self, repo, url):
+        """
+        Check the commit a shallow fetch from a mirror left in FETCH_HEAD
+        against what URL, the primary, says the version is.
+        """
+        fetched = repo.rev_parse("FETCH_HEAD")
+        if is_full_sha(self._version):
+            expected = self._version
+        else:
+            expected = Git(url, repo._path, logger=self._logger).remote_commit(self._version)
+        if fetched != expected:
+            raise GitException(
+                url, "a mirror has %s at %s, but the primary has it at %s" % (self._version, fetched, expected)
+            )
+
+    def checkout_stages(self, srcdir, shallow=False, cache_path=None, export=False):
+        path = os.path.join(srcdir, self._name)
+        export = export or self._export
+        mirror = None
+        if cache_path:
+            mirror = mirror_path(cache_path, self._name, self._url)
+
+        def fetch(_):
+            if os.path.exists(path):
+                raise Exception("%s already exists, please delete" % (path))
+            if mirror:
+                update_mirror(
+                    self._url,
+                    mirror,
+                    self._name,
+                    self._logger,
+                    mirrors=self._mirrors,
+                    version=self._version,
+                    bundle=self._bundle,
+                )
+            discard(path + ".tmp")
+            if mirror:
+                # Everything else is local to the disk.
+                return None
+            if export:
+                # Without a mirror to export from, a shallow fetch of
+                # the one commit is thrown away once exported.
+                discard(path + ".git")
+                return self._clone(self._url, path + ".git", True, mirrors=self._mirrors)
+            return self._clone(self._url, path, shallow, mirrors=self._mirrors, bundle=self._bundle)
+
+        def export_tree(repo):
+            self._logger.debug("git archive %s %s" % (self._version, self._name))
+            if repo is None:
+                with cache_lock(mirror, exclusive=False):
+                    Git(self._url, mirror, logger=self._logger).export(self._version, path)
+            else:
+                repo.export("FETCH_HEAD", path)
+                discard(path + ".git")
+            write_manifest(path, self.describe())
+
+        def checkout(repo):
+            if export:
+                return export_tree(repo)
+            if repo is None:
+                with cache_lock(mirror, exclusive=False):
+                    metrics.inc("source_fetch_local_bytes_total", pack_size(mirror), kind="mirror")
+                    repo = self._clone(mirror, path, shallow)
             if shallow:
-                self._logger.debug("git init")
-                repo = Git.git_init(url, path, logger=self._logger)
-                self._logger.debug("git remote add %s" % (self._url))
-                repo.add_remote()
-                self._logger.debug("git fetch %s" % (self._name))
-                repo.fetch(shallow=True, version=self._version)
                 repo.checkout("FETCH_HEAD", quiet=True)
             else:
-                self._logger.debug("git clone %s %s" % (self._url, self._name))
-                repo = Git.clone(url, path + ".tmp", logger=self._logger)
-                self._logger.debug("git fetch %s" % (self._name))
-                repo.fetch()
                 self._logger.debug("git checkout %s %s" % (self._version, self._name))
                 repo.checkout(self._version, quiet=True)
             self._logger.debug("git reset --hard %s" % (self._name))
             repo.reset(hard=True)
+            repo.record_checkout(self._version)
             repo.mv(path)
-        else:
-            raise Exception("%s already exists, please delete" % (path))
+
+        return [Stage("fetch", NETWORK, fetch), Stage("checkout", DISK, checkout)]
+
+    def checkout(self, srcdir, shallow=False, cache_path=None, export=False):
+        run_stages(self.checkout_stages(srcdir, shallow, cache_path, export))
 
     def log_for_revision(self, revision, cache_path=None):
         if cache_path is None:
@@ -718,23 +3787,23 @@ class SpcItemGitVersion(SpcItem):
         return self._log_for_revision_using_cachedir(revision, cache_path)
 
     def _log_for_revision_using_cachedir(self, revision, cache_path):
-        cache_path = os.path.join(cache_path, self._name)
-        if not os.path.exists(cache_path):
-            self._logger.debug("git clone %s %s (mirror)" % (self._url, self._name))
-            repo = Git.clone(self._url, cache_path, mirror=True, logger=self._logger)
-        else:
-            repo = Git(self._url, cache_path, logger=self._logger)
-            self._logger.debug("git fetch %s (mirror)" % self._name)
-            repo.fetch()
+        cache_path = mirror_path(cache_path, self._name, self._url)
+        repo = update_mirror(
+            self._url, cache_path, self._name, self._logger, mirrors=self._mirrors, bundle=self._bundle
+        )
         return repo.log_for_revision(revision)
 
 
 class SpcItemGitBranch(SpcItem):
-    def __init__(self, name, url, local_branch, remote_branch, logger=None, opt_arg=None):
+    def __init__(
+        self, name, url, local_branch, remote_branch, logger=None, opt_arg=None, mirrors=None, bundle=None
+    ):
         SpcItem.__init__(self, name, logger=logger, opt_arg=opt_arg)
         self._url = url
         self._local_branch = local_branch
         self._remote_branch = remote_branch
+        self._mirrors = mirrors or []
+        self._bundle = bundle
 
     def __eq__(self, other):
         """
@@ -754,17 +3823,86 @@ class SpcItemGitBranch(SpcItem):
         repo = Git(self._url, None, logger=self._logger)
         repo.archive_fd(self._remote_branch, self._name, fd)
 
-    def archive(self, output_dir):
-        repo = Git(self._url, None, logger=self._logger)
+    def archive(self, output_dir, cache_path=None):
         fname = os.path.join(output_dir, self._name + ".tar")
+        if network_policy.offline or (remote_cache.url and cache_path):
+            mirror = mirror_path(cache_path, self._name, self._url)
+            if not network_policy.offline:
+                update_mirror(self._url, mirror, self._name, self._logger, mirrors=self._mirrors, bundle=self._bundle)
+            with cache_lock(mirror, exclusive=False):
+                Git(mirror, None, logger=self._logger).archive(self._mirror_ref(), self._name, fname)
+            return
+        repo = Git(self._url, None, logger=self._logger)
         repo.archive(self._remote_branch, self._name, fname)
 
-    def checkout(self, srcdir, shallow=False, cache_path=None):
+    def _mirror_ref(self):
+        """Return the ref of the branch in a mirror of the repository."""
+        branch = self._remote_branch or self._local_branch
+        if branch.startswith("remotes/") or branch.startswith("vendors/"):
+            return "refs/" + branch
+        return "refs/heads/" + branch
+
+    def offline_missing(self, cache_path=None):
+        return self._mirror_missing(cache_path, self._mirror_ref())
+
+    def cache_key(self):
+        return ("git", self._name, self._url)
+
+    def describe(self):
+        return "git %s branch %s" % (self._url, self._remote_branch or self._local_branch)
+
+    def mirror_revision(self):
+        return self._mirror_ref()
+
+    def verify_identity(self, repo):
+        # The branch moves, so only which one is checked out can be told.
+        branch = repo.current_branch()
+        if branch != self._local_branch:
+            return ["on %s, not branch %s" % (branch, self._local_branch)]
+        return []
+
+    def warm_stages(self, cache_path):
+        mirror = mirror_path(cache_path, self._name, self._url)
+
+        def fetch(_):
+            update_mirror(self._url, mirror, self._name, self._logger, mirrors=self._mirrors, bundle=self._bundle)
+
+        return [Stage("fetch", NETWORK, fetch)]
+
+    def _clone_mirror(self, mirror, path, shallow):
+        """Clone PATH from MIRROR, leaving it as a clone of the real URL would be."""
+        if shallow:
+            repo = Git.git_init(mirror, path, logger=self._logger)
+            repo.add_remote()
+            repo.fetch(shallow, version=self._local_branch)
+            repo.set_url(self._url)
+            return repo
+        repo = Git.clone(mirror, path + ".tmp", logger=self._logger)
+        repo.set_url(self._url)
+        if self._remote_branch.startswith("remotes/"):
+            repo.add_branch_fetch()
+            repo.fetch(remote=mirror, refspecs=["+refs/remotes/*:refs/remotes/origin/remotes/*"])
+        elif self._remote_branch.startswith("vendors/ARM/"):
+            repo.add_arm_vendor_remote()
+            repo.fetch(remote=mirror, refspecs=["+refs/vendors/ARM/*:refs/remotes/vendors/ARM/*"])
+        return repo
+
+    def checkout_stages(self, srcdir, shallow=False, cache_path=None, export=False):
         path = os.path.join(srcdir, self._name)
-        if not os.path.exists(path):
+        mirror = None
+        if cache_path:
+            mirror = mirror_path(cache_path, self._name, self._url)
+
+        def fetch(_):
+            if os.path.exists(path):
+                raise Exception("%s already exists, please delete" % (path))
             if os.path.exists(path + ".tmp"):
                 self._logger.debug("rm -rf %s" % (path + ".tmp"))
-                rm(path + ".tmp", force=True, recursive=True)
+                discard(path + ".tmp")
+            if mirror:
+                update_mirror(self._url, mirror, self._name, self._logger, mirrors=self._mirrors, bundle=self._bundle)
+                # Everything else is local to the disk.
+                return None
             if shallow:
                 self._logger.debug("git init")
                 repo = Git.git_init(self._url, path, logger=self._logger)
@@ -772,29 +3910,52 @@ class SpcItemGitBranch(SpcItem):
                 repo.add_remote()
                 self._logger.debug("git fetch %s" % (self._name))
                 repo.fetch(shallow, version=self._local_branch)
-                repo.checkout(self._local_branch, quiet=True)
             else:
-                repo = Git.clone(self._url, path + ".tmp", logger=self._logger)
+                repo = None
+                if self._bundle:
+                    repo = bundle_clone(self._bundle, self._url, path + ".tmp", logger=self._logger)
+                if repo is not None:
+                    used = self._bundle
+                else:
+                    urls = rank_urls(candidate_urls(self._url, self._mirrors), self._logger)
+                    used, repo = try_urls(
+                        urls, lambda u: Git.clone(u, path + ".tmp", logger=self._logger), self._logger
+                    )
+                if used != self._url:
+                    # The branch must resolve as the primary URL has it.
+                    repo.set_url(self._url)
+                    repo.fetch()
                 if self._remote_branch.startswith("remotes/"):
                     repo.add_branch_fetch()
                     repo.fetch()
                 elif self._remote_branch.startswith("vendors/ARM/"):
                     repo.add_arm_vendor_remote()
                     repo.fetch(remote="vendors/ARM")
-
-                if self._remote_branch and self._local_branch != repo.current_branch():
-                    branch = self._remote_branch
-                    if self._remote_branch.startswith("remotes/"):
-                        branch = "remotes/origin/" + self._remote_branch
-                    elif self._remote_branch.startswith("vendors/ARM/"):
-                        branch = "remotes/" + self._remote_branch
-                    else:
-                        branch = "origin/" + self._remote_branch
-                    repo.branch(branch, self._local_branch)
-                repo.checkout(self._local_branch, quiet=True)
+            return repo
+
+        def checkout(repo):
+            if repo is None:
+                with cache_lock(mirror, exclusive=False):
+                    metrics.inc("source_fetch_local_bytes_total", pack_size(mirror), kind="mirror")
+                    repo = self._clone_mirror(mirror, path, shallow)
+            if not shallow and self._remote_branch and self._local_branch != repo.current_branch():
+                branch = self._remote_branch
+                if self._remote_branch.startswith("remotes/"):
+                    branch = "remotes/origin/" + self._remote_branch
+                elif self._remote_branch.startswith("vendors/ARM/"):
+                    branch = "remotes/" + self._remote_branch
+                else:
+                    branch = "origin/" + self._remote_branch
+                repo.branch(branch, self._local_branch)
+            repo.checkout(self._local_branch, quiet=True)
+            if not shallow:
                 repo.mv(path)
-        else:
-            raise Exception("%s already exists, please delete" % (path))
+
+        return [Stage("fetch", NETWORK, fetch), Stage("checkout", DISK, checkout)]
+
+    def checkout(self, srcdir, shallow=False, cache_path=None, export=False):
+        run_stages(self.checkout_stages(srcdir, shallow, cache_path, export))
+
 
 class SpcItemSubversionRevision(SpcItem):
     def __init__(self, name, url, revision, logger=None, opt_arg=None):
@@ -821,6 +3982,95 @@ class SpcItemSubversionRevision(SpcItem):
     def __hash__(self):
         return hash(self.url) + hash(self.revision)
 
+    def describe(self):
+        return "svn %s revision %s" % (self.url, self.revision)
+
+    def _mirror(self, cache_path):
+        # Kept apart from any git mirror of a component of the same name.
+        return SubversionMirror(self.url, mirror_path(cache_path, self._name, self.url) + ".svn", logger=self._logger)
+
+    def _update_mirror(self, mirror):
+        with cache_lock(mirror.path):
+            # A pinned revision already mirrored needs no round trip.
+            hit = mirror.has_revision(self.revision)
+            metrics.cache("mirror", hit)
+            if not hit:
+                if network_policy.offline:
+                    raise OfflineException(["%s: revision %s in mirror %s" % (self._name, self.revision, mirror.path)])
+                mirror.sync()
+            mark_used(mirror.path)
+
+    def _export(self, dst, cache_path=None):
+        """Export the pinned revision to DST, from the mirror in CACHE_PATH if given."""
+        rm(dst, force=True, recursive=True)
+        if cache_path:
+            mirror = self._mirror(cache_path)
+            with cache_lock(mirror.path, exclusive=False):
+                mirror.export(self.revision, dst)
+            return
+        command = ["svn", "export", "-q", "--non-interactive", "-r", self.revision]
+        command += ["%s@%s" % (self.url, self.revision), dst]
+        self._logger.debug(" ".join(command))
+        run_svn_network(command, self.url, self._logger, cleanup=lambda: rm(dst, force=True, recursive=True))
+
+    def archive(self, output_dir, cache_path=None):
+        if cache_path:
+            self._update_mirror(self._mirror(cache_path))
+        fname = os.path.join(output_dir, self._name + ".tar")
+        with TemporaryDirectory() as tmp:
+            dst = os.path.join(tmp, self._name)
+            self._export(dst, cache_path)
+            try:
+                with tarfile.open(fname, "w") as tar:
+                    tar.add(dst, arcname=self._name)
+            except:
+                rm(fname, force=True)
+                raise
+
+    def checkout_stages(self, srcdir, shallow=False, cache_path=None, export=False):
+        path = os.path.join(srcdir, self._name)
+
+        def fetch(_):
+            if os.path.exists(path):
+                raise Exception("%s already exists, please delete" % (path))
+            if cache_path:
+                self._update_mirror(self._mirror(cache_path))
+                # Everything else is local to the disk.
+                return False
+            self._export(path + ".tmp")
+            return True
+
+        def export(exported):
+            if not exported:
+                self._export(path + ".tmp", cache_path)
+            mv(path + ".tmp", path)
+            write_manifest(path, self.describe())
+
+        return [Stage("fetch", NETWORK, fetch), Stage("export", DISK, export)]
+
+    def checkout(self, srcdir, shallow=False, cache_path=None, export=False):
+        run_stages(self.checkout_stages(srcdir, shallow, cache_path, export))
+
+    def offline_missing(self, cache_path=None):
+        mirror = self._mirror(cache_path) if cache_path else None
+        if not mirror or not mirror.has_revision(self.revision):
+            where = mirror.path if mirror else "in --cache-dir"
+            return ["%s: revision %s in mirror %s" % (self._name, self.revision, where)]
+        return []
+
+    def cache_key(self):
+        return ("svn", self._name, self.url)
+
+    def warm_stages(self, cache_path):
+        mirror = self._mirror(cache_path)
+
+        def fetch(_):
+            with cache_lock(mirror.path):
+                mirror.sync()
+                mark_used(mirror.path)
+
+        return [Stage("fetch", NETWORK, fetch)]
+
 
 class SpcItemBldroot(SpcItem):
     def __init__(self, name, channel, status_filter, logger=None, opt_arg=None):
@@ -864,63 +4114,252 @@ class SpcItemBldroot(SpcItem):
             "bldroot-status-filter",
         ]
 
-    def checkout(self, srcdir, shallow=False, cache_path=None):
-        # Get tag based on channel's filter
-        cmd = [
-            "bld",
-            "build",
-            "list",
-            self.channel,
-            "--status",
-            self.status_filter,
-            "--count",
-            "1",
-        ]
-        tag = self._cmd_check_output(cmd)
-        tag = tag.strip()
+    def describe(self):
+        return "bldroot channel %s filter %s" % (self.channel, self.status_filter)
+
+    def resolve(self, cache_path=None, resolver=None):
+        """
+        Return the component this entry refers to in the spc artifact
+        of the latest tag of its channel, as RESOLVER, by default the
+        process wide one, finds it.
+        """
+        resolver = resolver or bldroot
+        tag = resolver.tag(self.channel, self.status_filter)
+        spec = resolver.spec(tag, cache_path)
+        if spec is None or self._name not in spec:
+            raise SpcException("unable to resolve bldroot entry %s" % self._name)
+        args = {
+            "class": spec[self._name].__class__,
+            "name": self._name,
+            "artifact": "spc",
+            "tag": tag,
+        }
+        # To avoid recursion we must only allow Branch/Version items to be frozen
+        if spec[self._name].__class__ == SpcItemBldroot:
+            msg = "found bldroot cycle {class} in component={name}, " "artifact={artifact}, tag={tag}".format(**args)
+            raise SpcException(msg)
+        msg = "checkout: {class} in component={name}, " "artifact={artifact}, tag={tag}".format(**args)
+        self._logger.debug(msg)
+        self._logger.info("checkout: {name} using " "{artifact} from {tag}".format(**args))
+        return spec[self._name]
+
+    def checkout(self, srcdir, shallow=False, cache_path=None, export=False):
+        return self.resolve(cache_path).checkout(srcdir, shallow, cache_path, export)
+
+
+class BldrootResolver(object):
+    """
+    Resolve bldroot channels to tags and tags to spc artifacts.
+
+    Each channel and status filter is asked for its tag once per run,
+    however many components refer to it.  Spc artifacts are kept in
+    the cache directory by tag, a tag's artifact never changes.
+    """
+
+    def __init__(self, logger=None):
+        self._logger = logger or logging.getLogger(__name__)
+        self._tags = {}
+        self._specs = {}
+        self._lock = threading.Lock()
+
+    def _run(self, cmd):
+        self._logger.debug("cmd='%s'", " ".join(cmd))
+        return run_process(cmd, stderr=None)
+
+    def tag(self, channel, status_filter):
+        key = (channel, status_filter)
+        with self._lock:
+            if key in self._tags:
+                return self._tags[key]
+        if network_policy.offline:
+            raise OfflineException(["bldroot channel %s" % channel])
+        cmd = ["bld", "build", "list", channel, "--status", status_filter, "--count", "1"]
+        child = self._run(cmd)
+        if child.returncode != 0:
+            raise SpcException(str(subprocess.CalledProcessError(child.returncode, cmd)))
+        tag = child.stdout.decode().strip()
+        if not tag:
+            raise SpcException("unable to resolve TAG name")
+        with self._lock:
+            self._tags[key] = tag
+        return tag
+
+    def spec(self, tag, cache_path=None):
+        """Return the Spc stored as TAG's spc artifact, or None if it has none."""
+        with self._lock:
+            if tag in self._specs:
+                return self._specs[tag]
+        path = os.path.join(cache_path, "bldroot", "%s.spc" % tag.replace("/", "_")) if cache_path else None
+        if path and os.path.isfile(path):
+            metrics.cache("bldroot", True, os.path.getsize(path))
+            spec = Spc.open(path)
+        else:
+            metrics.cache("bldroot", False)
+            spec = None
+            with TemporaryFile() as file_name:
+                if self._run(["bld", "artifact", "exists", "spc", tag]).returncode == 0:
+                    if self._run(["bld", "artifact", "get", "-o", file_name, "spc", tag]).returncode == 0:
+                        spec = Spc.open(file_name)
+                        if path:
+                            os.makedirs(os.path.dirname(path), exist_ok=True)
+                            shutil.copyfile(file_name, path + ".t")
+                            os.replace(path + ".t", path)
+        with self._lock:
+            self._specs[tag] = spec
+        return spec
+
+    def resolve_all(self, spc, cache_path=None):
+        """
+        Replace the bldroot entries of SPC by what they refer to.
+
+        Distinct channels, then distinct tags, are looked up
+        concurrently so the whole batch costs about one round trip of
+        each kind.
+        """
+        entries = [c for c in spc if isinstance(spc[c], SpcItemBldroot)]
+        if not entries:
+            return
+        with tracer.span("bldroot", "stage", components=len(entries)):
+            keys = set((spc[c].channel, spc[c].status_filter) for c in entries)
+            for f in [prefetch(self.tag, *k) for k in keys]:
+                f.result()
+            tags = set(self.tag(*k) for k in keys)
+            for f in [prefetch(self.spec, t, cache_path) for t in tags]:
+                f.result()
+            for c in entries:
+                spc[c] = spc[c].resolve(cache_path, self)
+
+
+bldroot = BldrootResolver()
+
+
+SIZES_FILE = "sizes.json"
+
+
+class SizeHistory(object):
+    """
+    How big the tree of each component was when last checked out.
+
+    Kept in SIZES_FILE in the cache, keyed by cache_key(), so that a
+    new version of a component is estimated from the one before it.
+    """
+
+    def __init__(self, cache_path=None):
+        self._path = os.path.join(cache_path, SIZES_FILE) if cache_path else None
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._changed = False
+        if self._path and os.path.isfile(self._path):
+            try:
+                with open(self._path) as fd:
+                    self._sizes = json.load(fd)
+            except ValueError:
+                pass
+
+    @staticmethod
+    def key(item):
+        return json.dumps(item.cache_key() or [type(item).__name__, str(item)])
+
+    def get(self, item):
+        return self._sizes.get(self.key(item))
+
+    def record(self, item, size):
+        with self._lock:
+            self._sizes[self.key(item)] = size
+            self._changed = True
+
+    def save(self):
+        if not self._path or not self._changed:
+            return
+        with self._lock:
+            data = json.dumps(self._sizes, indent=1, sort_keys=True).encode()
+        write_file(self._path, data)
+
+
+# How much an unpacked tarball is taken to grow by, when nothing better
+# is known, and the share of a filesystem's free space kept in hand.
+TARBALL_EXPANSION = 4
+SPACE_HEADROOM = 0.05
+
+
+def estimate_space(item, srcdir, cache_path, history):
+    """
+    Return what checking ITEM out into SRCDIR is expected to write, as
+    a list of (path, bytes) where bytes is None when there is no telling.
+
+    The size the tree last had is the best guess, then what the mirror
+    in the cache holds, or the tarball, of which the download is also
+    charged to the cache.
+    """
+    path = os.path.join(srcdir, str(item))
+    if os.path.exists(path):
+        return []
+    tree = history.get(item)
+    if isinstance(item, SpcItemTarball):
+        downloaddir = download_dir(cache_path)
+        bundlepath = os.path.join(downloaddir, os.path.basename(item._url))
+        if os.path.isfile(bundlepath):
+            size = os.path.getsize(bundlepath)
+            download = 0
+        else:
+            size = None
+            for url in candidate_urls(item._url, item._mirrors):
+                size = content_length(url)
+                if size is not None:
+                    break
+            download = size
+        if tree is None and size is not None:
+            tree = size * TARBALL_EXPANSION
+        return [(path, tree), (downloaddir, download)]
+    if cache_path and isinstance(item, (SpcItemGitVersion, SpcItemGitBranch)):
+        mirror = mirror_path(cache_path, str(item), item._url)
+        if not os.path.isdir(mirror):
+            return [(path, tree), (cache_path, None)]
+        if tree is None:
+            tree = dir_size(os.path.join(mirror, "objects"))
+    return [(path, tree)]
+
+
+def free_space(path):
+    """Return the filesystem PATH is, or would be, on and the bytes free there."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    st = os.statvfs(path)
+    return os.stat(path).st_dev, st.f_bavail * st.f_frsize
+
+
+def check_space(items, cache_path, history, logger=None):
+    """
+    Make sure checking out ITEMS, a list of (item, srcdir), fits on the
+    disk, raising SpaceException if it does not.
 
-        if not tag:
-            raise SpcException("unable to resolve TAG name")
+    Returns the estimated size of each item's tree, 0 when unknown.
+    """
+    logger = logger or logging.getLogger(__name__)
+    futures = [(item, prefetch(estimate_space, item, srcdir, cache_path, history)) for item, srcdir in items]
+    sizes = {}
+    filesystems = {}
+    for item, future in futures:
+        charges = future.result()
+        sizes[item] = (charges[0][1] or 0) if charges else 0
+        for path, size in charges:
+            if size is None:
+                logger.info("%s: no estimate of the space %s needs" % (item, path))
+                continue
+            dev, free = free_space(path)
+            fs = filesystems.setdefault(dev, {"path": path, "free": free, "need": 0, "items": []})
+            fs["need"] += size
+            fs["items"].append((size, str(item)))
+    for fs in filesystems.values():
+        if fs["need"] > fs["free"] * (1 - SPACE_HEADROOM):
+            largest = ", ".join("%s %s" % (c, format_size(n)) for n, c in sorted(fs["items"], reverse=True)[:5])
+            raise SpaceException(
+                "%s needed on the filesystem of %s, %s free; largest: %s"
+                % (format_size(fs["need"]), fs["path"], format_size(fs["free"]), largest)
+            )
+    return sizes
 
-        # Store tag's snp/spc file and obtain requested component
-        # In case snapshot is not available, use tag's spec file info
-        with TemporaryFile() as file_name:
-            for artifact_type in ["spc"]:
-                cmd = ["bld", "artifact", "exists", artifact_type, tag]
-                if not self._cmd_call(cmd):
-                    cmd = [
-                        "bld",
-                        "artifact",
-                        "get",
-                        "-o",
-                        file_name,
-                        artifact_type,
-                        tag,
-                    ]
-                    if not self._cmd_call(cmd):
-                        spec = Spc.open(file_name)
-                        args = {
-                            "class": spec[self._name].__class__,
-                            "name": self._name,
-                            "artifact": artifact_type,
-                            "tag": tag,
-                        }
-                        # To avoid recursion we must only allow Branch/Version items to be frozen
-                        if not spec[self._name].__class__ == SpcItemBldroot:
-                            msg = "checkout: {class} in component={name}, " "artifact={artifact}, tag={tag}".format(
-                                **args
-                            )
-                            self._logger.debug(msg)
-                            self._logger.info("checkout: {name} using " "{artifact} from {tag}".format(**args))
-                            return spec[self._name].checkout(srcdir, shallow, cache_path)
-                        else:
-                            msg = (
-                                "found bldroot cycle {class} in component={name}, "
-                                "artifact={artifact}, tag={tag}".format(**args)
-                            )
-                            raise SpcException(msg)
-            else:
-                raise SpcException("unable to resolve bldroot entry %s" % self._name)
 
 class Spc(object):
     """
@@ -942,10 +4381,9 @@ class Spc(object):
             try:
                 return SpcConfigSerializer.open(path, logger)
             except SpcException as config_reason:
-                sys.stderr.write("error: cannot read %s\n" % path)
-                sys.stderr.write(" classic reader: %s\n" % classic_reason)
-                sys.stderr.write(" config reader: %s\n" % config_reason)
-                return None
+                raise SpcException(
+                    "cannot read %s\n classic reader: %s\n config reader: %s" % (path, classic_reason, config_reason)
+                )
 
     @staticmethod
     def open_s(xs, name="<???>", logger=None):
@@ -970,14 +4408,129 @@ class Spc(object):
         keys.sort()
         return keys.__iter__()
 
-    def archive(self, output_dir, component_filter=None):
+    def copy(self):
+        """Return an Spc of the same items, whose entries can be replaced without touching this one."""
+        spc = Spc(self._logger)
+        spc._items = dict(self._items)
+        return spc
+
+    def select(self, component_filter):
+        """Drop the components COMPONENT_FILTER does not accept."""
+        for c in list(self):
+            if not component_filter(c):
+                del self[c]
+
+    def offline_missing(self, cache_path=None, component_filter=None):
+        """Return what the components need, but CACHE_PATH lacks, to work --offline."""
+        missing = []
         for component in self:
             if not component_filter or component_filter(component):
-                self[component].archive(output_dir)
+                missing.extend(self[component].offline_missing(cache_path))
+        return missing
 
-    def checkout(self, srcdir, shallow=False, cache_path=None):
+    def archive(self, output_dir, component_filter=None, cache_path=None):
         for component in self:
-            self[component].checkout(srcdir, shallow, cache_path)
+            if not component_filter or component_filter(component):
+                start = time.time()
+                with tracer.component(component):
+                    with tracer.span("archive", "stage"):
+                        self[component].archive(output_dir, cache_path=cache_path)
+                metrics.set("source_fetch_component_seconds", time.time() - start, component=component)
+
+    def checkout(
+        self,
+        srcdir,
+        shallow=False,
+        cache_path=None,
+        network_jobs=DEFAULT_NETWORK_JOBS,
+        disk_jobs=DEFAULT_DISK_JOBS,
+        export=False,
+    ):
+        return Spc.checkout_many(
+            [(self, srcdir)], shallow, cache_path, network_jobs, disk_jobs, self._logger, export=export
+        )
+
+    @staticmethod
+    def checkout_many(
+        targets,
+        shallow=False,
+        cache_path=None,
+        network_jobs=DEFAULT_NETWORK_JOBS,
+        disk_jobs=DEFAULT_DISK_JOBS,
+        logger=None,
+        export=False,
+        space_check=False,
+    ):
+        """
+        Check out each (spc, srcdir) of TARGETS.
+
+        Components that compare equal produce the same tree, so each
+        is checked out once, into the first srcdir wanting it, then
+        linked into the others.  Everything runs on one pipeline.
+        With EXPORT git versions are plain trees, without a .git.
+        With SPACE_CHECK nothing starts unless the estimated sizes fit
+        on the disk, and the largest components start first.
+        """
+        history = SizeHistory(cache_path)
+        jobs = Spc.checkout_jobs(targets, history, shallow, cache_path, export, space_check, logger)
+        pipeline = Pipeline([(NETWORK, network_jobs), (DISK, disk_jobs)], logger=logger)
+        try:
+            pipeline.run(jobs)
+        finally:
+            history.save()
+        return pipeline
+
+    @staticmethod
+    def checkout_jobs(targets, history, shallow=False, cache_path=None, export=False, space_check=False, logger=None):
+        """
+        Return the (component, stages) jobs that check out each
+        (spc, srcdir) of TARGETS, as checkout_many runs them.
+
+        The trees checked out are recorded in HISTORY, a SizeHistory
+        the caller saves once the jobs have run.
+        """
+        logger = logger or logging.getLogger(__name__)
+        groups = {}
+        for spc, srcdir in targets:
+            bldroot.resolve_all(spc, cache_path)
+            for c in spc:
+                groups.setdefault(spc[c], []).append((srcdir, c))
+
+        sizes = {}
+        if space_check:
+            sizes = check_space([(item, places[0][0]) for item, places in groups.items()], cache_path, history, logger)
+
+        jobs = []
+        for item, places in sorted(groups.items(), key=lambda g: -sizes.get(g[0], 0)):
+            stages = item.checkout_stages(places[0][0], shallow, cache_path, export)
+            if cache_path:
+
+                def measure(arg, item=item, path=os.path.join(*places[0])):
+                    # A manifest already has the sizes; other trees are
+                    # walked only the first time they are seen.
+                    size = manifest_size(path)
+                    if size is None and history.get(item) is None:
+                        size = dir_size(path)
+                    if size is not None:
+                        history.record(item, size)
+                    return arg
+
+                stages.append(Stage("measure", DISK, measure))
+            if len(places) > 1:
+                src = os.path.join(*places[0])
+
+                def share(_, src=src, others=places[1:]):
+                    for srcdir, c in others:
+                        dst = os.path.join(srcdir, c)
+                        if os.path.exists(dst):
+                            logger.info("%s already exists, not linking" % dst)
+                            continue
+                        mkdir(srcdir, parents=True)
+                        link_tree(src, dst)
+
+                stages.append(Stage("link", DISK, share))
+            jobs.append((places[0][1], stages))
+        return jobs
 
     def __eq__(self, other):
         """
@@ -1154,6 +4707,7 @@ class SpcConfigSerializer(SpcSerializer):
                 if type == "tarball":
                     url = None
                     series = None
+                    mirrors = None
                     opt_arg = {}
                     for option in config.options(name):
                         if option == "type":
@@ -1162,18 +4716,23 @@ class SpcConfigSerializer(SpcSerializer):
                             url = config.get(name, option)
                         elif option == "series":
                             series = config.get(name, option)
+                        elif option == "mirrors":
+                            mirrors = config.get(name, option).split()
                         elif option in SpcItemBldroot.get_forwardable():
                             opt_arg[option] = config.get(name, option)
                         else:
                             raise SpcException("unknown option '%s'" % option)
                     if url is None:
                         raise SpcException("%s has no url option" % name)
-                    spc[name] = SpcItemTarball(name, url, series, logger, opt_arg=opt_arg)
+                    spc[name] = SpcItemTarball(name, url, series, logger, opt_arg=opt_arg, mirrors=mirrors)
                 elif type == "git":
                     url = None
                     version = None
                     local_branch = None
                     remote_branch = None
+                    mirrors = None
+                    bundle = None
+                    export = False
                     opt_arg = {}
                     for option in config.options(name):
                         if option == "type":
@@ -1189,6 +4748,12 @@ class SpcConfigSerializer(SpcSerializer):
                             if remote_branch.startswith("origin/"):
                                 logger.warning("remote branch prefixed with " "origin/  %s" % path)
                                 remote_branch = remote_branch[7:]
+                        elif option == "mirrors":
+                            mirrors = config.get(name, option).split()
+                        elif option == "bundle":
+                            bundle = config.get(name, option)
+                        elif option == "export":
+                            export = config.getboolean(name, option)
                         elif option in SpcItemBldroot.get_forwardable():
                             opt_arg[option] = config.get(name, option)
                         else:
@@ -1197,10 +4762,21 @@ class SpcConfigSerializer(SpcSerializer):
                     if version:
                         if local_branch or remote_branch:
                             raise SpcException("%s has both version and " "branch options" % name)
-                        spc[name] = SpcItemGitVersion(name, url, version, logger, opt_arg=opt_arg)
+                        spc[name] = SpcItemGitVersion(
+                            name,
+                            url,
+                            version,
+                            logger,
+                            opt_arg=opt_arg,
+                            mirrors=mirrors,
+                            bundle=bundle,
+                            export=export,
+                        )
                     else:
                         if version:
                             raise SpcException("%s has both branch and " "version options" % name)
+                        if export:
+                            raise SpcException("%s: export needs a version option" % name)
                         if url is None:
                             raise SpcException("%s has no url option" % name)
 
@@ -1217,6 +4793,8 @@ class SpcConfigSerializer(SpcSerializer):
                             remote_branch,
                             logger,
                             opt_arg=opt_arg,
+                            mirrors=mirrors,
+                            bundle=bundle,
                         )
                 elif type == "subversion":
                     url = None
@@ -1234,6 +4812,9 @@ class SpcConfigSerializer(SpcSerializer):
                         else:
                             raise SpcException("unknown option '%s'" % option)
 
+                    for option, value in (("url", url), ("revision", revision)):
+                        if not value:
+                            raise SpcException("%s: subversion needs a %s option" % (name, option))
                     spc[name] = SpcItemSubversionRevision(name, url, revision, logger, opt_arg=opt_arg)
                 elif type == "bldroot":
                     channel = None
@@ -1274,6 +4855,8 @@ class SpcConfigSerializer(SpcSerializer):
                 fd.write("type=git\n")
                 fd.write("url=%s\n" % item._url)
                 fd.write("version=%s\n" % item._version)
+                if item._export:
+                    fd.write("export=yes\n")
             elif item.__class__ == SpcItemSubversionRevision:
                 fd.write("type=subversion\n")
                 fd.write("url=%s\n" % item.url)
@@ -1285,6 +4868,11 @@ class SpcConfigSerializer(SpcSerializer):
             else:
                 raise SpcException("cannot serialize class %s" % item.__class__)
 
+            if getattr(item, "_mirrors", None):
+                fd.write("mirrors=%s\n" % " ".join(item._mirrors))
+            if getattr(item, "_bundle", None):
+                fd.write("bundle=%s\n" % item._bundle)
+
             if item.opt_attr():
                 for k, v in list(item.opt_attr().items()):
                     fd.write("%s=%s\n" % (k, v))
@@ -1321,11 +4909,163 @@ def create_logger(verbose):
     return logger
 
 
-def do_archive(args):
-    spc = Spc.open(args.SPCFILE[0])
+# The components build-baremetal-toolchain.sh and
+# build-cross-linux-toolchain.sh look for with find_component.  gcc
+# may also come as an Arm GNU Toolchain source snapshot.
+BAREMETAL_COMPONENTS = [
+    "gcc",
+    "arm-gnu-toolchain-src-snapshot",
+    "gmp",
+    "mpfr",
+    "mpc",
+    "binutils",
+    "newlib",
+    "isl",
+    "cloog",
+    "libiconv",
+    "qemu",
+]
+CROSS_LINUX_COMPONENTS = [
+    "gcc",
+    "arm-gnu-toolchain-src-snapshot",
+    "linux",
+    "glibc",
+    "gmp",
+    "mpfr",
+    "mpc",
+    "binutils",
+    "isl",
+    "cloog",
+    "libffi",
+    "libiconv",
+    "newlib",
+    "qemu",
+]
+
+
+def target_components(target):
+    """Return the components the build script for TARGET looks for."""
+    if "-linux" in target:
+        return CROSS_LINUX_COMPONENTS
+    return BAREMETAL_COMPONENTS
+
+
+def component_filter(components, target=None):
+    """
+    Return a filter accepting the named COMPONENTS and those the build
+    for TARGET uses, or None to accept every component.
+    """
+    if not components and not target:
+        return None
+    prefixes = target_components(target) if target else []
 
     def f(c):
-        return args.components == [] or c in args.components
+        # find_source_tree matches source directories by prefix, so
+        # binutils-gdb and binutils-gdb--gdb are both binutils.
+        return c in components or any(c.startswith(p) for p in prefixes)
+
+    return f
+
+
+# What keeps one component of spc_changes from being told, but not the others.
+CHANGES_ERRORS = (GitException, OfflineException, FetchException, ShellException)
+
+
+def spc_changes(old, new, cache_path, network_jobs=DEFAULT_NETWORK_JOBS, disk_jobs=DEFAULT_DISK_JOBS, logger=None):
+    """
+    Return how the components of the Spc NEW differ from those of OLD.
+
+    Each change is a dict with the component name, its status, one
+    of added, removed or changed, and the old and new descriptions.
+    A git component that stays on the same URL also has the commits
+    gained, and any dropped, taken from its mirror in CACHE_PATH.
+    Mirrors are only fetched from when they lack a revision, or to
+    follow a branch, and components are worked on concurrently.  When
+    the commits of a component cannot be had, say for a revision that
+    does not exist, the reason is kept in its "error" and the others
+    carry on.
+    """
+    logger = logger or logging.getLogger(__name__)
+    changes = []
+    jobs = []
+    for c in sorted(set(old.components()) | set(new.components())):
+        before = old[c] if c in old.components() else None
+        after = new[c] if c in new.components() else None
+        change = {
+            "component": c,
+            "old": before.describe() if before else None,
+            "new": after.describe() if after else None,
+        }
+        if before is None or after is None:
+            change["status"] = "added" if before is None else "removed"
+            changes.append(change)
+            continue
+        if before == after or change["old"] == change["new"]:
+            continue
+        change["status"] = "changed"
+        changes.append(change)
+        revisions = [before.mirror_revision(), after.mirror_revision()]
+        if None in revisions or before._url != after._url:
+            continue
+        mirror = mirror_path(cache_path, c, after._url)
+
+        pinned = isinstance(before, SpcItemGitVersion) and isinstance(after, SpcItemGitVersion)
+
+        def fetch(_, item=after, mirror=mirror, revisions=revisions, pinned=pinned, change=change):
+            # Versions already mirrored need no round trip, a branch always does.
+            try:
+                if pinned and os.path.isdir(mirror):
+                    with cache_lock(mirror, exclusive=False):
+                        hit = not Git(item._url, mirror).missing_commits(revisions)
+                    if hit:
+                        metrics.cache("mirror", True)
+                        return True
+                update_mirror(item._url, mirror, item._name, logger, mirrors=item._mirrors, version=revisions[1])
+            except CHANGES_ERRORS as e:
+                logger.info("%s: %s" % (item, e))
+                change["error"] = str(e)
+                return False
+            return True
+
+        def log(fetched, item=after, mirror=mirror, revisions=revisions, change=change):
+            if not fetched:
+                return
+            try:
+                with cache_lock(mirror, exclusive=False):
+                    repo = Git(item._url, mirror, logger=logger)
+                    change["commits"] = repo.log_range(revisions[0], revisions[1])
+                    change["dropped"] = repo.log_range(revisions[1], revisions[0])
+            except CHANGES_ERRORS as e:
+                logger.info("%s: %s" % (item, e))
+                change["error"] = str(e)
+
+        jobs.append((c, [Stage("fetch", NETWORK, fetch), Stage("log", DISK, log)]))
+    Pipeline([(NETWORK, network_jobs), (DISK, disk_jobs)], logger=logger).run(jobs)
+    return changes
+
+
+def write_changes(changes, fd):
+    """Write CHANGES, as spc_changes returns them, as text to FD."""
+    for change in changes:
+        if change["status"] == "added":
+            fd.write("%s: added, %s\n" % (change["component"], change["new"]))
+        elif change["status"] == "removed":
+            fd.write("%s: removed, was %s\n" % (change["component"], change["old"]))
+        else:
+            fd.write("%s: %s -> %s\n" % (change["component"], change["old"], change["new"]))
+        if change.get("error"):
+            fd.write("  error: %s\n" % change["error"].strip().replace("\n", "\n    "))
+        for heading, key in [("", "commits"), ("dropped ", "dropped")]:
+            commits = change.get(key, [])
+            if commits:
+                fd.write("  %s%d commit%s\n" % (heading, len(commits), "" if len(commits) == 1 else "s"))
+            for commit in commits:
+                fd.write("    %s %s (%s)\n" % (commit["commit"][:12], commit["subject"], commit["author"]))
+
+
+def do_archive(args):
+    spc = Spc.open(args.SPCFILE[0])
+    f = component_filter(args.components, args.target)
 
     # The IOError raised when attempting to write into the none
     # existent directory specified the PATH of the file rather than
@@ -1335,8 +5075,13 @@ def do_archive(args):
         sys.stderr.write("error: no such directory: %s\n" % args.output_dir)
         return 3
 
+    if args.offline:
+        missing = spc.offline_missing(args.cachedir, component_filter=f)
+        if missing:
+            raise OfflineException(missing)
+
     try:
-        spc.archive(args.output_dir, component_filter=f)
+        spc.archive(args.output_dir, component_filter=f, cache_path=args.cachedir)
     except IOError as e:
         sys.stderr.write("error: %s\n" % str(e))
         return 3
@@ -1344,10 +5089,270 @@ def do_archive(args):
 
 
 def do_checkout(args):
-    spc = Spc.open(args.SPCFILE[0])
-    spc.checkout(args.srcdir, args.shallow, cache_path=args.cachedir)
+    f = component_filter(args.components, args.target)
+    targets = []
+    missing = []
+    for arg in args.SPCFILE:
+        spcfile, _, srcdir = arg.rpartition(":")
+        if not spcfile:
+            spcfile, srcdir = arg, args.srcdir
+        spc = Spc.open(spcfile)
+        if f:
+            spc.select(f)
+        if args.offline:
+            missing.extend(spc.offline_missing(args.cachedir))
+        targets.append((spc, srcdir))
+    if missing:
+        raise OfflineException(missing)
+    Spc.checkout_many(
+        targets,
+        args.shallow,
+        cache_path=args.cachedir,
+        network_jobs=args.network_jobs,
+        disk_jobs=args.disk_jobs,
+        export=args.export,
+        space_check=not args.no_space_check,
+    )
+    return 0
+
+
+def do_cache_maintain(args):
+    logger = logging.getLogger(__name__)
+    now = time.time()
+    max_size = parse_size(args.max_size) if args.max_size else None
+    start = time.time()
+    reclaimed = 0
+    kept = []
+    # Mirrors named before mirror_path told URLs apart are moved, or
+    # dropped when their URL already has a mirror.
+    for path in cache_mirrors(args.cachedir):
+        name = os.path.basename(path)
+        url = mirror_url(path)
+        if not url or name.endswith("-" + url_digest(url)):
+            continue
+        new = mirror_path(args.cachedir, name, url)
+        if not os.path.isdir(path):
+            sys.stdout.write("%s: moved to %s\n" % (name, os.path.basename(new)))
+            continue
+        with cache_lock(path):
+            size = dir_size(path)
+            rm(path, force=True, recursive=True)
+        sys.stdout.write("%s: evicted, superseded by %s, %s\n" % (name, os.path.basename(new), format_size(size)))
+        reclaimed += size
+    for path in cache_mirrors(args.cachedir):
+        name = os.path.basename(path)
+        with cache_lock(path):
+            if not os.path.isdir(path):
+                continue
+            mirror_start = time.time()
+            before = dir_size(path)
+            age = now - os.stat(path).st_mtime
+            if args.max_age is not None and age > args.max_age * 86400:
+                rm(path, force=True, recursive=True)
+                sys.stdout.write("%s: evicted, unused for %d days, %s\n" % (name, age // 86400, format_size(before)))
+                reclaimed += before
+                continue
+            with tracer.component(name):
+                with tracer.span("maintain", "stage"):
+                    maintain_mirror(path, args.prune_expire, logger)
+            after = dir_size(path)
+            reclaimed += before - after
+            sys.stdout.write(
+                "%s: %s -> %s in %.1fs\n" % (name, format_size(before), format_size(after), time.time() - mirror_start)
+            )
+            kept.append((os.stat(path).st_mtime, path, after))
+
+    if max_size is not None:
+        # Least recently used first.
+        kept.sort()
+        total = sum(size for _, _, size in kept)
+        for _, path, size in kept:
+            if total <= max_size:
+                break
+            with cache_lock(path):
+                rm(path, force=True, recursive=True)
+            sys.stdout.write("%s: evicted, over size budget, %s\n" % (os.path.basename(path), format_size(size)))
+            total -= size
+            reclaimed += size
+
+    metrics.inc("source_fetch_cache_reclaimed_bytes_total", reclaimed)
+    sys.stdout.write("reclaimed %s in %.1fs\n" % (format_size(reclaimed), time.time() - start))
+    return 0
+
+
+def do_cache_warm(args):
+    logger = logging.getLogger(__name__)
+    start = time.time()
+    jobs = []
+    seen = set()
+    f = component_filter(args.components, args.target)
+    for spcfile in args.SPCFILE:
+        spc = Spc.open(spcfile)
+        if f:
+            spc.select(f)
+        bldroot.resolve_all(spc, args.cachedir)
+        for c in spc:
+            key = spc[c].cache_key()
+            if key is None:
+                logger.info("%s: nothing to cache" % c)
+                continue
+            if key in seen:
+                continue
+            seen.add(key)
+            jobs.append((c, spc[c].warm_stages(args.cachedir)))
+    pipeline = Pipeline([(NETWORK, args.network_jobs), (DISK, args.disk_jobs)], logger=logger)
+    try:
+        pipeline.run(jobs)
+    finally:
+        # Only what was filled counts, even when the run fails.
+        sys.stdout.write(
+            "warmed %d of %d cache entries in %.1fs\n" % (len(pipeline.completed), len(jobs), time.time() - start)
+        )
+    return 0
+
+
+def do_cache_export(args):
+    since = snapshot_index(args.since) if args.since else None
+    start = time.time()
+    if args.FILE == "-":
+        index = cache_export(args.cachedir, sys.stdout.buffer, since=since)
+        report = sys.stderr
+    else:
+        tmp = args.FILE + ".t"
+        try:
+            with open(tmp, "wb") as fd:
+                index = cache_export(args.cachedir, fd, since=since)
+        except:
+            remove_force(tmp)
+            raise
+        os.replace(tmp, args.FILE)
+        report = sys.stdout
+    report.write(
+        "exported %d of %d mirrors and %d files in %.1fs\n"
+        % (len(index["bundles"]), len(index["mirrors"]), len(index["files"]), time.time() - start)
+    )
+    return 0
+
+
+def do_cache_import(args):
+    start = time.time()
+    if args.FILE == "-":
+        index = cache_import(args.cachedir, sys.stdin.buffer)
+    else:
+        try:
+            fd = open(args.FILE, "rb")
+        except IOError as e:
+            sys.stderr.write("error: %s\n" % str(e))
+            return 3
+        with fd:
+            index = cache_import(args.cachedir, fd)
+    sys.stdout.write(
+        "imported snapshot of %d mirrors and %d files in %.1fs\n"
+        % (len(index["mirrors"]), len(index["files"]), time.time() - start)
+    )
+    return 0
+
+
+def do_cache(args):
+    if not args.cachedir:
+        sys.stderr.write("error: cache commands require --cache-dir\n")
+        return 3
+    if args.cache_command in ("warm", "import"):
+        mkdir(args.cachedir, parents=True)
+    if not os.path.isdir(args.cachedir):
+        sys.stderr.write("error: no such directory: %s\n" % args.cachedir)
+        return 3
+    if args.cache_command == "maintain":
+        return do_cache_maintain(args)
+    if args.cache_command == "warm":
+        return do_cache_warm(args)
+    if args.cache_command == "export":
+        return do_cache_export(args)
+    if args.cache_command == "import":
+        return do_cache_import(args)
+    return 0
+
+
+def do_serve(args):
+    if not args.cachedir or not os.path.isdir(args.cachedir):
+        sys.stderr.write("error: serve needs an existing --cache-dir\n")
+        return 3
+    server = CacheServer((args.bind, args.port), args.cachedir, logger=logging.getLogger(__name__))
+    host, port = server.server_address[:2]
+    sys.stdout.write("serving %s on http://%s:%d/\n" % (args.cachedir, host, port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def do_changes(args):
+    old = Spc.open(args.OLD)
+    new = Spc.open(args.NEW)
+    if args.cachedir:
+        changes = spc_changes(old, new, args.cachedir, args.network_jobs, args.disk_jobs)
+    else:
+        logging.getLogger(__name__).warning(
+            "without --cache-dir every changed repository is cloned afresh, and thrown away after"
+        )
+        with TemporaryDirectory() as tmp:
+            changes = spc_changes(old, new, tmp, args.network_jobs, args.disk_jobs)
+    if args.json:
+        json.dump({"old": args.OLD, "new": args.NEW, "changes": changes}, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        write_changes(changes, sys.stdout)
     return 0
 
+
+def do_verify(args):
+    f = component_filter(args.components, args.target)
+    items = []
+    for arg in args.SPCFILE:
+        spcfile, _, srcdir = arg.rpartition(":")
+        if not spcfile:
+            spcfile, srcdir = arg, args.srcdir
+        spc = Spc.open(spcfile)
+        if f:
+            spc.select(f)
+        bldroot.resolve_all(spc, args.cachedir)
+        items.extend((spc[c], srcdir) for c in spc)
+    # Trees are checked side by side; the hashing within each has threads of its own.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        reports = list(pool.map(lambda i: i[0].verify(i[1], args.jobs, args.full), items))
+    dirty = False
+    for problems in reports:
+        for p in problems:
+            sys.stdout.write(p + "\n")
+            dirty = True
+    return 1 if dirty else 0
+
+
+# The exit status main_ returns for each kind of error.
+EXIT_CODES = [
+    (KeyError, 3),
+    (GitException, 4),
+    (SubversionException, 4),
+    (SpcException, 5),
+    (ExternalTransformException, 6),
+    (OfflineException, 7),
+    (FetchException, 8),
+    (SpaceException, 9),
+]
+
+
+def exit_code(error):
+    """Return the exit status main_ gives for ERROR, 1 for any other error."""
+    for t, code in EXIT_CODES:
+        if isinstance(error, t):
+            return code
+    return 1
+
+
 class Extend(argparse.Action):
     def __init__(self, option_strings, dest, nargs=None, **kwargs):
         if nargs is not None:
@@ -1374,6 +5379,83 @@ def main_(args):
         dest="cachedir",
         help="Specify a cache directory.",
     )
+    parser.add_argument(
+        "--config",
+        action="store",
+        metavar="FILE",
+        help="Read site settings, such as the [mirrors] URL rewrites, from FILE.",
+    )
+    parser.add_argument(
+        "--remote-cache",
+        action="store",
+        metavar="URL",
+        help="Look in the cache served at URL, by the serve command, before going upstream.",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        default=False,
+        help="Show the stage, bytes received, throughput and time left of each component on stderr.",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        action="store",
+        type=int,
+        metavar="SECONDS",
+        default=30,
+        help="When stderr is not a terminal, write a --progress summary every SECONDS, default 30.",
+    )
+    parser.add_argument(
+        "--io-limit",
+        action="store",
+        type=float,
+        metavar="MB/S",
+        default=0,
+        help="Write extracted tarballs and exported or copied trees at no more than MB/S megabytes a second, "
+        "default no limit; git and subversion checkouts are not paced, see --idle-io.",
+    )
+    parser.add_argument(
+        "--idle-io",
+        action="store_true",
+        default=False,
+        help="Run in the idle I/O scheduling class, so builds on the same disk go first.",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store",
+        metavar="FILE",
+        help="Write a Chrome trace format timeline of the run to FILE.",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        action="store",
+        metavar="FILE",
+        help="Write Prometheus textfile collector metrics for the run to FILE.",
+    )
+    parser.add_argument(
+        "--timeout",
+        action="store",
+        type=int,
+        metavar="SECONDS",
+        default=0,
+        help="Give up on a network operation after SECONDS, default no limit.",
+    )
+    parser.add_argument(
+        "--stall-timeout",
+        action="store",
+        type=int,
+        metavar="SECONDS",
+        default=300,
+        help="Give up on a network operation making no progress for SECONDS, default 300, 0 to disable.",
+    )
+    parser.add_argument(
+        "--retries",
+        action="store",
+        type=int,
+        metavar="N",
+        default=2,
+        help="Retry transient network failures N times with backoff, default 2.",
+    )
     parser.add_argument("-v", "--verbose", action="count", default=0, help="Increase verbosity.")
     subparsers = parser.add_subparsers(dest="command")
     sub = subparsers.add_parser("archive", help="Generate tarballs from a SPEC file.")
@@ -1386,6 +5468,12 @@ def main_(args):
         help="Filter output to include only COMPONENT.",
         default=[],
     )
+    sub.add_argument(
+        "--target",
+        action="store",
+        metavar="TRIPLE",
+        help="Include the components the build scripts use for TRIPLE.",
+    )
     sub.add_argument(
         "-o",
         "--output-dir",
@@ -1393,6 +5481,12 @@ def main_(args):
         default=".",
         help="Specify an output directory, default current directory.",
     )
+    sub.add_argument(
+        "--offline",
+        action="store_true",
+        default=False,
+        help="Use only what is in the cache, failing if anything is missing.",
+    )
     sub.add_argument("SPCFILE", nargs=1)
     sub = subparsers.add_parser("checkout", help="Checkout full source trees from SPEC file.")
     sub.add_argument(
@@ -1409,30 +5503,274 @@ def main_(args):
         default=False,
         help="Do shallow checkout.",
     )
-    sub.add_argument("SPCFILE", nargs=1)
+    sub.add_argument(
+        "--export",
+        action="store_true",
+        default=False,
+        help="Write git versions as plain trees, without a .git, as the export component option does.",
+    )
+    sub.add_argument(
+        "--components",
+        action=Extend,
+        metavar="COMPONENT",
+        type=lambda xs: xs.split(","),
+        help="Only fetch COMPONENT.",
+        default=[],
+    )
+    sub.add_argument(
+        "--target",
+        action="store",
+        metavar="TRIPLE",
+        help="Only fetch the components the build scripts use for TRIPLE, and any given by --components.",
+    )
+    sub.add_argument(
+        "--offline",
+        action="store_true",
+        default=False,
+        help="Use only what is in the cache, failing if anything is missing.",
+    )
+    sub.add_argument(
+        "--network-jobs",
+        action="store",
+        type=int,
+        metavar="N",
+        default=DEFAULT_NETWORK_JOBS,
+        help="Run up to N network bound stages at once, default %d." % DEFAULT_NETWORK_JOBS,
+    )
+    sub.add_argument(
+        "--disk-jobs",
+        action="store",
+        type=int,
+        metavar="N",
+        default=DEFAULT_DISK_JOBS,
+        help="Run up to N disk and CPU bound stages at once, default %d." % DEFAULT_DISK_JOBS,
+    )
+    sub.add_argument(
+        "--no-space-check",
+        action="store_true",
+        default=False,
+        help="Start even if the estimated size of the checkout exceeds the free disk space.",
+    )
+    sub.add_argument(
+        "SPCFILE",
+        nargs="+",
+        metavar="SPCFILE[:SRCDIR]",
+        help="Check SPCFILE out into SRCDIR, default --srcdir; components shared by several are fetched once.",
+    )
+    sub = subparsers.add_parser("serve", help="Serve the --cache-dir cache over HTTP, for --remote-cache.")
+    sub.add_argument(
+        "--bind",
+        action="store",
+        metavar="ADDRESS",
+        default="127.0.0.1",
+        help="Listen on ADDRESS, default 127.0.0.1; the cache is served without authentication, "
+        "so give an address other hosts reach only on a trusted network.",
+    )
+    sub.add_argument(
+        "--port",
+        action="store",
+        type=int,
+        metavar="N",
+        default=8765,
+        help="Listen on port N, default 8765.",
+    )
+    sub = subparsers.add_parser(
+        "changes", help="Show how the components of OLD became those of NEW, with the git commits between."
+    )
+    sub.add_argument(
+        "--json",
+        action="store_true",
+        default=False,
+        help="Write the changes as JSON.",
+    )
+    sub.add_argument(
+        "--network-jobs",
+        action="store",
+        type=int,
+        metavar="N",
+        default=DEFAULT_NETWORK_JOBS,
+        help="Run up to N network bound stages at once, default %d." % DEFAULT_NETWORK_JOBS,
+    )
+    sub.add_argument(
+        "--disk-jobs",
+        action="store",
+        type=int,
+        metavar="N",
+        default=DEFAULT_DISK_JOBS,
+        help="Run up to N disk and CPU bound stages at once, default %d." % DEFAULT_DISK_JOBS,
+    )
+    sub.add_argument("OLD")
+    sub.add_argument("NEW")
+    sub = subparsers.add_parser(
+        "verify", help="Check that checked out trees are intact, listing missing and modified files."
+    )
+    sub.add_argument(
+        "--srcdir",
+        "--src-dir",
+        action="store",
+        metavar="DIR",
+        default=".",
+        help="Specify a source directory.",
+    )
+    sub.add_argument(
+        "--components",
+        action=Extend,
+        metavar="COMPONENT",
+        type=lambda xs: xs.split(","),
+        help="Only verify COMPONENT.",
+        default=[],
+    )
+    sub.add_argument(
+        "--target",
+        action="store",
+        metavar="TRIPLE",
+        help="Only verify the components the build scripts use for TRIPLE, and any given by --components.",
+    )
+    sub.add_argument(
+        "--full",
+        action="store_true",
+        default=False,
+        help="Hash every file of trees without a .git, not only those whose size or time changed.",
+    )
+    sub.add_argument(
+        "--jobs",
+        action="store",
+        type=int,
+        metavar="N",
+        default=os.cpu_count() or 1,
+        help="Hash with N threads, default one per CPU.",
+    )
+    sub.add_argument(
+        "SPCFILE",
+        nargs="+",
+        metavar="SPCFILE[:SRCDIR]",
+        help="Verify the tree SPCFILE was checked out into in SRCDIR, default --srcdir.",
+    )
+    sub = subparsers.add_parser("cache", help="Look after the --cache-dir cache.")
+    cache_subparsers = sub.add_subparsers(dest="cache_command")
+    sub = cache_subparsers.add_parser(
+        "maintain", help="Repack and index the git mirrors, and evict those no longer wanted."
+    )
+    sub.add_argument(
+        "--max-age",
+        action="store",
+        type=float,
+        metavar="DAYS",
+        help="Evict mirrors not used for DAYS.",
+    )
+    sub.add_argument(
+        "--max-size",
+        action="store",
+        metavar="SIZE",
+        help="Evict the least recently used mirrors until they take up at most SIZE, such as 50G.",
+    )
+    sub.add_argument(
+        "--prune-expire",
+        action="store",
+        metavar="DATE",
+        default="2.weeks.ago",
+        help="Prune unreachable objects older than DATE, default 2.weeks.ago.",
+    )
+    sub = cache_subparsers.add_parser(
+        "warm", help="Fetch everything the SPEC files need into the cache, without checking anything out."
+    )
+    sub.add_argument(
+        "--network-jobs",
+        action="store",
+        type=int,
+        metavar="N",
+        default=DEFAULT_NETWORK_JOBS,
+        help="Run up to N network bound stages at once, default %d." % DEFAULT_NETWORK_JOBS,
+    )
+    sub.add_argument(
+        "--disk-jobs",
+        action="store",
+        type=int,
+        metavar="N",
+        default=DEFAULT_DISK_JOBS,
+        help="Run up to N disk and CPU bound stages at once, default %d." % DEFAULT_DISK_JOBS,
+    )
+    sub.add_argument(
+        "--components",
+        action=Extend,
+        metavar="COMPONENT",
+        type=lambda xs: xs.split(","),
+        help="Only fetch COMPONENT.",
+        default=[],
+    )
+    sub.add_argument(
+        "--target",
+        action="store",
+        metavar="TRIPLE",
+        help="Only fetch the components the build scripts use for TRIPLE, and any given by --components.",
+    )
+    sub.add_argument("SPCFILE", nargs="+")
+    sub = cache_subparsers.add_parser("export", help="Write a snapshot of the cache to FILE, - for stdout.")
+    sub.add_argument(
+        "--since",
+        action="store",
+        metavar="SNAPSHOT",
+        help="Only include what changed since the earlier snapshot SNAPSHOT.",
+    )
+    sub.add_argument("FILE")
+    sub = cache_subparsers.add_parser(
+        "import", help="Merge a snapshot made by cache export from FILE, - for stdin, into the cache."
+    )
+    sub.add_argument("FILE")
 
     args = parser.parse_args(args)
+    if args.progress_interval < 1:
+        parser.error("--progress-interval must be at least 1 second")
 
     logger = create_logger(args.verbose)
+    network_policy.timeout = args.timeout or None
+    network_policy.stall_timeout = args.stall_timeout or None
+    network_policy.attempts = args.retries + 1
+    network_policy.offline = getattr(args, "offline", False)
+    if args.config:
+        mirror_map.load(args.config)
+    if args.remote_cache:
+        remote_cache.url = args.remote_cache.rstrip("/")
+    io_budget.rate = args.io_limit * 1000000 if args.io_limit > 0 else None
+    if args.idle_io:
+        set_idle_io(logger)
+    if args.trace:
+        tracer.enable()
+    if args.progress:
+        progress.enable(interval=args.progress_interval)
+    start = time.time()
+    ret = 1
     try:
         if args.command == "archive":
-            return do_archive(args)
+            ret = do_archive(args)
         elif args.command == "checkout":
-            return do_checkout(args)
-        return 0
+            ret = do_checkout(args)
+        elif args.command == "cache":
+            ret = do_cache(args)
+        elif args.command == "changes":
+            ret = do_changes(args)
+        elif args.command == "verify":
+            ret = do_verify(args)
+        elif args.command == "serve":
+            ret = do_serve(args)
+        else:
+            ret = 0
+        return ret
 
-    except KeyError as e:
-        sys.stderr.write("error: %s\n" % str(e))
-        return 3
-    except GitException as e:
-        sys.stderr.write("error: %s\n" % str(e))
-        return 4
-    except SpcException as e:
+    except tuple(t for t, _ in EXIT_CODES) as e:
         sys.stderr.write("error: %s\n" % str(e))
-        return 5
-    except ExternalTransformException as e:
-        sys.stderr.write("error: %s\n" % str(e))
-        return 6
+        ret = exit_code(e)
+        return ret
+    finally:
+        progress.stop()
+        wait_discarded()
+        if args.trace:
+            tracer.write(args.trace)
+        if args.metrics_file and args.command:
+            metrics.set("source_fetch_run_seconds", time.time() - start)
+            metrics.set("source_fetch_run_success", 1 if ret == 0 else 0)
+            metrics.set("source_fetch_last_run_timestamp_seconds", time.time())
+            metrics.write(args.metrics_file, command=args.command)
 
 
 def main():
@@ -0,0 +1,349 @@
+"""
+Asynchronous Python API to source-fetch.py.
+
+For build orchestrators that would otherwise run source-fetch.py once
+per spc file and decode its exit status.  Everything here works on the
+same Spc, SpcItem* and GitIface classes as the command line; they are
+re-exported from this module.
+
+A Session holds the cache directory, the network and disk job limits
+and the network settings of the command line options.  Any number of
+checkouts may run on one event loop through the same Session: they
+share its limits, the process wide HTTP connection pool and the cache,
+and each returns a ComponentResult per component rather than raising
+at the first failure.  Sessions whose settings differ may be used one
+after the other but not at the same time.
+
+    import asyncio
+    import source_fetch
+
+    async def main():
+        session = source_fetch.Session(cache="/var/cache/source-fetch")
+        results = await asyncio.gather(
+            session.checkout("trunk.spc", "src/trunk"),
+            session.checkout("morello.spc", "src/morello", target="aarch64-none-elf"),
+        )
+        session.close()
+
+The stages themselves are those of the command line and run on the
+Session's threads; the event loop only schedules them.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+
+_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "source-fetch.py")
+_spec = importlib.util.spec_from_file_location("source_fetch_cli", _path)
+cli = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = cli
+_spec.loader.exec_module(cli)
+
+Spc = cli.Spc
+SpcItem = cli.SpcItem
+SpcItemTarball = cli.SpcItemTarball
+SpcItemGitVersion = cli.SpcItemGitVersion
+SpcItemGitBranch = cli.SpcItemGitBranch
+SpcItemSubversionRevision = cli.SpcItemSubversionRevision
+SpcItemBldroot = cli.SpcItemBldroot
+GitIface = cli.GitIface
+Git = cli.Git
+GitException = cli.GitException
+SubversionException = cli.SubversionException
+SpcException = cli.SpcException
+OfflineException = cli.OfflineException
+FetchException = cli.FetchException
+SpaceException = cli.SpaceException
+exit_code = cli.exit_code
+
+__all__ = [
+    "Session",
+    "ComponentResult",
+    "checkout",
+    "warm",
+    "changes",
+    "exit_code",
+    "Spc",
+    "SpcItem",
+    "SpcItemTarball",
+    "SpcItemGitVersion",
+    "SpcItemGitBranch",
+    "SpcItemSubversionRevision",
+    "SpcItemBldroot",
+    "GitIface",
+    "Git",
+    "GitException",
+    "SubversionException",
+    "SpcException",
+    "OfflineException",
+    "FetchException",
+    "SpaceException",
+]
+
+
+class ComponentResult(object):
+    """
+    How one component fared.
+
+    ERROR is the exception that stopped it, or None, and EXIT_CODE
+    what source-fetch.py would have exited with for it.  STAGES holds
+    (name, queued, elapsed) for each stage run, and SECONDS the wall
+    time from its first stage being queued to its last finishing.
+    """
+
+    def __init__(self, component):
+        self.component = component
+        self.error = None
+        self.stages = []
+        self.seconds = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def exit_code(self):
+        return 0 if self.error is None else exit_code(self.error)
+
+    def to_dict(self):
+        return {
+            "component": self.component,
+            "ok": self.ok,
+            "exit_code": self.exit_code,
+            "error": str(self.error) if self.error is not None else None,
+            "seconds": self.seconds,
+            "stages": [{"stage": s, "queued": q, "elapsed": e} for s, q, e in self.stages],
+        }
+
+    def __repr__(self):
+        return "ComponentResult(%r, ok=%r, seconds=%.3f)" % (self.component, self.ok, self.seconds)
+
+
+# The settings the command line module is configured with, and how
+# many operations are running with them.
+_settings = None
+_running = 0
+_settings_lock = threading.Lock()
+
+
+def _configure(settings):
+    """Set the process wide state of the command line module from SETTINGS, as main_ does from its options."""
+    config, offline, timeout, stall_timeout, retries, remote_cache = settings
+    mirror_map = cli.MirrorMap()
+    if config:
+        mirror_map.load(config)
+    cli.mirror_map = mirror_map
+    cli.remote_cache = cli.RemoteCache()
+    cli.remote_cache.url = remote_cache
+    cli.network_policy.offline = offline
+    cli.network_policy.timeout = timeout or None
+    cli.network_policy.stall_timeout = stall_timeout or None
+    cli.network_policy.attempts = retries + 1
+
+
+class Session(object):
+    """
+    The cache, job limits and network settings shared by the operations
+    run through it.
+
+    CACHE is the --cache-dir directory, or None.  At most NETWORK_JOBS
+    network bound and DISK_JOBS disk bound stages run at once across
+    every operation of the session.  CONFIG, OFFLINE, TIMEOUT,
+    STALL_TIMEOUT, RETRIES and REMOTE_CACHE are the options of the same
+    names.  They are process wide underneath, so an operation of a
+    session raises RuntimeError while one of a session with other
+    settings is running.
+    """
+
+    def __init__(
+        self,
+        cache=None,
+        network_jobs=cli.DEFAULT_NETWORK_JOBS,
+        disk_jobs=cli.DEFAULT_DISK_JOBS,
+        config=None,
+        offline=False,
+        timeout=None,
+        stall_timeout=300,
+        retries=2,
+        remote_cache=None,
+        logger=None,
+    ):
+        self.cache = cache
+        self._logger = logger or logging.getLogger(__name__)
+        self._jobs = {cli.NETWORK: max(1, network_jobs), cli.DISK: max(1, disk_jobs)}
+        self._limits = None
+        if config:
+            # Read now so that a bad file is reported here.
+            cli.MirrorMap().load(config)
+        self._settings = (config, offline, timeout, stall_timeout, retries, remote_cache and remote_cache.rstrip("/"))
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=sum(self._jobs.values()), thread_name_prefix="source-fetch"
+        )
+        if cache:
+            cli.mkdir(cache, parents=True)
+
+    def close(self):
+        """Release the session's threads."""
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextlib.contextmanager
+    def _configured(self):
+        """Run an operation with the command line module set up as this session says."""
+        global _settings, _running
+        with _settings_lock:
+            if _settings != self._settings:
+                if _running:
+                    raise RuntimeError("a Session with other settings is running")
+                _configure(self._settings)
+                _settings = self._settings
+            _running += 1
+        try:
+            yield
+        finally:
+            with _settings_lock:
+                _running -= 1
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _open(self, spc, components, target):
+        """
+        Return a copy of the Spc SPC, or the one in the file SPC, with
+        its bldroot entries resolved, and the filter for COMPONENTS and
+        TARGET.
+
+        Each operation resolves bldroot channels afresh, so a session
+        that lives long sees the tags they move on to.
+        """
+        if isinstance(spc, Spc):
+            spc = spc.copy()
+        else:
+            spc = await self._call(Spc.open, spc)
+        f = cli.component_filter(components or [], target)
+        await self._call(cli.BldrootResolver(self._logger).resolve_all, spc, self.cache)
+        return spc, f
+
+    async def _run(self, component, stages):
+        """Run STAGES, a list of Stage, for COMPONENT within the session's limits."""
+        if self._limits is None:
+            # Made on first use so that they belong to the running loop.
+            self._limits = dict((pool, asyncio.Semaphore(n)) for pool, n in self._jobs.items())
+        result = ComponentResult(component)
+        begin = time.time()
+        arg = None
+
+        def call(stage, arg):
+            cli.progress.stage(component, stage.name)
+            with cli.tracer.component(component):
+                with cli.tracer.span(stage.name, "stage", pool=stage.pool):
+                    return stage.fn(arg)
+
+        try:
+            for stage in stages:
+                queued_at = time.time()
+                async with self._limits[stage.pool]:
+                    start = time.time()
+                    arg = await self._call(call, stage, arg)
+                elapsed = time.time() - start
+                result.stages.append((stage.name, start - queued_at, elapsed))
+                cli.metrics.inc("source_fetch_stage_seconds_total", elapsed, stage=stage.name, pool=stage.pool)
+                cli.metrics.inc(
+                    "source_fetch_stage_queue_seconds_total", start - queued_at, stage=stage.name, pool=stage.pool
+                )
+        except Exception as e:
+            self._logger.error("%s: %s" % (component, e))
+            result.error = e
+        cli.progress.done(component)
+        result.seconds = time.time() - begin
+        cli.metrics.set("source_fetch_component_seconds", result.seconds, component=component)
+        return result
+
+    async def checkout(self, spc, srcdir, shallow=False, export=False, components=None, target=None, space_check=True):
+        """
+        Check the components of SPC, an Spc or spc file, out into SRCDIR.
+
+        COMPONENTS and TARGET select components as the options of the
+        same names do, and SPACE_CHECK false is --no-space-check; the
+        jobs are those of the checkout command.  Returns a
+        ComponentResult per component, or raises SpaceException before
+        starting any.
+        """
+        with self._configured():
+            spc, f = await self._open(spc, components, target)
+            if f:
+                spc.select(f)
+            history = cli.SizeHistory(self.cache)
+            try:
+                jobs = await self._call(
+                    Spc.checkout_jobs, [(spc, srcdir)], history, shallow, self.cache, export, space_check, self._logger
+                )
+                return list(await asyncio.gather(*[self._run(c, stages) for c, stages in jobs]))
+            finally:
+                await self._call(history.save)
+
+    async def warm(self, spc, components=None, target=None):
+        """Fill the cache for the components of SPC, returning a ComponentResult for each filled."""
+        if not self.cache:
+            raise ValueError("warming needs a session with a cache")
+        with self._configured():
+            spc, f = await self._open(spc, components, target)
+            jobs = []
+            for c in spc:
+                if (not f or f(c)) and spc[c].cache_key() is not None:
+                    jobs.append(self._run(c, spc[c].warm_stages(self.cache)))
+            return list(await asyncio.gather(*jobs))
+
+    async def changes(self, old, new):
+        """Return how the components of NEW differ from those of OLD, as the changes command does."""
+        with self._configured():
+            old, _ = await self._open(old, None, None)
+            new, _ = await self._open(new, None, None)
+            if self.cache:
+                return await self._call(
+                    cli.spc_changes, old, new, self.cache, self._jobs[cli.NETWORK], self._jobs[cli.DISK], self._logger
+                )
+
+            self._logger.warning("without a cache every changed repository is cloned afresh, and thrown away after")
+
+            def run():
+                with cli.TemporaryDirectory() as tmp:
+                    return cli.spc_changes(old, new, tmp, self._jobs[cli.NETWORK], self._jobs[cli.DISK], self._logger)
+
+            return await self._call(run)
+
+
+async def checkout(spc, srcdir, jobs=None, cache=None, **kwargs):
+    """
+    Check SPC out into SRCDIR in a session of its own.
+
+    JOBS, when given, limits both the network and disk stages; other
+    keyword arguments are those of Session.checkout.
+    """
+    limits = {"network_jobs": jobs, "disk_jobs": jobs} if jobs else {}
+    with Session(cache=cache, **limits) as session:
+        return await session.checkout(spc, srcdir, **kwargs)
+
+
+async def warm(spc, cache, jobs=None, **kwargs):
+    """Fill CACHE for SPC in a session of its own, see Session.warm."""
+    limits = {"network_jobs": jobs, "disk_jobs": jobs} if jobs else {}
+    with Session(cache=cache, **limits) as session:
+        return await session.warm(spc, **kwargs)
+
+
+async def changes(old, new, cache=None):
+    """Compare the spc files OLD and NEW in a session of its own, see Session.changes."""
+    with Session(cache=cache) as session:
+        return await session.changes(old, new)
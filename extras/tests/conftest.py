@@ -0,0 +1,62 @@
+"""
+Fixtures shared by the tests of source-fetch.py.
+
+The command line module is the one source_fetch.py loads, and the
+repositories are made by the builders of source-fetch-bench.py, on
+the local disk and used over file://.
+"""
+
+import importlib.util
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+EXTRAS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, EXTRAS)
+
+import source_fetch  # noqa: E402
+
+cli = source_fetch.cli
+
+_spec = importlib.util.spec_from_file_location("source_fetch_bench", os.path.join(EXTRAS, "source-fetch-bench.py"))
+bench = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bench)
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch, tmp_path):
+    """Give each test the process wide state main_ starts from, and somewhere of its own to run."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cli, "network_policy", cli.RetryPolicy(attempts=1))
+    monkeypatch.setattr(cli, "mirror_map", cli.MirrorMap())
+    monkeypatch.setattr(cli, "remote_cache", cli.RemoteCache())
+    monkeypatch.setattr(cli, "bldroot", cli.BldrootResolver())
+    monkeypatch.setattr(cli, "_probes", {})
+    monkeypatch.setattr(source_fetch, "_settings", None)
+    for var in ("GIT_AUTHOR", "GIT_COMMITTER"):
+        monkeypatch.setenv(var + "_NAME", "Test")
+        monkeypatch.setenv(var + "_EMAIL", "test@example.com")
+
+
+def make_git_repo(path, seed=0, files=4, commits=3):
+    """Make a bare repository at PATH as the benchmark does, returning its file:// URL and head commit."""
+    head = bench.make_git_repo(str(path), random.Random(seed), files, 64, commits)
+    return "file://%s" % path, head
+
+
+def git(path, *args):
+    return subprocess.check_output(["git", "-C", str(path)] + list(args)).decode().strip()
+
+
+def write_spc(path, sections):
+    """Write an spc file in the config format, SECTIONS mapping component names to their options."""
+    with open(path, "w") as fd:
+        for name, options in sections.items():
+            fd.write("[%s]\n" % name)
+            for option, value in options.items():
+                fd.write("%s=%s\n" % (option, value))
+            fd.write("\n")
+    return str(path)
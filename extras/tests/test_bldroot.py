@@ -0,0 +1,109 @@
+"""BldrootResolver asks for each channel's tag once, and keeps spc artifacts in the cache."""
+
+import asyncio
+import subprocess
+
+import pytest
+
+from conftest import cli, source_fetch, write_spc
+
+
+class FakeBld(object):
+    """Stands in for the bld command, recording what it was asked."""
+
+    def __init__(self, tags, artifacts):
+        self.tags = tags
+        self.artifacts = artifacts
+        self.calls = []
+
+    def __call__(self, cmd):
+        self.calls.append(cmd)
+        if cmd[:3] == ["bld", "build", "list"]:
+            tag = self.tags[cmd[3]]
+            return subprocess.CompletedProcess(cmd, 0, tag.encode() + b"\n", b"")
+        if cmd[:3] == ["bld", "artifact", "exists"]:
+            return subprocess.CompletedProcess(cmd, 0 if cmd[4] in self.artifacts else 1, b"", b"")
+        if cmd[:3] == ["bld", "artifact", "get"]:
+            with open(cmd[4], "w") as fd:
+                fd.write(self.artifacts[cmd[6]])
+            return subprocess.CompletedProcess(cmd, 0, b"", b"")
+        raise AssertionError("unexpected command %s" % cmd)
+
+    def count(self, *prefix):
+        return len([c for c in self.calls if c[: len(prefix)] == list(prefix)])
+
+
+GCC = "1" * 40
+ARTIFACT = (
+    "[gcc]\ntype=git\nurl=file:///srv/gcc.git\nversion=%s\n\n"
+    "[binutils]\ntype=git\nurl=file:///srv/binutils.git\nversion=%s\n" % (GCC, "2" * 40)
+)
+
+
+@pytest.fixture
+def bld(monkeypatch):
+    fake = FakeBld({"nightly": "nightly-42"}, {"nightly-42": ARTIFACT})
+    monkeypatch.setattr(cli.BldrootResolver, "_run", lambda self, cmd: fake(cmd))
+    return fake
+
+
+def bldroot_spc(tmp_path):
+    sections = dict(
+        (name, {"type": "bldroot", "channel": "nightly", "status-filter": "passed"}) for name in ("gcc", "binutils")
+    )
+    return cli.Spc.open(write_spc(tmp_path / "a.spc", sections))
+
+
+def test_channel_is_asked_once(tmp_path, bld):
+    spc = bldroot_spc(tmp_path)
+    resolver = cli.BldrootResolver()
+    resolver.resolve_all(spc)
+    assert isinstance(spc["gcc"], cli.SpcItemGitVersion)
+    assert spc["gcc"]._version == GCC
+    assert spc["binutils"]._version == "2" * 40
+    assert bld.count("bld", "build", "list") == 1
+    assert bld.count("bld", "artifact", "get") == 1
+    resolver.tag("nightly", "passed")
+    assert bld.count("bld", "build", "list") == 1
+
+
+def test_artifact_is_kept_in_the_cache(tmp_path, bld):
+    cache = str(tmp_path / "cache")
+    cli.BldrootResolver().resolve_all(bldroot_spc(tmp_path), cache)
+    assert bld.count("bld", "artifact", "get") == 1
+    # A new run asks for the tag again, but reads the artifact from the cache.
+    spc = bldroot_spc(tmp_path)
+    cli.BldrootResolver().resolve_all(spc, cache)
+    assert bld.count("bld", "build", "list") == 2
+    assert bld.count("bld", "artifact", "get") == 1
+    assert spc["gcc"]._version == GCC
+
+
+def test_offline_needs_no_bld(tmp_path, bld):
+    cli.network_policy.offline = True
+    with pytest.raises(cli.OfflineException):
+        cli.BldrootResolver().tag("nightly", "passed")
+    assert bld.calls == []
+
+
+def test_missing_artifact_is_an_error(tmp_path, bld):
+    bld.tags["nightly"] = "nightly-43"
+    with pytest.raises(cli.SpcException):
+        cli.BldrootResolver().resolve_all(bldroot_spc(tmp_path))
+
+
+def test_session_resolves_afresh_and_leaves_the_spc_alone(tmp_path, bld):
+    spc = bldroot_spc(tmp_path)
+
+    async def resolve_twice():
+        with source_fetch.Session() as session:
+            first, _ = await session._open(spc, None, None)
+            bld.tags["nightly"] = "nightly-44"
+            bld.artifacts["nightly-44"] = ARTIFACT.replace(GCC, "3" * 40)
+            second, _ = await session._open(spc, None, None)
+        return first, second
+
+    first, second = asyncio.run(resolve_twice())
+    assert first["gcc"]._version == GCC
+    assert second["gcc"]._version == "3" * 40
+    assert isinstance(spc["gcc"], cli.SpcItemBldroot)
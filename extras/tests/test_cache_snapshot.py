@@ -0,0 +1,99 @@
+"""Cache snapshots: what cache_import refuses, and a round trip through cache_export."""
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+import pytest
+
+from conftest import cli, git, make_git_repo, write_spc
+
+
+def snapshot(members, index=None):
+    """Return a snapshot holding MEMBERS, a list of (name, data), after an index of their digests."""
+    if index is None:
+        files = dict((name, {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}) for name, data in members)
+        index = {"version": 1, "created": 0, "base": None, "mirrors": {}, "files": files}
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w") as tar:
+        for name, data in [(cli.SNAPSHOT_INDEX, json.dumps(index).encode())] + members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    out.seek(0)
+    return out
+
+
+@pytest.mark.parametrize("name", ["../x", "/abs", "downloads/../../x", "downloads//x", "mirrors/.bundle", "other/x"])
+def test_unexpected_members_are_refused(tmp_path, name):
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    with pytest.raises(cli.SpcException):
+        cli.cache_import(str(cache), snapshot([(name, b"data")]))
+    assert sorted(os.listdir(cache)) == []
+    assert not os.path.exists(tmp_path / "x")
+
+
+def test_index_comes_first(tmp_path):
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w") as tar:
+        info = tarfile.TarInfo("downloads/x")
+        tar.addfile(info, io.BytesIO(b""))
+    out.seek(0)
+    with pytest.raises(cli.SpcException):
+        cli.cache_import(str(tmp_path), out)
+
+
+def test_file_must_match_its_digest(tmp_path):
+    index = {"version": 1, "created": 0, "base": None, "mirrors": {}, "files": {}}
+    index["files"]["downloads/x"] = {"size": 4, "sha256": hashlib.sha256(b"good").hexdigest()}
+    with pytest.raises(cli.SpcException):
+        cli.cache_import(str(tmp_path), snapshot([("downloads/x", b"evil")], index))
+    assert os.listdir(tmp_path / "downloads") == []
+
+
+def test_existing_files_are_kept(tmp_path):
+    (tmp_path / "downloads").mkdir()
+    (tmp_path / "downloads" / "x").write_bytes(b"local")
+    cli.cache_import(str(tmp_path), snapshot([("downloads/x", b"other"), ("downloads/y", b"new")]))
+    assert (tmp_path / "downloads" / "x").read_bytes() == b"local"
+    assert (tmp_path / "downloads" / "y").read_bytes() == b"new"
+
+
+def test_round_trip(tmp_path):
+    url, head = make_git_repo(tmp_path / "up.git")
+    spc = write_spc(tmp_path / "a.spc", {"x": {"type": "git", "url": url, "version": head}})
+    old = tmp_path / "old"
+    assert cli.main_(["--cache-dir", str(old), "checkout", "--srcdir", str(tmp_path / "src"), spc]) == 0
+    os.makedirs(old / "downloads" / "sub")
+    (old / "downloads" / "sub" / "pkg-1.0.tar.gz").write_bytes(b"tarball")
+
+    out = io.BytesIO()
+    index = cli.cache_export(str(old), out)
+    assert list(index["files"]) == ["downloads/sub/pkg-1.0.tar.gz"]
+    assert len(index["bundles"]) == 1
+    out.seek(0)
+    new = tmp_path / "new"
+    new.mkdir()
+    cli.cache_import(str(new), out)
+
+    assert (new / "downloads" / "sub" / "pkg-1.0.tar.gz").read_bytes() == b"tarball"
+    mirror = cli.mirror_path(str(new), "x", url)
+    assert os.path.basename(mirror) == index["bundles"][0]
+    assert git(mirror, "rev-parse", head + "^{commit}") == head
+    assert git(mirror, "config", "remote.origin.url") == url
+
+    # Nothing has changed since, so a snapshot against that index carries nothing.
+    out = io.BytesIO()
+    again = cli.cache_export(str(old), out, since=index)
+    assert again["bundles"] == []
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode="r|") as tar:
+        assert [member.name for member in tar] == [cli.SNAPSHOT_INDEX]
+
+    # The offline checkout works from the imported cache alone.
+    argv = ["--cache-dir", str(new), "checkout", "--offline", "--srcdir", str(tmp_path / "again"), spc]
+    assert cli.main_(argv) == 0
+    assert git(tmp_path / "again" / "x", "rev-parse", "HEAD") == head
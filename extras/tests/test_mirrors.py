@@ -0,0 +1,94 @@
+"""Choosing between the mirrors of a git component, and falling back from them."""
+
+import os
+
+import pytest
+
+from conftest import cli, git, make_git_repo, write_spc
+
+
+def test_rank_urls_puts_unreachable_last(tmp_path):
+    mirror, _ = make_git_repo(tmp_path / "mirror.git")
+    primary, _ = make_git_repo(tmp_path / "primary.git")
+    missing = "file://%s" % (tmp_path / "missing.git")
+    urls = cli.candidate_urls(primary, [missing, mirror])
+    assert urls == [missing, mirror, primary]
+    assert cli.rank_urls(urls) == [mirror, primary, missing]
+
+
+def test_site_rewrites_are_candidates(tmp_path):
+    config = tmp_path / "site.ini"
+    config.write_text("[mirrors]\nhttps://upstream.example.com/ = file:///srv/a/ file:///srv/b/\n")
+    cli.mirror_map.load(str(config))
+    url = "https://upstream.example.com/gcc.git"
+    assert cli.candidate_urls(url) == ["file:///srv/a/gcc.git", "file:///srv/b/gcc.git", url]
+
+
+@pytest.mark.parametrize("shallow", [False, True])
+def test_broken_mirror_falls_back_to_primary(tmp_path, shallow):
+    primary, head = make_git_repo(tmp_path / "primary.git")
+    # Probes as reachable, so it is tried first, but is no repository.
+    (tmp_path / "broken.git").mkdir()
+    spc = write_spc(
+        tmp_path / "a.spc",
+        {"x": {"type": "git", "url": primary, "version": head, "mirrors": "file://%s" % (tmp_path / "broken.git")}},
+    )
+    argv = ["checkout", "--srcdir", str(tmp_path / "src"), spc]
+    if shallow:
+        argv.insert(1, "--shallow")
+    assert cli.main_(argv) == 0
+    assert git(tmp_path / "src" / "x", "rev-parse", "HEAD") == head
+    assert git(tmp_path / "src" / "x", "config", "remote.origin.url") == primary
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_mirror_tag_is_checked_against_primary(tmp_path, cached):
+    primary, head = make_git_repo(tmp_path / "primary.git", seed=0)
+    mirror, other = make_git_repo(tmp_path / "mirror.git", seed=1)
+    git(tmp_path / "primary.git", "tag", "v1", head)
+    git(tmp_path / "mirror.git", "tag", "v1", other)
+    spc = write_spc(tmp_path / "a.spc", {"x": {"type": "git", "url": primary, "version": "v1", "mirrors": mirror}})
+    cache = ["--cache-dir", str(tmp_path / "cache")] if cached else []
+
+    # A full clone takes its refs from the primary after the mirror.
+    assert cli.main_(cache + ["checkout", "--srcdir", str(tmp_path / "full"), spc]) == 0
+    assert git(tmp_path / "full" / "x", "rev-parse", "HEAD") == head
+
+    # A shallow fetch of the mirror's v1 is refused and leaves nothing.
+    assert cli.main_(["checkout", "--shallow", "--srcdir", str(tmp_path / "shallow"), spc]) == 4
+    assert not os.path.exists(tmp_path / "shallow" / "x")
+
+
+def test_unreachable_primary_accepts_only_full_sha(tmp_path):
+    mirror, head = make_git_repo(tmp_path / "mirror.git")
+    git(tmp_path / "mirror.git", "tag", "v1", head)
+    primary = "file://%s" % (tmp_path / "gone.git")
+    repo = cli.Git.clone(mirror, str(tmp_path / "clone"))
+    repo.set_url(primary)
+    repo.fetch_verified(head)
+    with pytest.raises(cli.GitException):
+        repo.fetch_verified("v1")
+
+
+def test_mirrors_in_the_cache_are_kept_per_url(tmp_path):
+    one, head_one = make_git_repo(tmp_path / "one.git", seed=0)
+    two, head_two = make_git_repo(tmp_path / "two.git", seed=1)
+    cache = tmp_path / "cache"
+    for n, (url, head) in enumerate([(one, head_one), (two, head_two)]):
+        spc = write_spc(tmp_path / ("%d.spc" % n), {"x": {"type": "git", "url": url, "version": head}})
+        argv = ["--cache-dir", str(cache), "checkout", "--srcdir", str(tmp_path / ("src%d" % n)), spc]
+        assert cli.main_(argv) == 0
+        assert git(tmp_path / ("src%d" % n) / "x", "rev-parse", "HEAD") == head
+    assert sorted(os.path.basename(m) for m in cli.cache_mirrors(str(cache))) == sorted(
+        os.path.basename(cli.mirror_path(str(cache), "x", u)) for u in (one, two)
+    )
+
+
+def test_old_layout_mirror_is_moved(tmp_path):
+    url, head = make_git_repo(tmp_path / "up.git")
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    cli.Git.clone(url, str(cache / "x"), mirror=True)
+    path = cli.mirror_path(str(cache), "x", url)
+    assert os.path.isdir(path)
+    assert not os.path.exists(cache / "x")
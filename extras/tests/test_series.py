@@ -0,0 +1,48 @@
+"""Series.parse takes only patches below the series, as those are kept in the cache."""
+
+import os
+
+import pytest
+
+from conftest import cli
+
+URL = "https://example.com/patches/series"
+
+
+@pytest.mark.parametrize("name", ["/abs.diff", "../x.diff", "a/../../x.diff", "a/..", "series"])
+def test_unsafe_entries_are_refused(name):
+    with pytest.raises(cli.FetchException):
+        cli.Series.parse(URL, "fix.diff\n%s\n" % name)
+
+
+def test_entries_below_the_series_are_kept():
+    text = "\n  fix.diff\nsub/fix.diff  \n\nsub/dir/other.patch\n"
+    assert cli.Series.parse(URL, text) == ["fix.diff", "sub/fix.diff", "sub/dir/other.patch"]
+
+
+def test_cached_series_is_checked_too(tmp_path):
+    cache = str(tmp_path / "cache")
+    series = cli.Series.cache_dir(URL, cache)
+    os.makedirs(series)
+    with open(os.path.join(series, "series"), "w") as fd:
+        fd.write("fix.diff\n../../../escape.diff\n")
+    cli.network_policy.offline = True
+    with pytest.raises(cli.FetchException):
+        cli.Series.fetch(URL, cache_path=cache)
+
+
+def test_cached_series_is_loaded_offline(tmp_path):
+    cache = str(tmp_path / "cache")
+    series = cli.Series.cache_dir(URL, cache)
+    os.makedirs(os.path.join(series, "sub"))
+    with open(os.path.join(series, "series"), "w") as fd:
+        fd.write("fix.diff\nsub/fix.diff\n")
+    for name in ("fix.diff", "sub/fix.diff"):
+        with open(os.path.join(series, name), "wb") as fd:
+            fd.write(b"patch %s\n" % name.encode())
+    cli.network_policy.offline = True
+    loaded = cli.Series.fetch(URL, cache_path=cache)
+    assert loaded.names() == ["fix.diff", "sub/fix.diff"]
+    assert loaded.contents() == [b"patch fix.diff\n", b"patch sub/fix.diff\n"]
+    os.unlink(os.path.join(series, "sub", "fix.diff"))
+    assert cli.Series.missing(URL, cache) == ["https://example.com/patches/sub/fix.diff"]
@@ -0,0 +1,69 @@
+"""Subversion components: checkout and archive over file://, directly and through a cache mirror."""
+
+import os
+import random
+import shutil
+import tarfile
+
+import pytest
+
+from conftest import bench, cli, write_spc
+
+needs_svn = pytest.mark.skipif(
+    not all(shutil.which(tool) for tool in ("svn", "svnadmin", "svnlook", "svnsync")),
+    reason="needs the subversion command line tools",
+)
+
+FILES = ["src/f%05d.c" % f for f in range(3)]
+
+
+@pytest.fixture
+def svn_spc(tmp_path):
+    url, youngest = bench.make_svn_repo(str(tmp_path / "repo"), random.Random(0), len(FILES), 64, 3)
+    return write_spc(tmp_path / "a.spc", {"x": {"type": "subversion", "url": url, "revision": youngest}})
+
+
+def test_entry_needs_url_and_revision(tmp_path):
+    for options in ({"url": "file:///srv/repo/trunk"}, {"revision": "3"}):
+        options["type"] = "subversion"
+        with pytest.raises(cli.SpcException):
+            cli.Spc.open(write_spc(tmp_path / "a.spc", {"x": options}))
+
+
+def test_offline_without_mirror_is_refused(tmp_path):
+    spc = write_spc(tmp_path / "a.spc", {"x": {"type": "subversion", "url": "file:///srv/repo/trunk", "revision": "3"}})
+    argv = ["--cache-dir", str(tmp_path / "cache"), "checkout", "--offline", "--srcdir", str(tmp_path / "src"), spc]
+    assert cli.main_(argv) == 7
+    assert not os.path.exists(tmp_path / "src" / "x")
+
+
+@needs_svn
+@pytest.mark.parametrize("cached", [False, True])
+def test_checkout_and_archive(tmp_path, svn_spc, cached):
+    cache = ["--cache-dir", str(tmp_path / "cache")] if cached else []
+    src = tmp_path / "src"
+    assert cli.main_(cache + ["checkout", "--srcdir", str(src), svn_spc]) == 0
+    for rel in FILES:
+        assert os.path.isfile(src / "x" / rel)
+    assert not os.path.exists(src / "x" / ".svn")
+    assert cli.main_(["verify", "--srcdir", str(src), svn_spc]) == 0
+
+    out = tmp_path / "out"
+    out.mkdir()
+    assert cli.main_(cache + ["archive", "-o", str(out), svn_spc]) == 0
+    with tarfile.open(out / "x.tar") as tar:
+        names = tar.getnames()
+    assert sorted(n for n in names if n.startswith("x/src/")) == sorted("x/" + rel for rel in FILES)
+    with tarfile.open(out / "x.tar") as tar:
+        assert tar.extractfile("x/" + FILES[0]).read() == (src / "x" / FILES[0]).read_bytes()
+
+
+@needs_svn
+def test_offline_checkout_from_the_mirror(tmp_path, svn_spc):
+    cache = ["--cache-dir", str(tmp_path / "cache")]
+    assert cli.main_(cache + ["checkout", "--srcdir", str(tmp_path / "one"), svn_spc]) == 0
+    # The repository is gone; the mirror has all that is needed.
+    shutil.rmtree(tmp_path / "repo")
+    assert cli.main_(cache + ["checkout", "--offline", "--srcdir", str(tmp_path / "two"), svn_spc]) == 0
+    for rel in FILES:
+        assert (tmp_path / "two" / "x" / rel).read_bytes() == (tmp_path / "one" / "x" / rel).read_bytes()